@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from fman.url import as_url, basename, dirname, splitscheme
+from hashlib import sha1
+from tempfile import mkdtemp
+from threading import Lock
+
+import fman.fs
+import os
+import shutil
+
+class ArchiveCache:
+	"""
+	Keeps local copies of files extracted from archives, so they can be opened
+	with other applications. Entries are keyed by the archive's size and
+	modification time and by the file's path inside the archive. When the
+	total size of the cache exceeds `max_size_bytes`, the least recently used
+	entries are deleted.
+	"""
+	def __init__(self, cache_dir, max_size_bytes, fs=fman.fs):
+		self._dir = cache_dir
+		self._max_size_bytes = max_size_bytes
+		self._fs = fs
+		self._entries = OrderedDict()
+		self._lock = Lock()
+		self.hits = self.misses = 0
+		self._load_entries()
+	def get(self, url):
+		"""
+		Return the local path of the cached copy of `url`, or None if it isn't
+		cached yet.
+		"""
+		key = self._get_key(url)
+		entry_dir = os.path.join(self._dir, key)
+		result = os.path.join(entry_dir, basename(url))
+		with self._lock:
+			if key in self._entries and os.path.exists(result):
+				self._entries.move_to_end(key)
+				self.hits += 1
+			else:
+				# The file may have been deleted behind our back:
+				self._entries.pop(key, None)
+				self.misses += 1
+				return None
+		# Persist the access time so the LRU order survives restarts:
+		os.utime(entry_dir)
+		return result
+	def extract(self, url, run_task=None):
+		"""
+		Extract `url` into the cache and return the path of the local copy.
+		`run_task` lets the caller execute the extraction tasks, for instance
+		to show their progress.
+		"""
+		if run_task is None:
+			run_task = lambda task: task()
+		os.makedirs(self._dir, exist_ok=True)
+		key = self._get_key(url)
+		# Extract into a temporary directory first. This ensures that the
+		# cache never contains incomplete entries:
+		tmp_dir = mkdtemp(dir=self._dir, suffix='.tmp')
+		try:
+			tmp_path = os.path.join(tmp_dir, basename(url))
+			for task in self._fs.prepare_copy(url, as_url(tmp_path)):
+				run_task(task)
+			entry_dir = os.path.join(self._dir, key)
+			shutil.rmtree(entry_dir, ignore_errors=True)
+			os.rename(tmp_dir, entry_dir)
+		except BaseException:
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+			raise
+		with self._lock:
+			self._entries[key] = _get_size_bytes(entry_dir)
+			self._entries.move_to_end(key)
+			self._evict(keep=key)
+		return os.path.join(entry_dir, basename(url))
+	def describe_stats(self):
+		total = self.hits + self.misses
+		hit_rate = 100 * self.hits // total if total else 0
+		return 'Archive cache: %d hits, %d misses (%d%% hit rate).' % \
+			   (self.hits, self.misses, hit_rate)
+	def _evict(self, keep):
+		total_size = sum(self._entries.values())
+		for key in list(self._entries):
+			if total_size <= self._max_size_bytes:
+				break
+			if key == keep:
+				continue
+			total_size -= self._entries.pop(key)
+			shutil.rmtree(os.path.join(self._dir, key), ignore_errors=True)
+	def _get_key(self, url):
+		archive_path = _find_archive(url)
+		if archive_path is None:
+			raise FileNotFoundError(url)
+		stat = os.stat(archive_path)
+		data = '\0'.join((url, str(stat.st_size), str(stat.st_mtime_ns)))
+		return sha1(data.encode('utf-8')).hexdigest()
+	def _load_entries(self):
+		try:
+			names = os.listdir(self._dir)
+		except FileNotFoundError:
+			return
+		entries = []
+		for name in names:
+			path = os.path.join(self._dir, name)
+			if name.endswith('.tmp'):
+				# Left over from an extraction that was interrupted:
+				shutil.rmtree(path, ignore_errors=True)
+				continue
+			try:
+				mtime = os.stat(path).st_mtime
+			except OSError:
+				continue
+			entries.append((mtime, name, _get_size_bytes(path)))
+		for _, name, size in sorted(entries):
+			self._entries[name] = size
+
+def _find_archive(url):
+	# Walk up from zip:///a.zip/b/c.txt until we find the local file a.zip:
+	while True:
+		path = splitscheme(url)[1]
+		if os.path.isfile(path):
+			return path
+		parent = dirname(url)
+		if parent == url:
+			return None
+		url = parent
+
+def _get_size_bytes(dir_path):
+	result = 0
+	for parent, _, file_names in os.walk(dir_path):
+		for file_name in file_names:
+			try:
+				result += os.path.getsize(os.path.join(parent, file_name))
+			except OSError:
+				pass
+	return result
\ No newline at end of file
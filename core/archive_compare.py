@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from core.fs.compressed_tar import _detect_format, _normalize
+from core.fs.zip import iter_archive_infos
+from zipfile import ZipFile, BadZipFile, is_zipfile
+
+import os
+import tarfile
+import zlib
+
+def compare_with_directory(
+	archive_path, dir_path, check_canceled=None, num_workers=None
+):
+	"""
+	Compare the files in the archive at `archive_path` with those below the
+	local directory `dir_path`, without extracting anything. Files are compared
+	by the CRC32 the archive stores for them. Compressed tar archives have to
+	be decompressed anyway, so the CRC32 of their files is computed while doing
+	so. For other formats without CRCs, such as tar, only the sizes are
+	compared. The local files are hashed in parallel.
+	Returns two sorted lists of paths in the archive: Those whose local copy
+	differs and those that don't exist locally.
+	"""
+	if check_canceled is None:
+		check_canceled = lambda: None
+	if num_workers is None:
+		num_workers = os.cpu_count() or 1
+	differing = []
+	missing = []
+	to_hash = []
+	for path, size, crc in _iter_members(archive_path, check_canceled):
+		check_canceled()
+		local_path = os.path.join(dir_path, *path.split('/'))
+		try:
+			local_size = os.path.getsize(local_path)
+		except OSError:
+			missing.append(path)
+			continue
+		if local_size != size:
+			differing.append(path)
+		elif crc is not None:
+			to_hash.append((path, local_path, crc))
+	def has_crc(item):
+		_, local_path, crc = item
+		return _crc32(local_path, check_canceled) == crc
+	with ThreadPoolExecutor(num_workers) as executor:
+		for item, matches in zip(to_hash, executor.map(has_crc, to_hash)):
+			if not matches:
+				differing.append(item[0])
+	return sorted(differing), sorted(missing)
+
+def _iter_members(archive_path, check_canceled):
+	# Yield (path, size, CRC32 or None) for each file in the archive.
+	# 7-Zip's listing below does not fail when the archive doesn't exist:
+	os.stat(archive_path)
+	if is_zipfile(archive_path):
+		# Python's zipfile reads the CRCs much faster than starting 7-Zip:
+		try:
+			with ZipFile(archive_path) as zip_file:
+				infos = zip_file.infolist()
+		except BadZipFile:
+			pass
+		else:
+			for info in infos:
+				if not info.is_dir():
+					yield info.filename, info.file_size, info.CRC
+			return
+	if _detect_format(archive_path) and tarfile.is_tarfile(archive_path):
+		# 7-Zip would only list the .tar inside .tar.gz etc.
+		yield from _iter_compressed_tar_members(archive_path, check_canceled)
+		return
+	for info in iter_archive_infos(archive_path):
+		if not info.is_dir:
+			yield info.path, info.size_bytes, info.crc
+
+def _iter_compressed_tar_members(archive_path, check_canceled):
+	with tarfile.open(archive_path, 'r|*') as tar_file:
+		for tar_info in tar_file:
+			if tar_info.isfile():
+				# In stream mode, only the current member can be read:
+				with tar_file.extractfile(tar_info) as f:
+					crc = _crc32_of_stream(f, check_canceled)
+				yield _normalize(tar_info.name), tar_info.size, crc
+
+def _crc32(path, check_canceled):
+	try:
+		with open(path, 'rb') as f:
+			return _crc32_of_stream(f, check_canceled)
+	except OSError:
+		return None
+
+def _crc32_of_stream(f, check_canceled):
+	result = 0
+	while True:
+		check_canceled()
+		chunk = f.read(1024 * 1024)
+		if not chunk:
+			return result
+		result = zlib.crc32(chunk, result)
\ No newline at end of file
@@ -0,0 +1,152 @@
+from concurrent.futures import ThreadPoolExecutor
+from core.fs.compressed_tar import _normalize
+from core.fs.zip import iter_archive_infos, open_archive_member
+from fnmatch import fnmatchcase
+from queue import Queue, Empty
+from threading import Event
+from zipfile import ZipFile, is_zipfile
+
+import os
+import tarfile
+
+def search_archives(
+	dir_path, suffixes, name_pattern, text=None, check_canceled=None,
+	num_workers=None, on_error=None
+):
+	"""
+	Search the archives below `dir_path` for files whose name matches the
+	wildcard `name_pattern` and, if given, that contain `text`. The archives
+	are searched in parallel. Yields (archive path, path in archive) tuples as
+	they are found. `check_canceled` is called regularly and can raise an
+	exception to abort the search. Archives that can't be read, for instance
+	because they are corrupt or encrypted, are skipped. `on_error` is called
+	with the path of each of them and the exception that occurred.
+	"""
+	if check_canceled is None:
+		check_canceled = lambda: None
+	if on_error is None:
+		on_error = lambda archive_path, exc: None
+	if num_workers is None:
+		num_workers = max(4, os.cpu_count() or 1)
+	search = _ArchiveSearch(name_pattern, text)
+	executor = ThreadPoolExecutor(num_workers)
+	futures = []
+	try:
+		for archive_path in _find_archives(dir_path, suffixes):
+			check_canceled()
+			futures.append(executor.submit(search, archive_path))
+			yield from search.get_matches()
+			search.report_errors(on_error)
+		while futures:
+			try:
+				yield search.get_match(timeout=.1)
+			except Empty:
+				check_canceled()
+				futures = [future for future in futures if not future.done()]
+				search.report_errors(on_error)
+		yield from search.get_matches()
+		search.report_errors(on_error)
+	finally:
+		search.cancel()
+		for future in futures:
+			future.cancel()
+		executor.shutdown(wait=False)
+
+class _ArchiveSearch:
+	def __init__(self, name_pattern, text=None):
+		self._name_pattern = name_pattern.lower()
+		self._text = text.encode('utf-8') if text else None
+		self._matches = Queue()
+		# (archive path, exception) tuples:
+		self._errors = Queue()
+		self._canceled = Event()
+	def __call__(self, archive_path):
+		try:
+			if is_zipfile(archive_path):
+				# Python's zipfile is much faster than starting 7-Zip:
+				self._search_zip(archive_path)
+			elif tarfile.is_tarfile(archive_path):
+				# 7-Zip only sees the .tar inside .tar.gz etc. tarfile reads
+				# those and plain tar files in a single pass:
+				self._search_tar(archive_path)
+			else:
+				self._search_with_7zip(archive_path)
+		except Exception as e:
+			# The archive is corrupt, encrypted or can't be read. Skip it:
+			self._errors.put((archive_path, e))
+	def get_match(self, timeout):
+		return self._matches.get(timeout=timeout)
+	def get_matches(self):
+		while True:
+			try:
+				yield self._matches.get_nowait()
+			except Empty:
+				break
+	def report_errors(self, on_error):
+		while True:
+			try:
+				archive_path, exc = self._errors.get_nowait()
+			except Empty:
+				break
+			on_error(archive_path, exc)
+	def cancel(self):
+		self._canceled.set()
+	def _search_zip(self, archive_path):
+		with ZipFile(archive_path) as zip_file:
+			for info in zip_file.infolist():
+				if self._canceled.is_set():
+					break
+				path = info.filename.rstrip('/')
+				if info.is_dir() or not self._name_matches(path):
+					continue
+				if self._text:
+					with zip_file.open(info) as f:
+						if not self._contains_text(f):
+							continue
+				self._matches.put((archive_path, path))
+	def _search_tar(self, archive_path):
+		with tarfile.open(archive_path, 'r|*') as tar_file:
+			for tar_info in tar_file:
+				if self._canceled.is_set():
+					break
+				path = _normalize(tar_info.name)
+				if not tar_info.isfile() or not self._name_matches(path):
+					continue
+				if self._text:
+					# In stream mode, only the current member can be read:
+					with tar_file.extractfile(tar_info) as f:
+						if not self._contains_text(f):
+							continue
+				self._matches.put((archive_path, path))
+	def _search_with_7zip(self, archive_path):
+		for info in iter_archive_infos(archive_path):
+			if self._canceled.is_set():
+				break
+			if info.is_dir or not self._name_matches(info.path):
+				continue
+			if self._text:
+				with open_archive_member(archive_path, info.path) as f:
+					if not self._contains_text(f):
+						continue
+			self._matches.put((archive_path, info.path))
+	def _name_matches(self, path):
+		name = path.rsplit('/', 1)[-1]
+		return fnmatchcase(name.lower(), self._name_pattern)
+	def _contains_text(self, f):
+		# Keep the end of the last chunk in case the text spans two chunks:
+		overlap = len(self._text) - 1
+		data = b''
+		while not self._canceled.is_set():
+			chunk = f.read(64 * 1024)
+			if not chunk:
+				break
+			data = data[-overlap:] + chunk if overlap else chunk
+			if self._text in data:
+				return True
+		return False
+
+def _find_archives(dir_path, suffixes):
+	for parent, _, file_names in os.walk(dir_path):
+		for file_name in file_names:
+			if any(file_name.lower().endswith(suffix) for suffix in suffixes):
+				yield os.path.join(parent, file_name)
\ No newline at end of file
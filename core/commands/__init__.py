@@ -1,6 +1,11 @@
+from core.archive_cache import ArchiveCache
+from core.archive_compare import compare_with_directory
+from core.archive_search import search_archives
 from core.commands.util import get_program_files, get_program_files_x86, \
 	is_hidden
 from core.fileoperations import CopyFiles, MoveFiles
+from core.fs.zip import combine_additions, archive_transaction, \
+	CheckArchives, BatchExtract, BatchPack
 from core.github import find_repos, GitHubRepo
 from core.os_ import open_terminal_in_directory, open_native_file_manager, \
 	get_popen_kwargs_for_opening
@@ -21,7 +26,7 @@ from os.path import basename, pardir
 from pathlib import PurePath
 from PyQt5.QtCore import QUrl
 from PyQt5.QtGui import QDesktopServices
-from subprocess import Popen, DEVNULL, PIPE
+from subprocess import Popen, DEVNULL, PIPE, CalledProcessError
 from tempfile import TemporaryDirectory
 from urllib.error import URLError
 
@@ -136,6 +141,16 @@ class _Delete(Task):
 				% splitscheme(failing_url)[0]
 			)
 			return
+		try:
+			# Delete files in archives with as few 7-Zip invocations as
+			# possible:
+			with archive_transaction(self):
+				self._run_tasks()
+		except FileNotFoundError:
+			pass
+		except OSError as e:
+			self.show_alert(_get_error_message(self.get_title(), e))
+	def _run_tasks(self):
 		ignore_errors = False
 		for i, task in enumerate(self._tasks):
 			self.check_canceled()
@@ -147,14 +162,7 @@ class _Delete(Task):
 			except OSError as e:
 				if ignore_errors:
 					continue
-				text = task.get_title()
-				message = 'Error ' + text[0].lower() + text[1:]
-				reason = e.strerror or ''
-				if not reason and e.errno is not None:
-					reason = strerror(e.errno)
-				if reason:
-					message += ': ' + reason
-				message += '.'
+				message = _get_error_message(task.get_title(), e)
 				is_last = i == len(self._tasks) - 1
 				if is_last:
 					self.show_alert(message)
@@ -185,6 +193,15 @@ class _Delete(Task):
 				self.set_text('Preparing to delete {:,} files.'.format(num))
 		self._tasks.extend(url_tasks)
 
+def _get_error_message(task_title, exc):
+	message = 'Error ' + task_title[0].lower() + task_title[1:]
+	reason = exc.strerror or ''
+	if not reason and exc.errno is not None:
+		reason = strerror(exc.errno)
+	if reason:
+		message += ': ' + reason
+	return message + '.'
+
 def _describe(files, template='%d files'):
 	if len(files) == 1:
 		return basename(files[0])
@@ -297,6 +314,7 @@ class OpenFile(DirectoryPaneCommand):
 
 def _open_files(urls, pane):
 	local_file_paths = []
+	archive_urls = []
 	for url in urls:
 		# On Windows, CMD can handle mapped drives Z:\ but not UNC paths
 		# //192.168.0.2. If the former maps to the latter, then CMD fails to
@@ -315,6 +333,9 @@ def _open_files(urls, pane):
 					continue
 		scheme = splitscheme(url)[0]
 		if scheme != 'file://':
+			if _is_archive_scheme(scheme):
+				archive_urls.append(url)
+				continue
 			show_alert(
 				'Opening files from %s is not supported. If you are a plugin '
 				'developer, you can implement this with '
@@ -325,6 +346,61 @@ def _open_files(urls, pane):
 		# above to get backslashes on Windows:
 		local_file_paths.append(as_human_readable(url))
 	_open_local_files(local_file_paths, pane)
+	if archive_urls:
+		_open_files_in_archives(archive_urls, pane)
+
+def _is_archive_scheme(scheme):
+	settings = load_json('Core Settings.json', default={})
+	return scheme in settings.get('archive_handlers', {}).values()
+
+def _open_files_in_archives(urls, pane):
+	cache = _get_archive_cache()
+	cached_paths = []
+	to_extract = []
+	for url in urls:
+		try:
+			path = cache.get(url)
+		except OSError:
+			continue
+		if path:
+			cached_paths.append(path)
+		else:
+			to_extract.append(url)
+	_open_local_files(cached_paths, pane)
+	if to_extract:
+		submit_task(_ExtractAndOpen(to_extract, cache, pane))
+	else:
+		show_status_message(cache.describe_stats(), timeout_secs=3)
+
+def _get_archive_cache():
+	global _ARCHIVE_CACHE
+	if _ARCHIVE_CACHE is None:
+		settings = load_json('Core Settings.json', default={})
+		max_size_mb = settings.get('archive_cache_size_mb', 1024)
+		cache_dir = os.path.join(DATA_DIRECTORY, 'Local', 'Archive Cache')
+		_ARCHIVE_CACHE = ArchiveCache(cache_dir, max_size_mb * 1024 * 1024)
+	return _ARCHIVE_CACHE
+
+_ARCHIVE_CACHE = None
+
+class _ExtractAndOpen(Task):
+	def __init__(self, urls, cache, pane):
+		super().__init__('Extracting ' + _describe(urls))
+		self._urls = urls
+		self._cache = cache
+		self._pane = pane
+	def __call__(self):
+		paths = []
+		for url in self._urls:
+			self.check_canceled()
+			try:
+				paths.append(self._cache.extract(url, self.run))
+			except OSError as e:
+				self.show_alert(
+					'Could not extract %s (%s).' % (basename(url), e)
+				)
+		_open_local_files(paths, self._pane)
+		show_status_message(self._cache.describe_stats(), timeout_secs=3)
 
 def _is_file_url(url):
 	return splitscheme(url)[0] == 'file://'
@@ -1689,6 +1765,9 @@ class Pack(DirectoryPaneCommand):
 			try:
 				# Create empty archive:
 				mkdir(dest_rewritten)
+			except UnsupportedOperation:
+				show_alert('Sorry, but this archive format is read-only.')
+				return
 			except FileExistsError:
 				answer = show_alert(
 					'%s already exists. Do you want to add/update the selected '
@@ -1702,16 +1781,30 @@ class Pack(DirectoryPaneCommand):
 
 class _Pack(Task):
 	def __init__(self, files, archive_url):
-		super().__init__('Packing ' + _describe(files), size=len(files) * 100)
+		super().__init__('Packing ' + _describe(files))
 		self._files = files
 		self._archive = archive_url
 	def __call__(self):
+		self.set_text('Preparing...')
+		tasks = []
 		for f in self._files:
 			for task in prepare_copy(f, join(self._archive, basename(f))):
 				self.check_canceled()
-				self.run(task)
+				tasks.append(task)
+		# Let 7-Zip pack all files in one go. Otherwise, it would rewrite the
+		# archive once for each file:
+		tasks = combine_additions(tasks)
+		self.set_size(sum(task.get_size() for task in tasks))
+		for task in tasks:
+			self.check_canceled()
+			self.run(task)
 
 def _get_handler_for_archive(file_name):
+	return _find_archive_handler(file_name)[1]
+
+def _find_archive_handler(file_name):
+	# Return the archive suffix of the given file name and the scheme that
+	# handles it, or (None, None):
 	settings = load_json('Core Settings.json', default={})
 	archive_types = sorted(
 		settings.get('archive_handlers', {}).items(),
@@ -1719,7 +1812,251 @@ def _get_handler_for_archive(file_name):
 	)
 	for suffix, scheme in archive_types:
 		if file_name.lower().endswith(suffix):
-			return scheme
+			return suffix, scheme
+	return None, None
+
+class ExtractEach(DirectoryPaneCommand):
+
+	aliases = ('Extract each archive to its own folder', 'Extract here')
+
+	def __call__(self):
+		items = []
+		dst_urls = set()
+		for url in self.get_chosen_files():
+			file_name = basename(url)
+			suffix, scheme = _find_archive_handler(file_name)
+			if not scheme or not _is_file_url(url):
+				continue
+			dir_name = file_name[:-len(suffix)] or file_name
+			dst_url = _get_unused_url(dirname(url), dir_name, '', dst_urls)
+			dst_urls.add(dst_url)
+			items.append((scheme + splitscheme(url)[1], dst_url))
+		if not items:
+			show_alert('Please select one or more local archives to extract.')
+			return
+		submit_task(BatchExtract(items))
+	def is_visible(self):
+		return bool(self.pane.get_file_under_cursor())
+
+class PackEach(DirectoryPaneCommand):
+
+	aliases = ('Pack each to its own archive', 'Compress each')
+
+	def __call__(self):
+		files = [f for f in self.get_chosen_files() if _is_file_url(f)]
+		if not files:
+			show_alert('No file is selected!')
+			return
+		items = []
+		archive_urls = set()
+		for url in files:
+			stem = PurePath(basename(url)).stem if not is_dir(url) \
+				else basename(url)
+			archive_url = \
+				_get_unused_url(dirname(url), stem, '.zip', archive_urls)
+			archive_urls.add(archive_url)
+			items.append((url, 'zip://' + splitscheme(archive_url)[1]))
+		submit_task(BatchPack(items))
+	def is_visible(self):
+		return bool(self.pane.get_file_under_cursor())
+
+def _get_unused_url(dir_url, stem, suffix, taken):
+	# Find a name "stem", "stem (2)", ... that doesn't exist yet and isn't
+	# about to be created:
+	result = join(dir_url, stem + suffix)
+	i = 2
+	while result in taken or exists(result):
+		result = join(dir_url, '%s (%d)%s' % (stem, i, suffix))
+		i += 1
+	return result
+
+class TestArchives(DirectoryPaneCommand):
+
+	aliases = ('Test archive', 'Verify archive integrity')
+
+	def __call__(self):
+		files = self.get_chosen_files()
+		archives = [
+			as_human_readable(f) for f in files
+			if _is_file_url(f) and _get_handler_for_archive(basename(f))
+		]
+		if not archives:
+			show_alert('Please select one or more local archives to test.')
+			return
+		submit_task(CheckArchives(archives))
+	def is_visible(self):
+		return bool(self.pane.get_file_under_cursor())
+
+class CompareArchiveWithDirectory(DirectoryPaneCommand):
+
+	aliases = (
+		'Compare archive with directory', 'Verify extracted files (CRC)'
+	)
+
+	def __call__(self):
+		url = self.pane.get_file_under_cursor()
+		if not url or not _is_file_url(url) or \
+			not _get_handler_for_archive(basename(url)):
+			show_alert('Please place the cursor on a local archive.')
+			return
+		dir_url = _get_opposite_pane(self.pane).get_path()
+		if not _is_file_url(dir_url):
+			show_alert(
+				'Please open the local directory to compare with in the other '
+				'pane.'
+			)
+			return
+		submit_task(_CompareArchiveWithDirectory(
+			as_human_readable(url), as_human_readable(dir_url)
+		))
+	def is_visible(self):
+		return bool(self.pane.get_file_under_cursor())
+
+class _CompareArchiveWithDirectory(Task):
+
+	_MAX_NUM_PATHS_SHOWN = 20
+
+	def __init__(self, archive_path, dir_path):
+		super().__init__('Comparing ' + os.path.basename(archive_path))
+		self._archive_path = archive_path
+		self._dir_path = dir_path
+	def __call__(self):
+		self.set_text('Computing checksums...')
+		try:
+			differing, missing = compare_with_directory(
+				self._archive_path, self._dir_path, self.check_canceled
+			)
+		except (OSError, CalledProcessError):
+			self.show_alert(
+				'Could not read %s.' % os.path.basename(self._archive_path)
+			)
+			return
+		if not differing and not missing:
+			self.show_alert(
+				'All files in %s match the directory.' %
+				os.path.basename(self._archive_path)
+			)
+			return
+		message = ''
+		for heading, paths in (('Different', differing), ('Missing', missing)):
+			if paths:
+				message += '%s (%d):\n' % (heading, len(paths))
+				for path in paths[:self._MAX_NUM_PATHS_SHOWN]:
+					message += path + '\n'
+				if len(paths) > self._MAX_NUM_PATHS_SHOWN:
+					message += '...\n'
+				message += '\n'
+		self.show_alert(message.rstrip('\n'))
+
+class SearchArchives(DirectoryPaneCommand):
+
+	aliases = ('Search archives', 'Find files in archives')
+
+	def __call__(self):
+		scheme, dir_path = splitscheme(self.pane.get_path())
+		if scheme != 'file://':
+			show_alert(
+				'Sorry, searching archives is only supported for local '
+				'directories.'
+			)
+			return
+		name_pattern, ok = show_prompt(
+			'Search archives for files named (wildcards * and ? allowed):', '*'
+		)
+		if not name_pattern or not ok:
+			return
+		text, ok = show_prompt('Containing text (leave empty for any):')
+		if not ok:
+			return
+		search = _SearchArchives(dir_path, name_pattern, text)
+		submit_task(search)
+		# Show the matches while they are being found:
+		try:
+			result = show_quicksearch(search.get_items)
+		finally:
+			search.stop()
+		if result and result[1]:
+			url = result[1]
+			self.pane.set_path(
+				dirname(url), callback=lambda: self.pane.place_cursor_at(url)
+			)
+
+class _SearchArchives(Task):
+
+	_MAX_NUM_PATHS_SHOWN = 20
+
+	def __init__(self, dir_path, name_pattern, text):
+		super().__init__('Searching archives for ' + name_pattern)
+		self._dir_path = dir_path
+		self._name_pattern = name_pattern
+		self._text = text
+		# The search thread appends to this list. Other threads only read it:
+		self._matches = []
+		self._skipped = []
+		self._is_done = False
+		self._is_stopped = False
+	def __call__(self):
+		settings = load_json('Core Settings.json', default={})
+		suffixes = tuple(settings.get('archive_handlers', {}))
+		try:
+			for archive_path, path_in_archive in search_archives(
+				self._dir_path, suffixes, self._name_pattern, self._text,
+				self._check_stopped, on_error=self._on_error
+			):
+				scheme = _get_handler_for_archive(archive_path)
+				self._matches.append(
+					join(as_url(archive_path, scheme), path_in_archive)
+				)
+				self._update_text()
+		except _SearchStopped:
+			return
+		finally:
+			self._is_done = True
+		if self._skipped:
+			self._report_skipped()
+	def stop(self):
+		self._is_stopped = True
+	def get_items(self, query):
+		# fman asks for the items again whenever the query changes. Don't keep
+		# it waiting for matches that haven't been found yet. Our status text
+		# tells the user that the search is still running:
+		for url in self._matches[:]:
+			text = as_human_readable(url)
+			match = contains_chars(text.lower(), query.lower())
+			if match or not query:
+				yield QuicksearchItem(url, text, highlight=match)
+		if not self._is_done:
+			yield QuicksearchItem(
+				None, 'Still searching...', hint='Type to update the list'
+			)
+	def _on_error(self, archive_path, exc):
+		self._skipped.append(archive_path)
+		self._update_text()
+	def _update_text(self):
+		num_matches = len(self._matches)
+		text = 'Found %d match%s.' % \
+			   (num_matches, '' if num_matches == 1 else 'es')
+		if self._skipped:
+			num_skipped = len(self._skipped)
+			text += ' Could not read %d archive%s.' % \
+					(num_skipped, '' if num_skipped == 1 else 's')
+		self.set_text(text)
+	def _report_skipped(self):
+		paths = self._skipped[:self._MAX_NUM_PATHS_SHOWN]
+		if len(self._skipped) > len(paths):
+			paths.append('...')
+		self.show_alert(
+			'The following archives could not be searched. They may be '
+			'corrupt or encrypted:\n\n' + '\n'.join(paths)
+		)
+	def _check_stopped(self):
+		self.check_canceled()
+		if self._is_stopped:
+			# The user closed the list of matches.
+			raise _SearchStopped()
+
+class _SearchStopped(Exception):
+	pass
 
 class ArchiveOpenListener(DirectoryPaneListener):
 	def on_command(self, command_name, args):
@@ -1740,6 +2077,11 @@ class ArchiveOpenListener(DirectoryPaneListener):
 					new_args = dict(args)
 					new_args['url'] = new_scheme + path
 					return 'open_directory', new_args
+			elif command_name == 'open_file' and \
+				_get_handler_for_archive(basename(path)) == scheme:
+				# An archive inside an archive of the same type. Its file
+				# system lists the inner archive when asked to list the file:
+				return 'open_directory', args
 
 class Reload(DirectoryPaneCommand):
 
@@ -1,12 +1,24 @@
-from core.util import is_parent
+from concurrent.futures import Future, ThreadPoolExecutor
+from core.fs.zip import archive_transaction, combine_additions, \
+	combine_extractions
+from core.util import ParentChecker
 from fman import Task, YES, NO, YES_TO_ALL, NO_TO_ALL, ABORT, OK
 from fman.url import basename, join, dirname, splitscheme, relpath, \
 	as_human_readable
 from os.path import pardir
+from queue import Queue, Empty, Full
+from threading import Event, Lock, RLock, Thread
+from unicodedata import normalize
 
 import fman.fs
 
 class FileTreeOperation(Task):
+
+	_NUM_GATHER_THREADS = 8
+	_MAX_QUEUED_TASKS = 1000
+	_MIN_CONFLICTS_FOR_SUMMARY = 4
+	_MAX_CONFLICTS_SHOWN = 10
+
 	def __init__(
 		self, descr_verb, files, dest_dir, dest_name=None, fs=fman.fs
 	):
@@ -21,10 +33,15 @@ class FileTreeOperation(Task):
 		self._dest_name = dest_name
 		self._fs = fs
 		self._src_dir = dirname(files[0])
-		self._tasks = []
+		self._total_size = 0
+		self._size_lock = Lock()
+		self._alert_lock = RLock()
 		self._num_files = 0
 		self._cannot_move_to_self_shown = False
 		self._override_all = None
+		self._overwrite_older_only = False
+		self._dest_listings = {}
+		self._dest_listings_lock = Lock()
 		self._ignore_exceptions = False
 	def _transfer(self, src, dest):
 		raise NotImplementedError()
@@ -37,31 +54,163 @@ class FileTreeOperation(Task):
 	def _postprocess_directory(self, src_dir_path):
 		return None
 	def __call__(self):
+		# Start transferring files while we are still gathering them. The
+		# gathering happens in this thread, so the user is asked whether to
+		# overwrite a file before the task that overwrites it is enqueued. A
+		# separate thread executes the enqueued tasks. The queue between the
+		# two is bounded, so gathering can't run arbitrarily far ahead.
 		self.set_text('Gathering files...')
-		if not self._gather_files():
-			return
-		self.set_size(sum(task.get_size() for task in self._tasks))
-		for i, task in enumerate(self._iter(self._tasks)):
-			is_last = i == len(self._tasks) - 1
-			progress_before = self.get_progress()
+		self._queue = Queue(self._MAX_QUEUED_TASKS)
+		self._gathering_aborted = Event()
+		self._execution_ended = Event()
+		self._execution_error = None
+		runner = Thread(target=self._execute_tasks)
+		applying = False
+		try:
+			# Let 7-Zip delete and rename files in archives in one go. The
+			# other threads join the transaction, so they all see its pending
+			# changes. It is only applied when no error occurred. Otherwise,
+			# the user is told which archives were left unchanged:
+			with archive_transaction(self) as self._transaction:
+				runner.start()
+				gathered = False
+				try:
+					gathered = self._gather_files()
+				except _ExecutionEnded:
+					pass
+				finally:
+					if not gathered:
+						self._gathering_aborted.set()
+					self._put(_END_OF_TASKS, force=True)
+					runner.join()
+				if self._execution_error is not None:
+					raise self._execution_error
+				applying = True
+		except (OSError, IOError) as e:
+			if not applying:
+				raise
+			self._handle_exception(_get_error_message(self), True, e)
+	def _execute_tasks(self):
+		try:
 			try:
-				self.run(task)
+				with archive_transaction(join=self._transaction):
+					self._run_tasks()
 			except (OSError, IOError) as e:
-				title = task.get_title()
-				message = 'Error ' + (title[0].lower() + title[1:])
-				if not self._handle_exception(message, is_last, e):
-					break
-				self.set_progress(progress_before + task.get_size())
+				self._handle_exception(_get_error_message(self), True, e)
+		except BaseException as e:
+			self._execution_error = e
+		finally:
+			self._execution_ended.set()
+	def _run_tasks(self):
+		is_done = False
+		while not is_done:
+			batch, is_done = self._get_batch()
+			# Let 7-Zip add or extract consecutive files of the same archive in
+			# one go:
+			tasks = combine_extractions(combine_additions(batch))
+			self._add_to_size(
+				sum(task.get_size() for task in tasks) -
+				sum(task.get_size() for task in batch)
+			)
+			for i, task in enumerate(self._iter(tasks)):
+				if self._gathering_aborted.is_set():
+					return
+				is_last = is_done and i == len(tasks) - 1
+				progress_before = self.get_progress()
+				try:
+					self.run(task)
+				except (OSError, IOError) as e:
+					message = _get_error_message(task)
+					if not self._handle_exception(message, is_last, e):
+						return
+					self.set_progress(progress_before + task.get_size())
+	def _get_batch(self):
+		# Wait for the next task, then also take all others that are already
+		# available so consecutive tasks can be combined:
+		result = []
+		item = self._get_queued()
+		while item is not _END_OF_TASKS:
+			result.append(item)
+			if len(result) >= self._MAX_QUEUED_TASKS:
+				return result, False
+			try:
+				item = self._queue.get_nowait()
+			except Empty:
+				return result, False
+		return result, True
+	def _get_queued(self):
+		while True:
+			self.check_canceled()
+			try:
+				return self._queue.get(timeout=.1)
+			except Empty:
+				pass
+	def _put(self, item, force=False):
+		while True:
+			if self._execution_ended.is_set():
+				if force:
+					return
+				# The user aborted after an error. Stop gathering:
+				raise _ExecutionEnded()
+			if not force:
+				self.check_canceled()
+			try:
+				self._queue.put(item, timeout=.1)
+				return
+			except Full:
+				pass
+	def _add_to_size(self, delta):
+		with self._size_lock:
+			self._total_size += delta
+			self.set_size(self._total_size)
+	def show_alert(self, *args, **kwargs):
+		# The gathering and executing threads may both need to ask the user
+		# something. Show one question at a time:
+		with self._alert_lock:
+			return super().show_alert(*args, **kwargs)
 	def _gather_files(self):
 		dest_dir_url = self._get_dest_dir_url()
+		dest_dir_created = Event()
 		self._enqueue([Task(
-			'Preparing ' + basename(dest_dir_url), fn=self._fs.makedirs,
-			 args=(dest_dir_url,), kwargs={'exist_ok': True}
+			'Preparing ' + basename(dest_dir_url), fn=self._create_dest_dir,
+			args=(dest_dir_url, dest_dir_created)
 		)])
+		# Preparing a transfer may need the destination's parent directory.
+		# For example, LocalFileSystem.prepare_move(...) stats it. So wait
+		# until the destination directory was created:
+		while not dest_dir_created.wait(.1):
+			if self._execution_ended.is_set():
+				raise _ExecutionEnded()
+			self.check_canceled()
+		# Walking the source tree can take a long time, for instance on network
+		# drives. We therefore let a thread pool look at sibling subtrees
+		# concurrently. The results are consumed in the same order as a serial
+		# walk would produce them. This keeps the order of the tasks and of the
+		# questions we ask the user.
+		self._executor = ThreadPoolExecutor(self._NUM_GATHER_THREADS)
+		self._parent_checker = ParentChecker(self._fs)
+		self._gathering_stopped = Event()
+		try:
+			return self._gather_files_in_parallel()
+		finally:
+			self._gathering_stopped.set()
+			self._executor.shutdown()
+	def _create_dest_dir(self, dir_url, created):
+		try:
+			self._fs.makedirs(dir_url, exist_ok=True)
+		finally:
+			created.set()
+	def _gather_files_in_parallel(self):
+		probes = [
+			self._submit(self._probe, src, self._get_dest_url(src))
+			for src in self._files
+		]
+		if not self._resolve_conflicts(probes):
+			return False
 		for i, src in enumerate(self._iter(self._files)):
 			is_last = i == len(self._files) - 1
 			dest = self._get_dest_url(src)
-			if is_parent(src, dest, self._fs):
+			if self._parent_checker.is_parent(src, dest):
 				if src != dest:
 					try:
 						is_samefile = self._fs.samefile(src, dest)
@@ -76,7 +225,7 @@ class FileTreeOperation(Task):
 				)
 				return False
 			try:
-				is_dir = self._fs.is_dir(src)
+				is_dir, dest_exists, prepared = probes[i].result()
 			except OSError as e:
 				error_message = 'Could not %s %s' % \
 								(self._descr_verb, as_human_readable(src))
@@ -84,43 +233,55 @@ class FileTreeOperation(Task):
 					continue
 				return False
 			if is_dir:
-				if self._fs.exists(dest):
-					if not self._merge_directory(src):
+				if dest_exists:
+					if not self._merge_directory(src, prepared):
 						return False
 				else:
-					self._enqueue(self._prepare_transfer(src, dest))
+					self._enqueue(self._iter_prepared(prepared))
 			else:
-				if self._fs.exists(dest):
-					should_overwrite = self._should_overwrite(dest)
+				if dest_exists:
+					should_overwrite = self._should_overwrite(src, dest)
 					if should_overwrite == NO:
 						continue
 					elif should_overwrite == ABORT:
 						return False
 					else:
 						assert should_overwrite == YES, should_overwrite
-				self._enqueue(self._prepare_transfer(src, dest))
+					self._enqueue(self._prepare_transfer(src, dest))
+				else:
+					self._enqueue(self._iter_prepared(prepared))
 		return True
-	def _merge_directory(self, src):
-		for file_name in self._fs.iterdir(src):
-			file_url = join(src, file_name)
-			try:
-				src_is_dir = self._fs.is_dir(file_url)
-			except OSError:
-				src_is_dir = False
-			dst = self._get_dest_url(file_url)
+	def _probe(self, src, dest):
+		# Runs in a worker thread. Returns whether src is a directory, whether
+		# dest exists and what is pending for it: For directories that need to
+		# be merged, a _Job that lists their contents. Otherwise, unless the
+		# user first needs to be asked whether to overwrite dest, the prepared
+		# tasks returned by _submit_prepare(...).
+		if self._parent_checker.is_parent(src, dest):
+			# _gather_files_in_parallel() handles this case without us.
+			return None, None, None
+		is_dir = self._fs.is_dir(src)
+		dest_exists = self._dest_exists(dest)
+		if is_dir and dest_exists:
+			pending = self._submit_scan(src)
+		elif not dest_exists:
+			pending = self._submit_prepare(src, dest)
+		else:
+			pending = None
+		return is_dir, dest_exists, pending
+	def _merge_directory(self, src, scan=None):
+		if scan is None:
+			scan = self._submit_scan(src)
+		for file_url, src_is_dir, dst, dst_exists, pending in scan.result():
 			if src_is_dir:
-				try:
-					dst_is_dir = self._fs.is_dir(dst)
-				except OSError:
-					dst_is_dir = False
-				if dst_is_dir:
-					if not self._merge_directory(file_url):
+				if dst_exists:
+					if not self._merge_directory(file_url, pending):
 						return False
 				else:
-					self._enqueue(self._prepare_transfer(file_url, dst))
+					self._enqueue(self._iter_prepared(pending))
 			else:
-				if self._fs.exists(dst):
-					should_overwrite = self._should_overwrite(dst)
+				if dst_exists:
+					should_overwrite = self._should_overwrite(file_url, dst)
 					if should_overwrite == NO:
 						continue
 					elif should_overwrite == ABORT:
@@ -128,13 +289,184 @@ class FileTreeOperation(Task):
 					else:
 						assert should_overwrite == YES, \
 							should_overwrite
-				self._enqueue(self._prepare_transfer(file_url, dst))
+					self._enqueue(self._prepare_transfer(file_url, dst))
+				else:
+					self._enqueue(self._iter_prepared(pending))
 		if self._does_postprocess_directory():
 			# Post-process the parent directories bottom-up. For Move, this
 			# ensures that each directory is empty when post-processing.
 			self._enqueue([self._postprocess_directory(src)])
 		return True
-	def _should_overwrite(self, file_url):
+	def _submit_scan(self, src_dir):
+		return self._submit(self._scan_directory, src_dir)
+	def _scan_directory(self, src_dir):
+		# Runs in a worker thread. For each file in src_dir, returns its URL,
+		# whether it is a directory, its destination, whether the destination
+		# exists (for directories: whether it is a directory) and what is
+		# pending for it, like _probe(...).
+		result = []
+		for file_name in self._fs.iterdir(src_dir):
+			if self._gathering_stopped.is_set():
+				break
+			file_url = join(src_dir, file_name)
+			try:
+				src_is_dir = self._fs.is_dir(file_url)
+			except OSError:
+				src_is_dir = False
+			dst = self._get_dest_url(file_url)
+			if src_is_dir:
+				dst_exists = self._dest_is_dir(dst)
+				if dst_exists:
+					pending = self._submit_scan(file_url)
+				else:
+					pending = self._submit_prepare(file_url, dst)
+			else:
+				dst_exists = self._dest_exists(dst)
+				if dst_exists:
+					pending = None
+				else:
+					pending = self._submit_prepare(file_url, dst)
+			result.append((file_url, src_is_dir, dst, dst_exists, pending))
+		return result
+	def _submit_prepare(self, src, dest):
+		# Returns a queue that a worker fills with the tasks for transferring
+		# src to dest, along with the worker's _Job. Each task is passed on as
+		# soon as it was prepared. So we can start transferring a large
+		# directory before the worker has walked all of it. The queue is
+		# bounded, so the worker can't run arbitrarily far ahead.
+		tasks = Queue(self._MAX_QUEUED_TASKS)
+		job = self._submit(self._prepare_all, src, dest, tasks)
+		return src, dest, tasks, job
+	def _submit(self, fn, *args):
+		# Let the worker see the archive changes that are still pending:
+		def run_in_transaction():
+			with archive_transaction(join=self._transaction):
+				return fn(*args)
+		return _Job(self._executor.submit(run_in_transaction), fn, args)
+	def _prepare_all(self, src, dest, tasks):
+		# Runs in a worker thread. Ends with _END_OF_TASKS, or with the
+		# exception that occurred, which _iter_prepared(...) then raises.
+		try:
+			for task in self._prepare_transfer(src, dest):
+				if not self._put_prepared(tasks, task):
+					return
+		except BaseException as e:
+			self._put_prepared(tasks, e)
+		else:
+			self._put_prepared(tasks, _END_OF_TASKS)
+	def _put_prepared(self, tasks, item):
+		# Returns False if gathering stopped while we waited for room:
+		while not self._gathering_stopped.is_set():
+			try:
+				tasks.put(item, timeout=.1)
+				return True
+			except Full:
+				pass
+		return False
+	def _iter_prepared(self, prepared):
+		src, dest, tasks, job = prepared
+		if job.cancel():
+			# No worker has started yet. Don't wait for one to become free:
+			yield from self._prepare_transfer(src, dest)
+			return
+		while True:
+			try:
+				item = tasks.get(timeout=.1)
+			except Empty:
+				self.check_canceled()
+				continue
+			if item is _END_OF_TASKS:
+				return
+			if isinstance(item, BaseException):
+				raise item
+			yield item
+	def _resolve_conflicts(self, probes):
+		# Find the files that already exist in the destination. When there are
+		# many, ask the user once what to do with all of them instead of once
+		# per file. Returns False if the user aborted.
+		conflicts = []
+		for src, probe in zip(self._files, probes):
+			self.check_canceled()
+			try:
+				is_dir, dest_exists, pending = probe.result()
+			except OSError:
+				# _gather_files_in_parallel() reports this.
+				continue
+			if is_dir and dest_exists:
+				self._find_conflicts(pending, conflicts)
+			elif dest_exists:
+				conflicts.append(self._get_dest_url(src))
+		if len(conflicts) < self._MIN_CONFLICTS_FOR_SUMMARY:
+			return True
+		names = '\n'.join(
+			as_human_readable(url)
+			for url in conflicts[:self._MAX_CONFLICTS_SHOWN]
+		)
+		if len(conflicts) > self._MAX_CONFLICTS_SHOWN:
+			names += '\n...'
+		choice = self.show_alert(
+			'{:,} files already exist:\n\n{}\n\nDo you want to overwrite '
+			'all of them (Yes or Yes to All), skip all of them (No to All) or '
+			'choose which ones to overwrite (No)?'.format(len(conflicts), names),
+			YES | NO | YES_TO_ALL | NO_TO_ALL | ABORT, YES_TO_ALL
+		)
+		if choice & (YES | YES_TO_ALL):
+			self._override_all = True
+		elif choice & NO_TO_ALL:
+			self._override_all = False
+		elif choice & NO:
+			choice = self.show_alert(
+				'Do you want to overwrite only the files that are older than '
+				'the new ones (Yes) or decide for each file (No)?',
+				YES | NO | ABORT, YES
+			)
+			if choice & YES:
+				self._overwrite_older_only = True
+			elif not choice & NO:
+				assert choice & ABORT, choice
+				return False
+		else:
+			assert choice & ABORT, choice
+			return False
+		return True
+	def _find_conflicts(self, scan, conflicts):
+		for _, src_is_dir, dst, dst_exists, pending in scan.result():
+			self.check_canceled()
+			if src_is_dir and dst_exists:
+				self._find_conflicts(pending, conflicts)
+			elif dst_exists:
+				conflicts.append(dst)
+	def _dest_exists(self, url):
+		return self._may_exist_in_dest(url) and self._fs.exists(url)
+	def _dest_is_dir(self, url):
+		if not self._may_exist_in_dest(url):
+			return False
+		try:
+			return self._fs.is_dir(url)
+		except OSError:
+			return False
+	def _may_exist_in_dest(self, url):
+		# Checking each destination file individually takes one round trip
+		# per file, which is slow eg. on network drives. So we list each
+		# destination directory once. Names are compared case-insensitively,
+		# to be safe on case-insensitive file systems. A match is therefore
+		# only a candidate the caller still needs to confirm.
+		dir_url = dirname(url)
+		with self._dest_listings_lock:
+			names = self._dest_listings.get(dir_url)
+		if names is None:
+			try:
+				names = {
+					_normalize_name(name) for name in self._fs.iterdir(dir_url)
+				}
+			except OSError:
+				names = set()
+			with self._dest_listings_lock:
+				self._dest_listings[dir_url] = names
+		return _normalize_name(basename(url)) in names
+	def _should_overwrite(self, src, file_url):
+		if self._overwrite_older_only:
+			return YES if self._is_newer(src, file_url) else NO
 		if self._override_all is None:
 			choice = self.show_alert(
 				"%s exists. Do you want to overwrite it?" % basename(file_url),
@@ -152,6 +484,15 @@ class FileTreeOperation(Task):
 				assert choice & ABORT, choice
 				return ABORT
 		return YES if self._override_all else NO
+	def _is_newer(self, src, dest):
+		try:
+			src_mtime = self._fs.query(src, 'modified_datetime')
+			dest_mtime = self._fs.query(dest, 'modified_datetime')
+		except OSError:
+			return False
+		if src_mtime is None or dest_mtime is None:
+			return False
+		return src_mtime > dest_mtime
 	def _enqueue(self, tasks):
 		for task in self._iter(tasks):
 			if task.get_size() > 0:
@@ -160,7 +501,8 @@ class FileTreeOperation(Task):
 					'Preparing to {} {:,} files.'
 						.format(self._descr_verb, self._num_files)
 				)
-			self._tasks.append(task)
+			self._add_to_size(task.get_size())
+			self._put(task)
 	def _handle_exception(self, message, is_last, exc):
 		if self._ignore_exceptions:
 			return True
@@ -266,4 +608,40 @@ class MoveFiles(FileTreeOperation):
 			next(iter(self._fs.iterdir(dir_url)))
 		except StopIteration:
 			return True
-		return False
\ No newline at end of file
+		return False
+
+def _get_error_message(task):
+	title = task.get_title()
+	return 'Error ' + (title[0].lower() + title[1:])
+
+def _normalize_name(name):
+	return normalize('NFC', name).casefold()
+
+_END_OF_TASKS = object()
+
+class _Job:
+	"""
+	The result of fn(*args), which a thread pool computes. If no worker has
+	started on it yet when the result is needed, it is computed in the calling
+	thread instead. The workers may all be waiting for the caller to consume
+	their output, so waiting for one to become free could block forever.
+	"""
+	def __init__(self, future, fn, args):
+		self._future = future
+		self._fn = fn
+		self._args = args
+	def cancel(self):
+		return self._future.cancel()
+	def result(self):
+		if self._future.cancel():
+			self._future = Future()
+			try:
+				result = self._fn(*self._args)
+			except BaseException as e:
+				self._future.set_exception(e)
+			else:
+				self._future.set_result(result)
+		return self._future.result()
+
+class _ExecutionEnded(Exception):
+	pass
\ No newline at end of file
@@ -1,2 +1,3 @@
 from .local import *
-from .zip import *
\ No newline at end of file
+from .zip import *
+from .compressed_tar import *
\ No newline at end of file
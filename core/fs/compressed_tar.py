@@ -0,0 +1,368 @@
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from core.fs.zip import _7ZipFileSystem, _FileInfo, _basename, \
+	_create_temp_dir_next_to
+from core.util import filenotfounderror
+from datetime import datetime
+from fman import Task
+from fman.url import splitscheme, as_url, as_human_readable, join
+from io import RawIOBase, BufferedReader, UnsupportedOperation
+from threading import Lock
+
+import bz2
+import errno
+import lzma
+import os
+import tarfile
+import zlib
+
+__all__ = ['CompressedTarFileSystem']
+
+class CompressedTarFileSystem(_7ZipFileSystem):
+	"""
+	Browses .tar.gz, .tar.bz2 and .tar.xz archives. 7-Zip only sees the single
+	.tar file inside them. We therefore list and extract them with Python's
+	tarfile module, via a TarIndex. These archives are read-only.
+	"""
+
+	scheme = 'ctar://'
+
+	_MAX_NUM_INDEXES = 16
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._indexes = OrderedDict()
+		self._indexes_lock = Lock()
+	def prepare_copy(self, src_url, dst_url):
+		src_scheme, src_path = splitscheme(src_url)
+		if src_scheme != self.scheme or splitscheme(dst_url)[0] != 'file://':
+			raise _read_only_error()
+		tar_path, path_in_tar = self._split(src_path)
+		dst_ospath = as_human_readable(dst_url)
+		return [ExtractFromCompressedTar(
+			self, self._fs, tar_path, path_in_tar, dst_ospath
+		)]
+	def prepare_move(self, src_url, dst_url):
+		raise _read_only_error()
+	def mkdir(self, path):
+		raise _read_only_error()
+	def delete(self, path):
+		raise _read_only_error()
+	def prepare_delete(self, path):
+		raise _read_only_error()
+	def _iter_archive_infos(self, zip_path, path_in_zip, recursive=False):
+		# The index is in memory, so there is no point in limiting the depth:
+		yield from self._get_index(zip_path).iter_infos(path_in_zip)
+	def _open_member(self, local_path, path_in_zip):
+		return self._load_index(local_path).open(path_in_zip)
+	def _get_index(self, tar_path):
+		return self._load_index(self._get_local_path(tar_path))
+	def _load_index(self, local_path):
+		stat = os.stat(local_path)
+		fingerprint = (stat.st_size, stat.st_mtime_ns)
+		with self._indexes_lock:
+			try:
+				cached_fingerprint, result = self._indexes[local_path]
+			except KeyError:
+				pass
+			else:
+				if cached_fingerprint == fingerprint:
+					self._indexes.move_to_end(local_path)
+					return result
+		# Don't hold the lock while indexing. This can take a long time and
+		# should not block access to other archives:
+		result = TarIndex(local_path)
+		with self._indexes_lock:
+			self._indexes[local_path] = (fingerprint, result)
+			self._indexes.move_to_end(local_path)
+			while len(self._indexes) > self._MAX_NUM_INDEXES:
+				self._indexes.popitem(last=False)
+		return result
+
+def _read_only_error():
+	return UnsupportedOperation(
+		'Modifying compressed tar archives is not supported.'
+	)
+
+class ExtractFromCompressedTar(Task):
+	def __init__(self, tar_fs, fman_fs, tar_path, path_in_tar, dst_ospath):
+		super().__init__('Extracting ' + _basename(tar_path, path_in_tar))
+		self._tar_fs = tar_fs
+		self._fman_fs = fman_fs
+		self._tar_path = tar_path
+		self._path_in_tar = path_in_tar
+		self._dst_ospath = dst_ospath
+	def __call__(self):
+		index = self._tar_fs._get_index(self._tar_path)
+		# Create temp dir next to dst_path to ensure moving the extracted
+		# files is cheap because they are on the same file system:
+		tmp_dir = _create_temp_dir_next_to(self._dst_ospath)
+		try:
+			index.extract(self._path_in_tar, tmp_dir.name, self.check_canceled)
+			# Use fman.fs.move(...) so fman's file:// caches are notified of the
+			# new file:
+			self._fman_fs.move(
+				join(as_url(tmp_dir.name), self._path_in_tar),
+				as_url(self._dst_ospath)
+			)
+		finally:
+			try:
+				tmp_dir.cleanup()
+			except FileNotFoundError:
+				# This happens when path_in_tar = ''
+				pass
+
+_CHECKPOINT_INTERVAL_BYTES = 32 * 1024 * 1024
+
+class TarIndex:
+	"""
+	Lists the members of a compressed tar archive in a single decompression
+	pass. For gzip, it also saves the decompressor's state every
+	`checkpoint_interval` bytes of uncompressed data. Reading a member near the
+	end of a large archive then only needs to decompress the data after the
+	closest checkpoint, instead of everything before the member. The bzip2 and
+	xz decompressors in Python's standard library can't be copied, so for
+	those formats, reads always start at the beginning of the archive.
+	"""
+	def __init__(self, path, checkpoint_interval=_CHECKPOINT_INTERVAL_BYTES):
+		self._path = path
+		self._format = _detect_format(path)
+		if self._format is None:
+			# We can seek directly, so we don't need checkpoints:
+			checkpoint_interval = None
+		members = {}
+		reader = _DecompressingReader(path, self._format, checkpoint_interval)
+		with reader, tarfile.open(fileobj=reader, mode='r|') as tar_file:
+			for tar_info in tar_file:
+				path_in_tar = _normalize(tar_info.name)
+				if path_in_tar:
+					# Later members replace earlier ones with the same name:
+					members[path_in_tar] = _Member.from_tar_info(
+						path_in_tar, tar_info
+					)
+		self._paths = sorted(members)
+		self._members = [members[path] for path in self._paths]
+		self._checkpoints = reader.checkpoints
+		self._checkpoint_offsets = [c[0] for c in self._checkpoints]
+	def iter_infos(self, path_in_tar=''):
+		"""
+		Yield the info of `path_in_tar` itself, if it has an entry, followed by
+		the infos of all files and directories below it.
+		"""
+		for member in self._iter_members(path_in_tar):
+			yield member.info
+	def open(self, path_in_tar):
+		member = self._get_member(path_in_tar)
+		if member.info.is_dir:
+			raise IsADirectoryError(
+				errno.EISDIR, os.strerror(errno.EISDIR), path_in_tar
+			)
+		reader = self._open_at(member.offset_data)
+		return BufferedReader(_LimitedReader(reader, member.info.size_bytes))
+	def extract(self, path_in_tar, dst_dir, check_canceled=None):
+		"""
+		Extract `path_in_tar` and everything below it to `dst_dir`. Files keep
+		their path in the archive, relative to `dst_dir`.
+		"""
+		members = list(self._iter_members(path_in_tar))
+		if not members:
+			raise filenotfounderror(path_in_tar)
+		wanted = set(member.info.path for member in members)
+		start = min(member.offset for member in members)
+		end = max(member.offset for member in members)
+		with self._open_at(start) as reader, \
+			tarfile.open(fileobj=reader, mode='r|') as tar_file:
+			for tar_info in tar_file:
+				if check_canceled:
+					check_canceled()
+				# Offsets in the stream are relative to where it started:
+				if start + tar_info.offset > end:
+					break
+				if _normalize(tar_info.name) in wanted:
+					tar_file.extract(tar_info, dst_dir, **_EXTRACT_KWARGS)
+	def _iter_members(self, path_in_tar):
+		if path_in_tar:
+			i = bisect_left(self._paths, path_in_tar)
+			if i < len(self._paths) and self._paths[i] == path_in_tar:
+				yield self._members[i]
+			prefix = path_in_tar + '/'
+		else:
+			prefix = ''
+		# Paths with the same prefix are adjacent in the sorted list:
+		i = bisect_left(self._paths, prefix)
+		while i < len(self._paths) and self._paths[i].startswith(prefix):
+			yield self._members[i]
+			i += 1
+	def _get_member(self, path_in_tar):
+		i = bisect_left(self._paths, path_in_tar)
+		if i == len(self._paths) or self._paths[i] != path_in_tar:
+			raise filenotfounderror(path_in_tar)
+		return self._members[i]
+	def _open_at(self, offset):
+		if self._format is None:
+			# Uncompressed: We can seek directly.
+			checkpoint = (offset, offset, _NoDecompressor())
+		else:
+			i = bisect_right(self._checkpoint_offsets, offset)
+			checkpoint = self._checkpoints[i - 1] if i else None
+		result = _DecompressingReader(
+			self._path, self._format, checkpoint=checkpoint
+		)
+		try:
+			result.skip(offset - result.tell())
+		except BaseException:
+			result.close()
+			raise
+		return result
+
+# Prevent path traversal and other dangerous members where Python supports it:
+_EXTRACT_KWARGS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+class _Member:
+	def __init__(self, info, offset, offset_data):
+		self.info = info
+		# Where the member's header(s) and data start in the uncompressed tar:
+		self.offset = offset
+		self.offset_data = offset_data
+	@classmethod
+	def from_tar_info(cls, path_in_tar, tar_info):
+		is_dir = tar_info.isdir()
+		info = _FileInfo(
+			path_in_tar, is_dir, None if is_dir else tar_info.size,
+			datetime.fromtimestamp(tar_info.mtime), tar_info.mode, None
+		)
+		return cls(info, tar_info.offset, tar_info.offset_data)
+
+def _normalize(name):
+	while name.startswith('./'):
+		name = name[2:]
+	return '' if name == '.' else name.strip('/')
+
+def _detect_format(path):
+	with open(path, 'rb') as f:
+		magic = f.read(6)
+	for format_, format_magic in _MAGIC_NUMBERS.items():
+		if magic.startswith(format_magic):
+			return format_
+	# Some .tgz files are not actually compressed. Read them as they are:
+	return None
+
+_MAGIC_NUMBERS = {
+	'gz': b'\x1f\x8b', 'bz2': b'BZh', 'xz': b'\xfd7zXZ\x00'
+}
+
+_DECOMPRESSORS = {
+	# 16 makes zlib expect a gzip header:
+	'gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+	'bz2': bz2.BZ2Decompressor,
+	'xz': lzma.LZMADecompressor
+}
+
+class _NoDecompressor:
+	eof = False
+	unused_data = b''
+	def decompress(self, data):
+		return data
+	def copy(self):
+		return self
+
+class _DecompressingReader(RawIOBase):
+	"""
+	Reads the decompressed data of a file. A checkpoint is a tuple (offset in
+	the decompressed data, offset in the file, decompressor). If
+	`checkpoint_interval` is given and the decompressor supports it,
+	checkpoints are recorded in `self.checkpoints` while reading.
+	"""
+
+	_CHUNK_SIZE = 64 * 1024
+
+	def __init__(
+		self, path, format_, checkpoint_interval=None, checkpoint=None
+	):
+		super().__init__()
+		self._file = open(path, 'rb')
+		self._format = format_
+		if checkpoint:
+			self._pos, file_offset, decompressor = checkpoint
+			self._file.seek(file_offset)
+			# Copy the decompressor so the checkpoint can be used again:
+			self._decompressor = decompressor.copy()
+		else:
+			self._pos = 0
+			self._decompressor = self._new_decompressor()
+		self._buffer = memoryview(b'')
+		self._checkpoint_interval = checkpoint_interval
+		if checkpoint_interval:
+			self._next_checkpoint = self._pos + checkpoint_interval
+		self.checkpoints = []
+	def readable(self):
+		return True
+	def tell(self):
+		return self._pos - len(self._buffer)
+	def readinto(self, b):
+		while not self._buffer:
+			if not self._decompress_chunk():
+				return 0
+		result = min(len(b), len(self._buffer))
+		b[:result] = self._buffer[:result]
+		self._buffer = self._buffer[result:]
+		return result
+	def skip(self, num_bytes):
+		while num_bytes > 0:
+			if not self._buffer and not self._decompress_chunk():
+				raise EOFError('Unexpected end of archive')
+			step = min(num_bytes, len(self._buffer))
+			self._buffer = self._buffer[step:]
+			num_bytes -= step
+	def close(self):
+		try:
+			self._file.close()
+		finally:
+			super().close()
+	def _decompress_chunk(self):
+		data = self._file.read(self._CHUNK_SIZE)
+		if not data:
+			return False
+		if self._decompressor.eof:
+			self._decompressor = self._new_decompressor()
+		output = self._decompressor.decompress(data)
+		# Files can consist of several concatenated compressed streams. This is
+		# for instance the case for archives created by pigz or pbzip2:
+		while self._decompressor.eof and self._decompressor.unused_data:
+			data = self._decompressor.unused_data
+			self._decompressor = self._new_decompressor()
+			output += self._decompressor.decompress(data)
+		self._buffer = memoryview(output)
+		self._pos += len(output)
+		if self._checkpoint_interval and self._pos >= self._next_checkpoint:
+			copy = getattr(self._decompressor, 'copy', None)
+			if copy:
+				self.checkpoints.append((self._pos, self._file.tell(), copy()))
+			self._next_checkpoint = self._pos + self._checkpoint_interval
+		return True
+	def _new_decompressor(self):
+		if self._format is None:
+			return _NoDecompressor()
+		return _DECOMPRESSORS[self._format]()
+
+class _LimitedReader(RawIOBase):
+	def __init__(self, source, size):
+		super().__init__()
+		self._source = source
+		self._remaining = size
+	def readable(self):
+		return True
+	def readinto(self, b):
+		if self._remaining <= 0:
+			return 0
+		view = memoryview(b)[:self._remaining]
+		result = self._source.readinto(view)
+		if not result:
+			raise EOFError('Unexpected end of archive')
+		self._remaining -= result
+		return result
+	def close(self):
+		try:
+			self._source.close()
+		finally:
+			super().close()
\ No newline at end of file
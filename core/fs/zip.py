@@ -1,22 +1,38 @@
-from collections import namedtuple, deque
+from codecs import getincrementaldecoder
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import copy
 from core.os_ import is_arch, is_mac
-from core.util import filenotfounderror
+from core.util import filenotfounderror, format_size, format_duration
 from datetime import datetime
 from fman import PLATFORM, load_json, Task
 from fman.fs import FileSystem
 from fman.url import as_url, splitscheme, as_human_readable, basename
-from io import UnsupportedOperation, FileIO, BufferedReader, TextIOWrapper
+from heapq import heappop, heappush
+from io import UnsupportedOperation, FileIO, BufferedReader, TextIOWrapper, \
+	RawIOBase
+from itertools import chain
 from os.path import join, dirname
 from pathlib import PurePosixPath, Path
 from subprocess import Popen, PIPE, DEVNULL, CalledProcessError
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp, mkstemp
+from threading import Lock, RLock, local
+from time import time
+from zipfile import ZipFile, BadZipFile, is_zipfile, ZIP_STORED, ZIP_DEFLATED, \
+	ZIP_BZIP2, ZIP_LZMA
 
+import errno
 import fman.fs
 import os
 import os.path
 import re
+import shutil
 import signal
+import struct
+import tarfile
 import sys
+import zlib
 
 # Prevent 'Rename' below from accidentally overwriting core.Rename:
 __all__ = ['ZipFileSystem', 'SevenZipFileSystem', 'TarFileSystem']
@@ -33,12 +49,22 @@ else:
 		_7ZIP_BINARY += '.exe'
 
 class _7ZipFileSystem(FileSystem):
-	def __init__(self, fs=fman.fs, suffixes=None):
+	def __init__(self, fs=fman.fs, suffixes=None, compression_args=None):
 		if suffixes is None:
 			suffixes = self._load_suffixes_from_json()
+		if compression_args is None:
+			compression_args = self._load_compression_args_from_json()
 		super().__init__()
 		self._fs = fs
 		self._suffixes = suffixes
+		self._compression_args = compression_args
+		# Archives inside archives, eg. a.zip/b.zip. Maps the path of the inner
+		# archive to (path of outer archive, path of inner archive in outer):
+		self._nested_archives = {}
+		# Maps the path of a nested archive to (fingerprint, local copy):
+		self._nested_copies = {}
+		self._nested_copies_dir = None
+		self._nested_copies_lock = Lock()
 	def _load_suffixes_from_json(self):
 		settings = load_json('Core Settings.json', default={})
 		archive_handlers = settings.get('archive_handlers', {})
@@ -46,6 +72,18 @@ class _7ZipFileSystem(FileSystem):
 			suffix for suffix, scheme in archive_handlers.items()
 			if scheme == self.scheme
 		)
+	def _load_compression_args_from_json(self):
+		settings = load_json('Core Settings.json', default={})
+		profile = settings.get('compression_profile', 'balanced')
+		try:
+			result = settings['compression_profiles'][profile][self.scheme]
+		except (KeyError, TypeError):
+			return []
+		if not isinstance(result, list) or \
+			not all(isinstance(arg, str) for arg in result):
+			# Malformed Core Settings.json
+			return []
+		return result
 	def get_default_columns(self, path):
 		return 'core.Name', 'core.Size', 'core.Modified'
 	def resolve(self, path):
@@ -56,9 +94,10 @@ class _7ZipFileSystem(FileSystem):
 				return super().resolve(path)
 		return self._fs.resolve(as_url(path))
 	def iterdir(self, path):
-		path_in_zip = self._split(path)[1]
+		# Listing an archive inside an archive lists the inner archive:
+		path_in_zip = self._split(path, into_nested=True)[1]
 		already_yielded = set()
-		for file_info in self._iter_infos(path):
+		for file_info in self._iter_infos(path, into_nested=True):
 			candidate = file_info.path
 			while candidate:
 				candidate_path = PurePosixPath(candidate)
@@ -74,7 +113,7 @@ class _7ZipFileSystem(FileSystem):
 	def is_dir(self, existing_path):
 		zip_path, path_in_zip = self._split(existing_path)
 		if not path_in_zip:
-			if Path(zip_path).exists():
+			if self._archive_exists(zip_path):
 				return True
 			raise filenotfounderror(existing_path)
 		result = self._query_info_attr(existing_path, 'is_dir', True)
@@ -87,7 +126,7 @@ class _7ZipFileSystem(FileSystem):
 		except FileNotFoundError:
 			return False
 		if not path_in_zip:
-			return Path(zip_path).exists()
+			return self._archive_exists(zip_path)
 		try:
 			next(iter(self._iter_infos(path)))
 		except (StopIteration, FileNotFoundError):
@@ -102,9 +141,12 @@ class _7ZipFileSystem(FileSystem):
 		if src_scheme == self.scheme and dst_scheme == 'file://':
 			zip_path, path_in_zip = self._split(src_path)
 			dst_ospath = as_human_readable(dst_url)
-			return [Extract(self._fs, zip_path, path_in_zip, dst_ospath)]
+			return [
+				Extract(self, self._fs, zip_path, path_in_zip, dst_ospath)
+			]
 		elif src_scheme == 'file://' and dst_scheme == self.scheme:
 			zip_path, path_in_zip = self._split(dst_path)
+			self._raise_if_nested(zip_path)
 			src_ospath = as_human_readable(src_url)
 			return [
 				AddToArchive(self, self._fs, src_ospath, zip_path, path_in_zip)
@@ -114,6 +156,7 @@ class _7ZipFileSystem(FileSystem):
 			assert src_scheme == self.scheme
 			src_zip_path, path_in_src_zip = self._split(src_path)
 			dst_zip_path, path_in_dst_zip = self._split(dst_path)
+			self._raise_if_nested(dst_zip_path)
 			return [CopyBetweenArchives(
 				self, self._fs, src_zip_path, path_in_src_zip, dst_zip_path,
 				path_in_dst_zip
@@ -131,11 +174,15 @@ class _7ZipFileSystem(FileSystem):
 			assert src_scheme == self.scheme
 			src_zip, src_pth_in_zip = self._split(src_path)
 			dst_zip, dst_pth_in_zip = self._split(dst_path)
+			self._raise_if_nested(src_zip)
+			self._raise_if_nested(dst_zip)
 			if src_zip == dst_zip:
 				return [Rename(self, src_zip, src_pth_in_zip, dst_pth_in_zip)]
 			else:
 				return [MoveBetweenArchives(self, src_url, dst_url)]
 		else:
+			if src_scheme == self.scheme:
+				self._raise_if_nested(self._split(src_path)[0])
 			result = list(self.prepare_copy(src_url, dst_url))
 			title = 'Cleaning up ' + basename(src_url)
 			result.append(Task(title, fn=self._fs.delete, args=(src_url,)))
@@ -144,6 +191,7 @@ class _7ZipFileSystem(FileSystem):
 		if self.exists(path):
 			raise FileExistsError(path)
 		zip_path, path_in_zip = self._split(path)
+		self._raise_if_nested(zip_path)
 		if not path_in_zip:
 			self._create_empty_archive(zip_path)
 		elif not self.exists(str(PurePosixPath(path).parent)):
@@ -164,14 +212,27 @@ class _7ZipFileSystem(FileSystem):
 		if not self.exists(path):
 			raise filenotfounderror(path)
 		zip_path, path_in_zip = self._split(path)
-		with self._preserve_empty_parent(zip_path, path_in_zip):
-			_run_7zip(['d', zip_path, path_in_zip])
-		self.notify_file_removed(path)
+		self._raise_if_nested(zip_path)
+		self._change_archive(zip_path, 'd', (path_in_zip,))
 	def prepare_delete(self, path):
 		return [Task(
 			'Deleting ' + path.rsplit('/', 1)[-1],
 			fn=self.delete, args=(path,), size=1
 		)]
+	def open_read(self, path):
+		"""
+		Return a binary file-like object for reading the given file in the
+		archive. This lets callers peek at a file without extracting it to
+		disk. The caller is responsible for closing the returned object.
+		"""
+		zip_path, path_in_zip = self._split(path)
+		if not path_in_zip or self.is_dir(path):
+			raise IsADirectoryError(
+				errno.EISDIR, os.strerror(errno.EISDIR), self.scheme + path
+			)
+		self._flush_changes(zip_path, path_in_zip)
+		local_path = self._get_local_path(zip_path)
+		return self._open_member(local_path, path_in_zip)
 	def size_bytes(self, path):
 		return self._query_info_attr(path, 'size_bytes', None)
 	def modified_datetime(self, path):
@@ -186,40 +247,156 @@ class _7ZipFileSystem(FileSystem):
 					return getattr(info, attr)
 				return folder_default
 		return self.cache.query(path, attr, compute_value)
-	def _preserve_empty_parent(self, zip_path, path_in_zip):
+	def _change_archive(self, zip_path, command, args, task=None):
+		# Apply the change now, or when the current archive_transaction()
+		# ends:
+		transaction = getattr(_transaction, 'current', None)
+		if transaction is None:
+			changes = _ArchiveChanges(self, zip_path)
+			changes.add(command, args)
+			changes.apply(task)
+		else:
+			transaction.add(self, zip_path, command, args)
+	def _flush_changes(self, zip_path, path_in_zip=None):
+		# Apply pending changes before we read or write files they affect.
+		# path_in_zip=None means the entire archive.
+		transaction = getattr(_transaction, 'current', None)
+		if transaction is not None:
+			transaction.flush(self, zip_path, path_in_zip)
+	def _preserve_empty_parents(self, zip_path, paths_in_zip):
 		# 7-Zip deletes empty directories that remain after an operation. For
 		# instance, when deleting the last file from a directory, or when moving
 		# it out of the directory. We don't want this to happen. The present
-		# method allows us to preserve the parent directory, even if empty:
-		parent = str(PurePosixPath(path_in_zip).parent)
-		parent_fullpath = zip_path + '/' + parent
+		# method allows us to preserve the parent directories, even if empty:
+		parents = []
+		for path_in_zip in paths_in_zip:
+			parent = str(PurePosixPath(path_in_zip).parent)
+			if parent == '.' or parent in parents:
+				continue
+			if any(_is_in(parent, path) for path in paths_in_zip):
+				# The parent is itself affected by the operation.
+				continue
+			parents.append(parent)
 		class CM:
 			def __enter__(cm):
-				if parent != '.':
-					cm._parent_wasdir_before = self.is_dir(parent_fullpath)
-				else:
-					cm._parent_wasdir_before = False
+				cm._parents_wasdir_before = [
+					parent for parent in parents
+					if self.is_dir(zip_path + '/' + parent)
+				]
 			def __exit__(cm, exc_type, exc_val, exc_tb):
 				if not exc_val:
-					if cm._parent_wasdir_before:
+					for parent in cm._parents_wasdir_before:
+						parent_fullpath = zip_path + '/' + parent
 						if not self.exists(parent_fullpath):
 							self.makedirs(parent_fullpath)
 		return CM()
-	def _split(self, path):
-		for suffix in self._suffixes:
-			try:
-				split_point = path.lower().index(suffix) + len(suffix)
-			except ValueError as suffix_not_found:
+	def _split(self, path, into_nested=False):
+		parts = path.split('/')
+		for i, part in enumerate(parts):
+			if self._is_archive_name(part):
+				zip_path = '/'.join(parts[:i + 1])
+				path_in_zip = '/'.join(parts[i + 1:]).lstrip('/')
+				return self._split_nested(zip_path, path_in_zip, into_nested)
+		raise filenotfounderror(self.scheme + path) from None
+	def _split_nested(self, zip_path, path_in_zip, into_nested=False):
+		# Consider a.zip/b.zip/c.txt. If b.zip is a file in a.zip, then we
+		# want to split into a.zip/b.zip and c.txt. But a.zip/b.zip itself is
+		# a file in a.zip, which can for instance be deleted or extracted as a
+		# whole. Only `into_nested` makes it the root of the inner archive.
+		parts = path_in_zip.split('/') if path_in_zip else []
+		for i, part in enumerate(parts):
+			if not self._is_archive_name(part):
 				continue
+			if i == len(parts) - 1 and not into_nested:
+				break
+			path_in_outer = '/'.join(parts[:i + 1])
+			if self._is_nested_archive(zip_path, path_in_outer):
+				nested_path = zip_path + '/' + path_in_outer
+				self._nested_archives[nested_path] = (zip_path, path_in_outer)
+				return self._split_nested(
+					nested_path, '/'.join(parts[i + 1:]), into_nested
+				)
+		return zip_path, path_in_zip
+	def _is_archive_name(self, name):
+		name = name.lower()
+		return any(name.endswith(suffix) for suffix in self._suffixes)
+	def _is_nested_archive(self, zip_path, path_in_zip):
+		def compute_value():
+			try:
+				for info in self._iter_archive_infos(zip_path, path_in_zip):
+					return info.path == path_in_zip and not info.is_dir
+			except FileNotFoundError:
+				pass
+			return False
+		return self.cache.query(
+			zip_path + '/' + path_in_zip, 'is_nested_archive', compute_value
+		)
+	def _archive_exists(self, zip_path):
+		# Nested archives were already found to exist by _split(...):
+		return zip_path in self._nested_archives or Path(zip_path).exists()
+	def _raise_if_nested(self, zip_path):
+		if zip_path in self._nested_archives:
+			raise UnsupportedOperation(
+				'Modifying archives inside other archives is not supported.'
+			)
+	def _get_local_path(self, zip_path):
+		# 7-Zip can only read archives from disk. We therefore extract nested
+		# archives. To avoid doing this on every access, we keep the copy until
+		# the outer archive changes.
+		try:
+			outer_path, path_in_outer = self._nested_archives[zip_path]
+		except KeyError:
+			return zip_path
+		outer_local_path = self._get_local_path(outer_path)
+		stat = os.stat(outer_local_path)
+		fingerprint = (outer_local_path, stat.st_size, stat.st_mtime_ns)
+		with self._nested_copies_lock:
+			try:
+				cached_fingerprint, result = self._nested_copies[zip_path]
+			except KeyError:
+				pass
 			else:
-				return path[:split_point], path[split_point:].lstrip('/')
-		raise filenotfounderror(self.scheme + path) from None
-	def _iter_infos(self, path):
-		zip_path, path_in_zip = self._split(path)
-		self._raise_filenotfounderror_if_not_exists(zip_path)
-		args = ['l', '-ba', '-slt', zip_path]
+				if cached_fingerprint == fingerprint and os.path.exists(result):
+					return result
+				shutil.rmtree(os.path.dirname(result), ignore_errors=True)
+			result = self._extract_nested(outer_local_path, path_in_outer)
+			self._nested_copies[zip_path] = (fingerprint, result)
+			return result
+	def _extract_nested(self, outer_local_path, path_in_outer):
+		if self._nested_copies_dir is None:
+			self._nested_copies_dir = TemporaryDirectory(prefix='fman-')
+		dst_dir = mkdtemp(dir=self._nested_copies_dir.name)
+		result = join(dst_dir, PurePosixPath(path_in_outer).name)
+		try:
+			with self._open_member(outer_local_path, path_in_outer) as src:
+				with open(result, 'wb') as f:
+					shutil.copyfileobj(src, f)
+		except BaseException:
+			shutil.rmtree(dst_dir, ignore_errors=True)
+			raise
+		return result
+	def _iter_infos(self, path, into_nested=False):
+		zip_path, path_in_zip = self._split(path, into_nested)
+		found = False
+		for file_info in self._iter_archive_infos(zip_path, path_in_zip):
+			found = True
+			self._put_in_cache(zip_path, file_info)
+			yield file_info
+		if path_in_zip and not found:
+			raise filenotfounderror(self.scheme + path)
+	def _iter_archive_infos(self, zip_path, path_in_zip, recursive=False):
+		self._flush_changes(zip_path, path_in_zip)
+		local_path = self._get_local_path(zip_path)
+		self._raise_filenotfounderror_if_not_exists(local_path)
+		args = ['l', '-ba', '-slt', local_path]
 		if path_in_zip:
 			args.append(path_in_zip)
+		if not recursive:
+			self._exclude_grandchildren(args, path_in_zip)
+		yield from _iter_infos(args)
+	def _open_member(self, local_path, path_in_zip):
+		return BufferedReader(_7zipReader(local_path, path_in_zip))
+	def _exclude_grandchildren(self, args, path_in_zip):
 		# We can hugely improve performance by making 7-Zip exclude children of
 		# the given directory. Unfortunately, this has a drawback: If you have
 		# a/b.txt in an archive but no separate entry for a/, then excluding */*
@@ -227,42 +404,46 @@ class _7ZipFileSystem(FileSystem):
 		# that contain at least one subdirectory with a file.
 		exclude = (path_in_zip + '/' if path_in_zip else '') + '*/*/*/*'
 		args.append('-x!' + exclude)
-		with _7zip(args, kill=True) as process:
-			stdout_lines = process.stdout_lines
-			file_info = self._read_file_info(stdout_lines)
-			if path_in_zip and not file_info:
-				raise filenotfounderror(self.scheme + path)
-			while file_info:
-				self._put_in_cache(zip_path, file_info)
-				yield file_info
-				file_info = self._read_file_info(stdout_lines)
+	def _get_tree_sizes(self, zip_path, path_in_zip):
+		# Return the total size of each file and directory in the given subtree,
+		# and the children of each directory:
+		sizes = {path_in_zip: 0}
+		children = {}
+		prefix = path_in_zip + '/' if path_in_zip else ''
+		infos = self._iter_archive_infos(zip_path, path_in_zip, recursive=True)
+		for info in infos:
+			if info.path != path_in_zip and not info.path.startswith(prefix):
+				continue
+			path = info.path
+			while True:
+				if path not in sizes:
+					sizes[path] = 0
+					parent = path.rsplit('/', 1)[0] if '/' in path else ''
+					children.setdefault(parent, []).append(path)
+				sizes[path] += info.size_bytes or 0
+				if path == path_in_zip:
+					break
+				path = path.rsplit('/', 1)[0] if '/' in path else ''
+		return sizes, children
+	def _copy_directly(
+		self, src_zip_path, path_in_src_zip, dst_zip_path, path_in_dst_zip,
+		task
+	):
+		# Subclasses can copy between archives without a temporary directory.
+		# They return False if this is not possible for the given files.
+		return False
+	def _append_directly(self, zip_path, sources, task):
+		# Subclasses can add files without rewriting the entire archive. They
+		# return False if this is not possible, for instance because an
+		# existing file would be replaced.
+		return False
+	def _partition_members(self, local_path, path_in_zip, num_partitions):
+		# Subclasses whose archives compress each file separately return a list
+		# of lists of paths in the archive, which can be extracted in parallel.
+		# They return None if this is not possible or not worth it.
+		return None
 	def _raise_filenotfounderror_if_not_exists(self, zip_path):
 		os.stat(zip_path)
-	def _read_file_info(self, stdout):
-		path = size = mtime = None
-		is_dir = False
-		for line in stdout:
-			line = line.rstrip('\r\n')
-			if not line:
-				break
-			if line.startswith('Path = '):
-				path = line[len('Path = '):].replace(os.sep, '/')
-			elif line.startswith('Folder = '):
-				folder = line[len('Folder = '):]
-				is_dir = is_dir or folder == '+'
-			elif line.startswith('Size = '):
-				size_str = line[len('Size = '):]
-				if size_str:
-					size = int(size_str)
-			elif line.startswith('Modified = '):
-				mtime_str = line[len('Modified = '):]
-				if mtime_str:
-					mtime = datetime.strptime(mtime_str, '%Y-%m-%d %H:%M:%S')
-			elif line.startswith('Attributes = '):
-				attributes = line[len('Attributes = '):]
-				is_dir = is_dir or attributes.startswith('D')
-		if path:
-			return _FileInfo(path, is_dir, size, mtime)
 	def _put_in_cache(self, zip_path, file_info):
 		for field in file_info._fields:
 			if field != 'path':
@@ -271,8 +452,244 @@ class _7ZipFileSystem(FileSystem):
 					getattr(file_info, field)
 				)
 
+def iter_archive_infos(archive_path):
+	"""
+	Yield information about all files and directories in the archive at the
+	given local path. Unlike the file systems above, this bypasses all caches.
+	Raises CalledProcessError if 7-Zip can't read the archive.
+	"""
+	with _7zip(['l', '-ba', '-slt', archive_path]) as process:
+		stdout_lines = process.stdout_lines
+		try:
+			file_info = _read_file_info(stdout_lines)
+			while file_info:
+				yield file_info
+				file_info = _read_file_info(stdout_lines)
+		except GeneratorExit:
+			# The caller stopped early. Don't wait for 7-Zip to finish:
+			process.kill()
+			raise
+
+def open_archive_member(archive_path, path_in_archive):
+	"""
+	Return a binary file-like object for reading the given file in the archive
+	at the given local path.
+	"""
+	return BufferedReader(_7zipReader(archive_path, path_in_archive))
+
+def _iter_infos(args):
+	with _7zip(args, kill=True) as process:
+		stdout_lines = process.stdout_lines
+		file_info = _read_file_info(stdout_lines)
+		while file_info:
+			yield file_info
+			file_info = _read_file_info(stdout_lines)
+
+def _read_file_info(stdout):
+	path = size = mtime = mode = crc = None
+	is_dir = False
+	for line in stdout:
+		line = line.rstrip('\r\n')
+		if not line:
+			break
+		if line.startswith('Path = '):
+			path = line[len('Path = '):].replace(os.sep, '/')
+		elif line.startswith('Folder = '):
+			folder = line[len('Folder = '):]
+			is_dir = is_dir or folder == '+'
+		elif line.startswith('Size = '):
+			size_str = line[len('Size = '):]
+			if size_str:
+				size = int(size_str)
+		elif line.startswith('Modified = '):
+			mtime_str = line[len('Modified = '):]
+			if mtime_str:
+				mtime = datetime.strptime(mtime_str, '%Y-%m-%d %H:%M:%S')
+		elif line.startswith('Attributes = '):
+			attributes = line[len('Attributes = '):]
+			is_dir = is_dir or attributes.startswith('D')
+			mode = _parse_unix_mode(attributes)
+		elif line.startswith('CRC = '):
+			crc_str = line[len('CRC = '):]
+			if crc_str:
+				crc = int(crc_str, 16)
+	if path:
+		return _FileInfo(path, is_dir, size, mtime, mode, crc)
+
+_transaction = local()
+
+@contextmanager
+def archive_transaction(task=None, join=None):
+	"""
+	Defers deletions and renames in archives until the end of the with block.
+	7-Zip rewrites the entire archive for each modification. Deferring lets us
+	apply many modifications with a single invocation. Pending changes are
+	applied early when files they affect are accessed. They are discarded if
+	the with block raises an exception, or if applying them fails.
+
+	If `task` is given, the changes are applied in subtasks of it, so the user
+	sees their progress and can cancel them. It is also used to tell the user
+	which archives were left unchanged when changes are discarded.
+
+	The transaction belongs to the current thread. To let other threads see
+	and add to its pending changes, pass the object this yields to their own
+	archive_transaction(join=...). Only the block that started the
+	transaction applies the changes.
+	"""
+	outer = getattr(_transaction, 'current', None)
+	if join is None and outer is not None:
+		# Already in a transaction. Let the outermost one apply the changes:
+		yield outer
+		return
+	transaction = _ArchiveTransaction() if join is None else join
+	_transaction.current = transaction
+	try:
+		yield transaction
+	except BaseException:
+		if join is None:
+			transaction.discard(task)
+		raise
+	finally:
+		_transaction.current = outer
+	if join is None:
+		try:
+			transaction.apply(task)
+		except BaseException:
+			transaction.discard(task)
+			raise
+
+class _ArchiveTransaction:
+	def __init__(self):
+		# Maps (file system, archive path) to _ArchiveChanges:
+		self._changes = OrderedDict()
+		# Several threads can take part in the transaction:
+		self._lock = RLock()
+	def add(self, zip_fs, zip_path, command, args):
+		with self._lock:
+			key = (zip_fs, zip_path)
+			if key not in self._changes:
+				self._changes[key] = _ArchiveChanges(zip_fs, zip_path)
+			self._changes[key].add(command, args)
+	def flush(self, zip_fs, zip_path, path_in_zip=None):
+		with self._lock:
+			changes = self._changes.get((zip_fs, zip_path))
+			if changes and changes.affects(path_in_zip):
+				changes.apply()
+	def apply(self, task=None):
+		with self._lock:
+			for (_, zip_path), changes in self._changes.items():
+				if not changes.affects():
+					continue
+				if task is None:
+					changes.apply()
+				else:
+					subtask = _ApplyArchiveChanges(changes, zip_path)
+					task.set_size(task.get_size() + subtask.get_size())
+					task.run(subtask)
+	def discard(self, task=None):
+		with self._lock:
+			zip_paths = [
+				zip_path for (_, zip_path), changes in self._changes.items()
+				if changes.affects()
+			]
+			self._changes.clear()
+		if zip_paths and task is not None:
+			task.show_alert(
+				'The operation did not complete. The following archives were '
+				'therefore left unchanged:\n\n' + '\n'.join(zip_paths)
+			)
+
+class _ArchiveChanges:
+	def __init__(self, zip_fs, zip_path):
+		self._zip_fs = zip_fs
+		self._zip_path = zip_path
+		# List of (7-Zip command, list of args tuples):
+		self._steps = []
+	def add(self, command, args):
+		# Merge with an earlier step that has the same command, unless the
+		# steps in between affect the same files:
+		for step_command, step_args in reversed(self._steps):
+			conflicts = any(
+				_overlaps(path1, path2)
+				for other_args in step_args for path1 in other_args
+				for path2 in args
+			)
+			if step_command == command and not (conflicts and command == 'rn'):
+				step_args.append(args)
+				return
+			if conflicts:
+				break
+		self._steps.append((command, [args]))
+	def affects(self, path_in_zip=None):
+		if path_in_zip is None:
+			return bool(self._steps)
+		return any(
+			_overlaps(path, path_in_zip)
+			for _, step_args in self._steps for args in step_args
+			for path in args
+		)
+	def apply(self, task=None):
+		steps, self._steps = self._steps, []
+		for command, step_args in steps:
+			self._run(command, step_args, task)
+	def _run(self, command, step_args, task):
+		src_paths = [args[0] for args in step_args]
+		with self._zip_fs._preserve_empty_parents(self._zip_path, src_paths):
+			with TemporaryDirectory() as tmp_dir:
+				if len(step_args) == 1:
+					args = [command, self._zip_path] + list(step_args[0])
+				else:
+					# Pass the paths via a list file to avoid exceeding the
+					# maximum command line length:
+					list_file = os.path.join(tmp_dir, 'files.txt')
+					with open(list_file, 'w', encoding='utf-8') as f:
+						for args in step_args:
+							for path in args:
+								f.write(path + '\n')
+					args = [
+						command, '-scsUTF-8', self._zip_path, '@' + list_file
+					]
+				if task is None:
+					_run_7zip(args)
+				else:
+					task.run_7zip_with_progress(args)
+		for args in step_args:
+			self._zip_fs.notify_file_removed(self._zip_path + '/' + args[0])
+			if command == 'rn':
+				self._zip_fs.notify_file_added(self._zip_path + '/' + args[1])
+
+def _overlaps(path1, path2):
+	# Is one of the two paths in the archive equal to or inside the other?
+	return _is_in(path1, path2) or _is_in(path2, path1)
+
+def _is_in(path, dir_path):
+	return not dir_path or path == dir_path or path.startswith(dir_path + '/')
+
+def _parse_unix_mode(attributes):
+	# For archives created on Unix, 7-Zip appends the permissions in `ls -l`
+	# format to the Windows attributes. Eg. "A_ -rwxr-xr-x".
+	parts = attributes.split(' ')
+	if len(parts) < 2 or len(parts[1]) != 10:
+		return None
+	result = 0
+	for i, char in enumerate(parts[1][1:]):
+		if char != '-':
+			result |= 1 << (8 - i)
+	return result
+
 class _7zipTaskWithProgress(Task):
-	def run_7zip_with_progress(self, args, **kwargs):
+	def run_7zip_with_progress(self, args, size_bytes=None, **kwargs):
+		start_time = time()
+		for percent in self._iter_7zip_progress(args, **kwargs):
+			# At least on Linux, 7za shows progress going from 0 to 100% twice.
+			# The second pass is much faster - maybe some kind of
+			# verification? Only show the first round:
+			if percent > self.get_progress():
+				self.set_progress(percent)
+				if size_bytes:
+					bytes_done = size_bytes * percent / 100
+					self._report_throughput(bytes_done, start_time, size_bytes)
+	def _iter_7zip_progress(self, args, **kwargs):
 		with _7zip(args, pty=True, **kwargs) as process:
 			for line in process.stdout_lines:
 				try:
@@ -283,59 +700,361 @@ class _7zipTaskWithProgress(Task):
 				# The \r appears on Windows only:
 				match = re.match('\r? *(\\d\\d?)% ', line)
 				if match:
-					percent = int(match.group(1))
-					# At least on Linux, 7za shows progress going from 0 to
-					# 100% twice. The second pass is much faster - maybe
-					# some kind of verification? Only show the first round:
-					if percent > self.get_progress():
-						self.set_progress(percent)
-
-class AddToArchive(_7zipTaskWithProgress):
-	def __init__(self, zip_fs, fman_fs, src_ospath, zip_path, path_in_zip):
-		if not path_in_zip:
+					yield int(match.group(1))
+	def _report_throughput(self, bytes_done, start_time, size_bytes=None):
+		elapsed = time() - start_time
+		if elapsed > 0:
+			text = '%s/s' % format_size(bytes_done / elapsed)
+			if size_bytes and bytes_done:
+				time_left = elapsed * (size_bytes - bytes_done) / bytes_done
+				text += ', %s left' % format_duration(max(time_left, 0))
+			self.set_text(text)
+
+class _ApplyArchiveChanges(_7zipTaskWithProgress):
+	def __init__(self, changes, zip_path):
+		super().__init__('Updating ' + _basename(zip_path, ''), size=100)
+		self._changes = changes
+	def __call__(self):
+		self._changes.apply(self)
+
+class AddManyToArchive(_7zipTaskWithProgress):
+	"""
+	Adds several files to the same archive with a single 7-Zip invocation.
+	`sources` is a list of (src_ospath, path_in_zip) tuples. 7-Zip rewrites the
+	entire archive whenever files are added. So packing the files in one go is
+	much faster than adding them one by one.
+	"""
+	def __init__(self, zip_fs, fman_fs, sources, zip_path, title=None):
+		if not sources:
+			raise ValueError('Must specify at least one file to add')
+		if not all(path_in_zip for _, path_in_zip in sources):
 			raise ValueError(
 				'Must specify the destination path inside the archive'
 			)
-		super().__init__('Packing ' + os.path.basename(src_ospath), size=100)
+		if title is None:
+			if len(sources) == 1:
+				title = 'Packing ' + os.path.basename(sources[0][0])
+			else:
+				title = 'Packing %d files' % len(sources)
+		super().__init__(title, size=100)
 		self._zip_fs = zip_fs
 		self._fman_fs = fman_fs
-		self._src_ospath = src_ospath
+		self._sources = sources
 		self._zip_path = zip_path
-		self._path_in_zip = path_in_zip
 	def __call__(self):
+		self._zip_fs._flush_changes(self._zip_path)
+		appended = self._zip_fs._append_directly(
+			self._zip_path, self._sources, self
+		)
+		if not appended:
+			self._add_with_7zip()
+		for _, path_in_zip in self._sources:
+			self._zip_fs.notify_file_added(self._zip_path + '/' + path_in_zip)
+	def _add_with_7zip(self):
 		with TemporaryDirectory() as tmp_dir:
-			dest = Path(tmp_dir, *self._path_in_zip.split('/'))
-			dest.parent.mkdir(parents=True, exist_ok=True)
-			src = Path(self._src_ospath)
-			try:
-				dest.symlink_to(src, src.is_dir())
-			except OSError:
-				# This for instance happens on non-NTFS drives on Windows.
-				# We need to incur the cost of physically copying the file:
-				self._fman_fs.copy(as_url(src), as_url(dest))
-			args = ['a', self._zip_path, self._path_in_zip]
-			if PLATFORM != 'Windows':
-				args.insert(1, '-l')
-			self.run_7zip_with_progress(args, cwd=tmp_dir)
-			dest_path = self._zip_path + '/' + self._path_in_zip
-			self._zip_fs.notify_file_added(dest_path)
-
-class Extract(Task):
-	def __init__(self, fman_fs, zip_path, path_in_zip, dst_ospath):
-		super().__init__('Extracting ' + _basename(zip_path, path_in_zip))
+			plan = self._plan_adding_in_place()
+			if plan is not None:
+				groups, renames = plan
+				if len(groups) == 1 and not renames:
+					# 7-Zip can add the files from where they are in one pass:
+					self._add_in_place(tmp_dir, groups, renames)
+					return
+			# Otherwise, adding in place rewrites the archive once per source
+			# directory and once more for the renames. Symlinks let 7-Zip add
+			# everything in one pass. Without them, staging copies each file.
+			if plan is None or _can_symlink(tmp_dir):
+				self._add_via_staging_dir(tmp_dir)
+			else:
+				self._add_in_place(tmp_dir, groups, renames)
+	def _plan_adding_in_place(self):
+		# 7-Zip stores each file under the path it was given relative to its
+		# working directory. So we can point it at the source files directly
+		# instead of mirroring the destination paths with symlinks or copies.
+		# When a file's path in the archive isn't a suffix of its source path,
+		# we add it under its name and rename it afterwards. Returns a list of
+		# (working directory, paths relative to it) tuples and a list of
+		# renames, or None when the temporary names could clash.
+		groups = OrderedDict()
+		renames = []
+		for src_ospath, path_in_zip in self._sources:
+			src = Path(src_ospath)
+			parts = path_in_zip.split('/')
+			if len(src.parts) > len(parts) and \
+				src.parts[-len(parts):] == tuple(parts):
+				cwd = str(src.parents[len(parts) - 1])
+				groups.setdefault(cwd, []).append(path_in_zip)
+			else:
+				if not src.name:
+					return None
+				groups.setdefault(str(src.parent), []).append(src.name)
+				renames.append((src.name, path_in_zip))
+		if renames:
+			final_paths = [path_in_zip for _, path_in_zip in self._sources]
+			tmp_names = [tmp_name for tmp_name, _ in renames]
+			for i, tmp_name in enumerate(tmp_names):
+				others = final_paths + tmp_names[:i] + tmp_names[i + 1:]
+				if any(_overlaps(tmp_name, other) for other in others):
+					return None
+				if self._zip_fs.exists(self._zip_path + '/' + tmp_name):
+					return None
+		return list(groups.items()), renames
+	def _add_in_place(self, tmp_dir, groups, renames):
+		size_bytes = sum(_get_size_bytes(src) for src, _ in self._sources)
+		start_time = time()
+		bytes_before = 0
+		for i, (cwd, paths) in enumerate(groups):
+			group_bytes = sum(
+				_get_size_bytes(os.path.join(cwd, path)) for path in paths
+			)
+			list_file = os.path.join(tmp_dir, 'files%d.txt' % i)
+			args = self._get_add_args(paths, list_file)
+			for percent in self._iter_7zip_progress(args, cwd=cwd):
+				bytes_done = bytes_before + group_bytes * percent / 100
+				if size_bytes:
+					progress = int(100 * bytes_done / size_bytes)
+				else:
+					progress = percent
+				if progress > self.get_progress():
+					self.set_progress(progress)
+					self._report_throughput(bytes_done, start_time)
+			bytes_before += group_bytes
+		if renames:
+			list_file = os.path.join(tmp_dir, 'renames.txt')
+			with open(list_file, 'w', encoding='utf-8') as f:
+				for tmp_name, path_in_zip in renames:
+					f.write(tmp_name + '\n' + path_in_zip + '\n')
+			_run_7zip(['rn', '-scsUTF-8', self._zip_path, '@' + list_file])
+	def _add_via_staging_dir(self, tmp_dir):
+		# Stage the files in a subdirectory so the list file below can't clash
+		# with them:
+		staging_dir = os.path.join(tmp_dir, 'files')
+		size_bytes = 0
+		for src_ospath, path_in_zip in self._sources:
+			self._stage(src_ospath, staging_dir, path_in_zip)
+			size_bytes += _get_size_bytes(src_ospath)
+		paths = [path_in_zip for _, path_in_zip in self._sources]
+		args = self._get_add_args(paths, os.path.join(tmp_dir, 'files.txt'))
+		self.run_7zip_with_progress(args, size_bytes, cwd=staging_dir)
+	def _get_add_args(self, paths, list_file):
+		args = ['a'] + self._zip_fs._compression_args + [self._zip_path]
+		if PLATFORM != 'Windows':
+			args.insert(1, '-l')
+		if len(paths) == 1:
+			args.append(paths[0])
+		else:
+			# Pass the paths via a list file to avoid exceeding the maximum
+			# command line length:
+			with open(list_file, 'w', encoding='utf-8') as f:
+				for path in paths:
+					f.write(path + '\n')
+			args.insert(1, '-scsUTF-8')
+			args.append('@' + list_file)
+		return args
+	def _stage(self, src_ospath, staging_dir, path_in_zip):
+		dest = Path(staging_dir, *path_in_zip.split('/'))
+		dest.parent.mkdir(parents=True, exist_ok=True)
+		src = Path(src_ospath)
+		try:
+			dest.symlink_to(src, src.is_dir())
+		except OSError:
+			# This for instance happens on non-NTFS drives on Windows.
+			# We need to incur the cost of physically copying the file:
+			self._fman_fs.copy(as_url(src), as_url(dest))
+
+def _can_symlink(dir_path):
+	link = os.path.join(dir_path, 'symlink-test')
+	try:
+		os.symlink('target', link)
+	except (OSError, NotImplementedError):
+		return False
+	os.unlink(link)
+	return True
+
+class AddToArchive(AddManyToArchive):
+	def __init__(self, zip_fs, fman_fs, src_ospath, zip_path, path_in_zip):
+		super().__init__(zip_fs, fman_fs, [(src_ospath, path_in_zip)], zip_path)
+
+def combine_additions(tasks, title=None):
+	"""
+	Merge consecutive AddManyToArchive tasks for the same archive into one task,
+	so the archive is only rewritten once. Other tasks are passed through
+	unchanged.
+	"""
+	result = []
+	for group in _group_consecutive(tasks, _can_combine_additions):
+		if len(group) == 1:
+			result.append(group[0])
+		else:
+			first = group[0]
+			sources = [src for task in group for src in task._sources]
+			result.append(AddManyToArchive(
+				first._zip_fs, first._fman_fs, sources, first._zip_path, title
+			))
+	return result
+
+def _can_combine_additions(group, task):
+	last = group[-1]
+	return isinstance(last, AddManyToArchive) and \
+		   isinstance(task, AddManyToArchive) and \
+		   last._zip_fs is task._zip_fs and \
+		   last._zip_path == task._zip_path
+
+def combine_extractions(tasks, title=None):
+	"""
+	Merge consecutive Extract tasks for the same archive into one ExtractMany
+	task, so 7-Zip only has to decompress the archive once. Other tasks are
+	passed through unchanged.
+	"""
+	result = []
+	for group in _group_consecutive(tasks, _can_combine_extractions):
+		if len(group) == 1:
+			result.append(group[0])
+		else:
+			first = group[0]
+			members = [
+				(task._path_in_zip, task._dst_ospath) for task in group
+			]
+			result.append(ExtractMany(
+				first._zip_fs, first._fman_fs, first._zip_path, members, title
+			))
+	return result
+
+def _can_combine_extractions(group, task):
+	first = group[0]
+	if type(first) is not Extract or type(task) is not Extract:
+		return False
+	if first._zip_fs is not task._zip_fs or first._zip_path != task._zip_path:
+		return False
+	# Extracting the entire archive, or a directory together with one of its
+	# files, can't be expressed as a single list of members:
+	return not any(
+		_overlaps(other._path_in_zip, task._path_in_zip) for other in group
+	)
+
+def _group_consecutive(tasks, can_combine):
+	result = []
+	for task in tasks:
+		if result and can_combine(result[-1], task):
+			result[-1].append(task)
+		else:
+			result.append([task])
+	return result
+
+class Extract(_7zipTaskWithProgress):
+	def __init__(self, zip_fs, fman_fs, zip_path, path_in_zip, dst_ospath):
+		title = 'Extracting ' + _basename(zip_path, path_in_zip)
+		super().__init__(title, size=100)
+		self._zip_fs = zip_fs
 		self._fman_fs = fman_fs
 		self._zip_path = zip_path
 		self._path_in_zip = path_in_zip
 		self._dst_ospath = dst_ospath
+		self._max_processes = os.cpu_count() or 1
+	def set_max_processes(self, max_processes):
+		self._max_processes = max_processes
 	def __call__(self):
+		src_path = _join(self._zip_path, self._path_in_zip)
+		self._zip_fs._flush_changes(self._zip_path, self._path_in_zip)
+		self._local_zip_path = self._zip_fs._get_local_path(self._zip_path)
+		if self._path_in_zip and not self._zip_fs.is_dir(src_path):
+			self._extract_file(src_path)
+		elif self._can_extract_directly():
+			self._extract_directly()
+		else:
+			self._extract_via_temp_dir()
+	def _extract_file(self, src_path):
+		# Stream the file from 7-Zip's stdout to the destination. This avoids
+		# the temporary directory and the subsequent move.
+		dst = Path(self._dst_ospath)
+		dst_existed = dst.exists()
+		if dst_existed:
+			# Don't destroy the existing file if the extraction fails. A unique
+			# name ensures we don't overwrite another file of the user's:
+			fd, tmp_name = mkstemp(dir=str(dst.parent), prefix='.' + dst.name)
+			os.close(fd)
+			tmp_dst = Path(tmp_name)
+		else:
+			tmp_dst = dst
+		size_bytes = self._zip_fs.size_bytes(src_path) or 0
+		try:
+			if tmp_dst != dst:
+				# mkstemp(...) creates the file with mode 0600:
+				shutil.copymode(str(dst), tmp_name)
+			# Closing the stream early stops 7-Zip from decompressing data
+			# nobody reads:
+			with self._zip_fs._open_member(
+				self._local_zip_path, self._path_in_zip
+			) as stream:
+				self._write_stream(stream, tmp_dst, size_bytes)
+			self._copy_attributes(src_path, tmp_dst)
+			if tmp_dst != dst:
+				tmp_dst.replace(dst)
+		except BaseException:
+			try:
+				tmp_dst.unlink()
+			except FileNotFoundError:
+				pass
+			raise
+		if not dst_existed:
+			self._fman_fs.notify_file_added(as_url(self._dst_ospath))
+	def _write_stream(self, stream, dst, size_bytes):
+		start_time = time()
+		with dst.open('wb') as f:
+			num_written = 0
+			while True:
+				self.check_canceled()
+				chunk = stream.read(64 * 1024)
+				if not chunk:
+					break
+				num_written += f.write(chunk)
+				self._report_progress(num_written, size_bytes, start_time)
+	def _report_progress(self, num_bytes, total_bytes, start_time):
+		size = self.get_size()
+		if size and total_bytes:
+			self.set_progress(min(size, size * num_bytes // total_bytes))
+			self._report_throughput(num_bytes, start_time, total_bytes)
+	def _copy_attributes(self, src_path, dst):
+		mtime = self._zip_fs.modified_datetime(src_path)
+		if mtime is not None:
+			timestamp = mtime.timestamp()
+			os.utime(str(dst), (timestamp, timestamp))
+		if PLATFORM != 'Windows':
+			mode = self._zip_fs._query_info_attr(src_path, 'mode', None)
+			if mode is not None:
+				dst.chmod(mode)
+	def _can_extract_directly(self):
+		# 7-Zip extracts a/b to <output dir>/a/b. We can therefore extract
+		# straight to the destination if the destination "looks like" this
+		# and does not yet exist. Otherwise, we need a temporary directory.
+		if os.path.exists(self._dst_ospath):
+			return False
+		if not self._path_in_zip:
+			return True
+		return '/' not in self._path_in_zip and \
+			   os.path.basename(self._dst_ospath) == self._path_in_zip
+	def _extract_directly(self):
+		if self._path_in_zip:
+			out_dir = os.path.dirname(self._dst_ospath)
+		else:
+			# Create the directory ourselves. 7-Zip does not do it when the
+			# archive is empty.
+			os.mkdir(self._dst_ospath)
+			out_dir = self._dst_ospath
+		try:
+			self._extract_to(out_dir)
+			if not os.path.exists(self._dst_ospath):
+				src_path = _join(self._zip_path, self._path_in_zip)
+				raise filenotfounderror(self._zip_fs.scheme + src_path)
+		except BaseException:
+			shutil.rmtree(self._dst_ospath, ignore_errors=True)
+			raise
+		self._fman_fs.notify_file_added(as_url(self._dst_ospath))
+	def _extract_via_temp_dir(self):
 		# Create temp dir next to dst_path to ensure Path.replace(...) works
 		# because it's on the same file system.
 		tmp_dir = _create_temp_dir_next_to(self._dst_ospath)
 		try:
-			args = ['x', self._zip_path, '-o' + tmp_dir.name]
-			if self._path_in_zip:
-				args.insert(2, self._path_in_zip)
-			_run_7zip(args)
+			self._extract_to(tmp_dir.name)
 			# Use fman.fs.move(...) so fman's file:// caches are notified of the
 			# new file:
 			self._fman_fs.move(
@@ -348,11 +1067,114 @@ class Extract(Task):
 			except FileNotFoundError:
 				# This happens when path_in_zip = ''
 				pass
+	def _extract_to(self, out_dir):
+		# Extracts path_in_zip to out_dir/path_in_zip.
+		sizes = self._zip_fs._get_tree_sizes(self._zip_path, self._path_in_zip)
+		size_bytes = sizes[0][self._path_in_zip]
+		partitions = None
+		if self._max_processes > 1:
+			partitions = self._zip_fs._partition_members(
+				self._local_zip_path, self._path_in_zip, self._max_processes
+			)
+		if partitions:
+			self._extract_in_parallel(partitions, out_dir, size_bytes)
+		else:
+			args = ['x', self._local_zip_path, '-o' + out_dir]
+			if self._path_in_zip:
+				args.insert(2, self._path_in_zip)
+			self.run_7zip_with_progress(args, size_bytes)
+	def _extract_in_parallel(self, partitions, out_dir, size_bytes):
+		# A single 7-Zip process only uses one CPU core for Deflate. When the
+		# files are compressed independently, we can instead let several
+		# processes each extract a part of them.
+		with TemporaryDirectory() as tmp_dir:
+			all_args = []
+			for i, paths_in_zip in enumerate(partitions):
+				list_file = os.path.join(tmp_dir, '%d.txt' % i)
+				with open(list_file, 'w', encoding='utf-8') as f:
+					for path_in_zip in paths_in_zip:
+						f.write(path_in_zip + '\n')
+				all_args.append([
+					'x', '-scsUTF-8', self._local_zip_path, '@' + list_file,
+					'-o' + out_dir
+				])
+			# The partitions hold about the same amount of data. So the
+			# average of their percentages is a good measure of the progress:
+			percentages = [0] * len(all_args)
+			lock = Lock()
+			start_time = time()
+			def run(i):
+				for percent in self._iter_7zip_progress(all_args[i]):
+					with lock:
+						percentages[i] = max(percentages[i], percent)
+						progress = sum(percentages) // len(percentages)
+						if progress > self.get_progress():
+							self.set_progress(progress)
+							bytes_done = size_bytes * progress / 100
+							self._report_throughput(
+								bytes_done, start_time, size_bytes
+							)
+			with ThreadPoolExecutor(len(all_args)) as executor:
+				# Iterating over the results raises the first error, if any.
+				# When the task is canceled, each worker kills its 7-Zip
+				# process:
+				for _ in executor.map(run, range(len(all_args))):
+					pass
+
+class ExtractMany(_7zipTaskWithProgress):
+	"""
+	Extracts several files from the same archive with a single 7-Zip
+	invocation. `members` is a list of (path_in_zip, dst_ospath) tuples. For
+	solid archives, this is much faster than extracting the files one by one,
+	because each extraction decompresses the solid block from its start.
+	"""
+	def __init__(self, zip_fs, fman_fs, zip_path, members, title=None):
+		if not members:
+			raise ValueError('Must specify at least one file to extract')
+		if title is None:
+			title = 'Extracting %d files' % len(members)
+		super().__init__(title, size=100)
+		self._zip_fs = zip_fs
+		self._fman_fs = fman_fs
+		self._zip_path = zip_path
+		self._members = members
+	def __call__(self):
+		self._zip_fs._flush_changes(self._zip_path)
+		local_zip_path = self._zip_fs._get_local_path(self._zip_path)
+		sizes = self._zip_fs._get_tree_sizes(self._zip_path, '')[0]
+		size_bytes = sum(sizes.get(path, 0) for path, _ in self._members)
+		# Create temp dir next to the destination so moving the extracted
+		# files there is cheap:
+		tmp_dir = _create_temp_dir_next_to(self._members[0][1])
+		try:
+			# Pass the paths via a list file to avoid exceeding the maximum
+			# command line length:
+			list_file = os.path.join(tmp_dir.name, 'files.txt')
+			with open(list_file, 'w', encoding='utf-8') as f:
+				for path_in_zip, _ in self._members:
+					f.write(path_in_zip + '\n')
+			out_dir = os.path.join(tmp_dir.name, 'files')
+			args = [
+				'x', '-scsUTF-8', local_zip_path, '@' + list_file,
+				'-o' + out_dir
+			]
+			self.run_7zip_with_progress(args, size_bytes)
+			for path_in_zip, dst_ospath in self._members:
+				self.check_canceled()
+				# Use fman.fs.move(...) so fman's file:// caches are notified
+				# of the new file:
+				self._fman_fs.move(
+					join(as_url(out_dir), path_in_zip), as_url(dst_ospath)
+				)
+		finally:
+			tmp_dir.cleanup()
+
+_STAGING_LIMIT_BYTES = 256 * 1024 * 1024
 
 class CopyBetweenArchives(Task):
 	def __init__(
 		self, zip_fs, fman_fs, src_zip_path, path_in_src_zip, dst_zip_path,
-		path_in_dst_zip
+		path_in_dst_zip, staging_limit_bytes=_STAGING_LIMIT_BYTES
 	):
 		title = 'Copying ' + _basename(src_zip_path, path_in_src_zip)
 		super().__init__(title, size=200)
@@ -362,20 +1184,77 @@ class CopyBetweenArchives(Task):
 		self._path_in_src_zip = path_in_src_zip
 		self._dst_zip_path = dst_zip_path
 		self._path_in_dst_zip = path_in_dst_zip
+		self._staging_limit_bytes = staging_limit_bytes
 	def __call__(self):
-		with TemporaryDirectory() as tmp_dir:
-			src_basename = self._path_in_src_zip.rsplit('/', 1)[-1]
-			# Give temp dir the same name as the source file; This leads to the
-			# correct name being displayed in the progress dialog:
-			tmp_dst_ospath = os.path.join(tmp_dir, src_basename)
-			self.run(Extract(
-				self._fman_fs, self._src_zip_path, self._path_in_src_zip,
-				tmp_dst_ospath
-			))
-			self.run(AddToArchive(
-				self._zip_fs, self._fman_fs, tmp_dst_ospath, self._dst_zip_path,
-				self._path_in_dst_zip
-			))
+		copied = self._zip_fs._copy_directly(
+			self._src_zip_path, self._path_in_src_zip, self._dst_zip_path,
+			self._path_in_dst_zip, self
+		)
+		if not copied:
+			self._copy_via_staging_area()
+	def _copy_via_staging_area(self):
+		# Extract the files to a temporary directory, then add them to the
+		# destination archive. To limit the disk space needed for this, we
+		# split large directories into batches of at most staging_limit_bytes.
+		# The files of each batch are extracted with a single 7-Zip
+		# invocation.
+		dirs, batches = self._split_into_batches()
+		for dir_path in dirs:
+			dst_path = \
+				_join(self._dst_zip_path, self._get_path_in_dst(dir_path))
+			if not self._zip_fs.exists(dst_path):
+				self._zip_fs.mkdir(dst_path)
+		for batch in batches:
+			with TemporaryDirectory() as tmp_dir:
+				extractions = []
+				sources = []
+				for i, src_path in enumerate(batch):
+					# Give the temp file the same name as the source file; This
+					# leads to the correct name being displayed in the progress
+					# dialog:
+					name = src_path.rsplit('/', 1)[-1]
+					tmp_dst_ospath = os.path.join(tmp_dir, str(i), name)
+					os.mkdir(os.path.dirname(tmp_dst_ospath))
+					extractions.append(Extract(
+						self._zip_fs, self._fman_fs, self._src_zip_path,
+						src_path, tmp_dst_ospath
+					))
+					path_in_dst = self._get_path_in_dst(src_path)
+					sources.append((tmp_dst_ospath, path_in_dst))
+				for task in combine_extractions(extractions):
+					self.run(task)
+				self.run(AddManyToArchive(
+					self._zip_fs, self._fman_fs, sources, self._dst_zip_path,
+					self.get_title()
+				))
+	def _split_into_batches(self):
+		root = self._path_in_src_zip
+		sizes, children = self._zip_fs._get_tree_sizes(self._src_zip_path, root)
+		limit = self._staging_limit_bytes
+		dirs, units = [], []
+		to_visit = [root]
+		while to_visit:
+			path = to_visit.pop()
+			if sizes[path] > limit and path in children:
+				dirs.append(path)
+				to_visit.extend(reversed(children[path]))
+			else:
+				units.append(path)
+		batches = []
+		batch_size = 0
+		for unit in units:
+			if not batches or batch_size + sizes[unit] > limit:
+				batches.append([])
+				batch_size = 0
+			batches[-1].append(unit)
+			batch_size += sizes[unit]
+		return dirs, batches
+	def _get_path_in_dst(self, path_in_src_zip):
+		if not self._path_in_src_zip:
+			return self._path_in_dst_zip + '/' + path_in_src_zip \
+				if path_in_src_zip else self._path_in_dst_zip
+		return self._path_in_dst_zip + \
+			   path_in_src_zip[len(self._path_in_src_zip):]
 
 class Rename(_7zipTaskWithProgress):
 	def __init__(self, zip_fs, zip_path, src_in_zip, dst_in_zip):
@@ -385,12 +1264,9 @@ class Rename(_7zipTaskWithProgress):
 		self._src_in_zip = src_in_zip
 		self._dst_in_zip = dst_in_zip
 	def __call__(self, *args, **kwargs):
-		with self._fs._preserve_empty_parent(self._zip_path, self._src_in_zip):
-			self.run_7zip_with_progress(
-				['rn', self._zip_path, self._src_in_zip, self._dst_in_zip]
-			)
-		self._fs.notify_file_removed(self._zip_path + '/' + self._src_in_zip)
-		self._fs.notify_file_added(self._zip_path + '/' + self._dst_in_zip)
+		self._fs._change_archive(
+			self._zip_path, 'rn', (self._src_in_zip, self._dst_in_zip), self
+		)
 
 class MoveBetweenArchives(Task):
 	def __init__(self, fs, src_url, dst_url):
@@ -400,14 +1276,256 @@ class MoveBetweenArchives(Task):
 		self._dst_url = dst_url
 	def __call__(self):
 		self.set_text('Preparing...')
-		with TemporaryDirectory() as tmp_dir:
-			# Give temp dir the same name as the source file; This leads to the
-			# correct name being displayed in the progress dialog:
-			tmp_url = as_url(os.path.join(tmp_dir, basename(self._src_url)))
-			tasks = list(self._fs.prepare_move(self._src_url, tmp_url))
-			tasks.extend(self._fs.prepare_move(tmp_url, self._dst_url))
-			for task in tasks:
-				self.run(task)
+		# Copy first, so the files aren't lost when the copy fails:
+		tasks = list(self._fs.prepare_copy(self._src_url, self._dst_url))
+		tasks.extend(self._fs.prepare_delete(splitscheme(self._src_url)[1]))
+		for task in tasks:
+			self.run(task)
+
+class _ArchiveBatch(_7zipTaskWithProgress):
+	"""
+	Processes several independent items, such as archives, in parallel and
+	collects the result for each of them. At most one item per CPU core is
+	processed at a time. Subclasses implement _process(item), which either
+	returns None or an error message, or raises OSError or CalledProcessError.
+	"""
+
+	_FAILURE_MESSAGE = 'Could not process'
+
+	def __init__(self, title, items, num_workers=None):
+		super().__init__(title, size=100)
+		self._items = items
+		if num_workers is None:
+			num_workers = min(len(items), os.cpu_count() or 1)
+		self._num_workers = max(num_workers, 1)
+		self._lock = Lock()
+		# Maps each item to an error message, or None if it succeeded:
+		self.results = OrderedDict()
+	def __call__(self):
+		with ThreadPoolExecutor(self._num_workers) as executor:
+			futures = [executor.submit(self._run, item) for item in self._items]
+			for item, future in zip(self._items, futures):
+				try:
+					self.results[item] = future.result()
+				except Task.Canceled:
+					# Workers that are already running notice the cancellation
+					# themselves. Don't start the others:
+					for other in futures:
+						other.cancel()
+					raise
+		self._show_report()
+	def _run(self, item):
+		try:
+			return self._process(item)
+		except (OSError, CalledProcessError) as e:
+			return _describe_error(e, self._get_local_path(item))
+	def _get_local_path(self, item):
+		return item
+	def _show_report(self):
+		errors = self._get_errors()
+		if errors:
+			header = '%s %d of %d items:' % \
+					 (self._FAILURE_MESSAGE, len(errors), len(self.results))
+			self.show_alert(self._format_errors(header, errors))
+	def _get_errors(self):
+		return [(item, e) for item, e in self.results.items() if e is not None]
+	def _format_errors(self, header, errors):
+		result = header + '\n'
+		for item, error in errors[:_MAX_NUM_ERRORS_SHOWN]:
+			name = os.path.basename(self._get_local_path(item))
+			result += '\n%s: %s' % (name, error)
+		if len(errors) > _MAX_NUM_ERRORS_SHOWN:
+			result += '\n...'
+		return result
+
+class CheckArchives(_ArchiveBatch):
+	"""
+	Checks the integrity of several archives in parallel and reports the
+	result for each of them at the end. Zip files are checked with Python's
+	zipfile module, which verifies each file's CRC. Other archives are tested
+	with `7za t`.
+	"""
+	def __init__(self, archive_paths, num_workers=None):
+		if len(archive_paths) == 1:
+			title = 'Testing ' + os.path.basename(archive_paths[0])
+		else:
+			title = 'Testing %d archives' % len(archive_paths)
+		super().__init__(title, archive_paths, num_workers)
+		self._item_sizes = {}
+		self._size_bytes = 0
+		self._bytes_done = {}
+		self._start_time = None
+	def __call__(self):
+		# Measure the archives here rather than in __init__(...), which runs
+		# in the thread that creates this task:
+		for archive_path in self._items:
+			self.check_canceled()
+			self._item_sizes[archive_path] = _get_size_bytes(archive_path)
+		self._size_bytes = sum(self._item_sizes.values())
+		self._start_time = time()
+		super().__call__()
+	def _run(self, archive_path):
+		result = super()._run(archive_path)
+		self._report_bytes_done(archive_path, self._item_sizes[archive_path])
+		return result
+	def _process(self, archive_path):
+		try:
+			with ZipFile(archive_path) as zip_file:
+				if _can_test_with_zipfile(zip_file):
+					self._test_with_zipfile(archive_path, zip_file)
+					return None
+		except (BadZipFile, EOFError, zlib.error) as e:
+			if is_zipfile(archive_path):
+				return _describe_error(e, archive_path)
+		except (RuntimeError, NotImplementedError):
+			pass
+		self._test_with_7zip(archive_path)
+	def _test_with_zipfile(self, archive_path, zip_file):
+		bytes_done = 0
+		for info in zip_file.infolist():
+			# ZipExtFile raises BadZipFile when the CRC does not match:
+			with zip_file.open(info) as f:
+				while f.read(1024 * 1024):
+					self.check_canceled()
+			bytes_done += info.compress_size
+			self._report_bytes_done(archive_path, bytes_done)
+	def _test_with_7zip(self, archive_path):
+		size_bytes = self._item_sizes[archive_path]
+		for percent in self._iter_7zip_progress(['t', archive_path]):
+			bytes_done = size_bytes * percent / 100
+			self._report_bytes_done(archive_path, bytes_done)
+	def _report_bytes_done(self, archive_path, num_bytes):
+		with self._lock:
+			bytes_done = self._bytes_done
+			bytes_done[archive_path] = \
+				max(bytes_done.get(archive_path, 0), num_bytes)
+			total = sum(bytes_done.values())
+			if self._size_bytes:
+				self.set_progress(min(100, 100 * total // self._size_bytes))
+			self._report_throughput(total, self._start_time)
+	def _show_report(self):
+		errors = self._get_errors()
+		if errors:
+			header = '%d of %d archives have errors:' % \
+					 (len(errors), len(self.results))
+			message = self._format_errors(header, errors)
+		elif len(self.results) == 1:
+			message = 'No errors were found.'
+		else:
+			message = 'All %d archives are OK.' % len(self.results)
+		self.show_alert(message)
+
+class _SubtaskBatch(_ArchiveBatch):
+	"""
+	A batch whose items are processed by tasks from fman's file systems. They
+	run as our subtasks, so they notice when the user cancels the batch. Their
+	progress makes up ours.
+	"""
+	def __init__(self, title, items, fman_fs, num_workers=None):
+		super().__init__(title, items, num_workers)
+		self._fman_fs = fman_fs
+		self.set_size(0)
+	def _run_subtasks(self, tasks):
+		for task in tasks:
+			self.check_canceled()
+			if isinstance(task, Extract):
+				# We already process one item per CPU core:
+				task.set_max_processes(1)
+			with self._lock:
+				self.set_size(self.get_size() + task.get_size())
+			self.run(task)
+
+class BatchExtract(_SubtaskBatch):
+	"""
+	Extracts each of several archives to its own directory. The items are
+	(archive URL, destination directory URL) tuples.
+	"""
+
+	_FAILURE_MESSAGE = 'Could not extract'
+
+	def __init__(self, items, fman_fs=fman.fs, num_workers=None):
+		title = 'Extracting %d archives' % len(items)
+		super().__init__(title, items, fman_fs, num_workers)
+	def _process(self, item):
+		archive_url, dst_url = item
+		self._run_subtasks(self._fman_fs.prepare_copy(archive_url, dst_url))
+	def _get_local_path(self, item):
+		return splitscheme(item[0])[1]
+
+class BatchPack(_SubtaskBatch):
+	"""
+	Packs each of several files or directories into its own archive. The items
+	are (source URL, archive URL) tuples.
+	"""
+
+	_FAILURE_MESSAGE = 'Could not pack'
+
+	def __init__(self, items, fman_fs=fman.fs, num_workers=None):
+		title = 'Packing %d files' % len(items)
+		super().__init__(title, items, fman_fs, num_workers)
+	def _process(self, item):
+		src_url, archive_url = item
+		# Create an empty archive:
+		self._fman_fs.mkdir(archive_url)
+		dst_url = archive_url + '/' + basename(src_url)
+		try:
+			self._run_subtasks(self._fman_fs.prepare_copy(src_url, dst_url))
+		except BaseException:
+			# Don't leave an incomplete archive behind:
+			try:
+				self._fman_fs.delete(as_url(splitscheme(archive_url)[1]))
+			except OSError:
+				pass
+			raise
+	def _get_local_path(self, item):
+		return splitscheme(item[0])[1]
+
+_MAX_NUM_ERRORS_SHOWN = 20
+
+def _can_test_with_zipfile(zip_file):
+	# Python's zipfile can't check encrypted files, or compression methods
+	# such as Deflate64. We let 7-Zip handle those.
+	return all(
+		not info.flag_bits & _ZIP_FLAG_ENCRYPTED and
+		info.compress_type in (
+			ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
+		)
+		for info in zip_file.infolist()
+	)
+
+def _describe_error(exc, archive_path):
+	if isinstance(exc, CalledProcessError) and exc.output:
+		# 7-Zip prints a line "ERROR: ..." for each problem it finds:
+		messages = []
+		for match in re.finditer('ERROR: (.*)', exc.output):
+			message = match.group(1).strip()
+			if message and message != archive_path and \
+				message not in messages:
+				messages.append(message)
+		if messages:
+			return '. '.join(messages)
+	if isinstance(exc, OSError) and exc.strerror:
+		return exc.strerror
+	return str(exc) or exc.__class__.__name__
+
+def _get_size_bytes(ospath):
+	# This is only used for displaying statistics. So ignore errors:
+	if not os.path.isdir(ospath):
+		try:
+			return os.path.getsize(ospath)
+		except OSError:
+			return 0
+	result = 0
+	for dir_path, _, file_names in os.walk(ospath):
+		for file_name in file_names:
+			try:
+				result += os.path.getsize(os.path.join(dir_path, file_name))
+			except OSError:
+				pass
+	return result
+
+def _join(zip_path, path_in_zip):
+	return zip_path + ('/' + path_in_zip if path_in_zip else '')
 
 def _basename(zip_path, path_in_zip):
 	sep = ('/' if path_in_zip else '')
@@ -426,11 +1544,14 @@ class _7zip:
 
 	_7ZIP_WARNING = 1
 
-	def __init__(self, args, cwd=None, pty=False, kill=False):
+	def __init__(self, args, cwd=None, pty=False, kill=False, binary=False):
+		if pty and binary:
+			raise ValueError('pty=True cannot be combined with binary=True')
 		self._args = args
 		self._cwd = cwd
 		self._pty = pty
 		self._kill = kill
+		self._binary = binary
 		self._killed = False
 		self._process = None
 		self._stdout_lines = deque(maxlen=100)
@@ -439,9 +1560,15 @@ class _7zip:
 			cls = Run7ZipViaWinpty if self._pty else Popen7ZipWindows
 		else:
 			cls = Run7ZipViaPty if self._pty else Popen7ZipUnix
-		self._process = cls(self._args, self._cwd)
+		if self._binary:
+			self._process = cls(self._args, self._cwd, binary=True)
+		else:
+			self._process = cls(self._args, self._cwd)
 		return self
 	@property
+	def stdout(self):
+		return self._process.stdout
+	@property
 	def stdout_lines(self):
 		for line in self._process.stdout:
 			self._stdout_lines.append(line)
@@ -466,6 +1593,33 @@ class _7zip:
 		finally:
 			self._process.stdout.close()
 
+class _7zipReader(RawIOBase):
+	"""
+	Reads a single file from an archive via `7za e -so`.
+	"""
+	def __init__(self, zip_path, path_in_zip):
+		super().__init__()
+		self._process = _7zip(['e', '-so', zip_path, path_in_zip], binary=True)
+		self._process.__enter__()
+		self._eof = False
+	def readable(self):
+		return True
+	def readinto(self, b):
+		result = self._process.stdout.readinto(b)
+		if not result:
+			self._eof = True
+		return result
+	def close(self):
+		if self.closed:
+			return
+		try:
+			if not self._eof:
+				# Don't make 7-Zip decompress data nobody is going to read:
+				self._process.kill()
+			self._process.__exit__(None, None, None)
+		finally:
+			super().close()
+
 class _7zipError(CalledProcessError):
 	def __str__(self):
 		result = '7-Zip with args %r returned non-zero exit status %d' % \
@@ -475,7 +1629,9 @@ class _7zipError(CalledProcessError):
 		return result
 
 class Popen7Zip:
-	def __init__(self, args, cwd, env, encoding=None, **kwargs):
+	def __init__(
+		self, args, cwd, env, encoding=None, binary=False, **kwargs
+	):
 		# We need to supply stdin and stderr != None because otherwise on
 		# Windows, when fman is run as a GUI app, we get:
 		# 	OSError: [WinError 6] The handle is invalid
@@ -484,16 +1640,22 @@ class Popen7Zip:
 			[_7ZIP_BINARY] + args, stdout=PIPE, stderr=DEVNULL, stdin=DEVNULL,
 			cwd=cwd, env=env, **kwargs
 		)
-		self.stdout = SourceClosingTextIOWrapper(self._process.stdout, encoding)
+		if binary:
+			self.stdout = self._process.stdout
+		else:
+			self.stdout = \
+				SourceClosingTextIOWrapper(self._process.stdout, encoding)
 	def kill(self):
 		self._process.kill()
 	def wait(self):
 		return self._process.wait()
 
 class Popen7ZipWindows(Popen7Zip):
-	def __init__(self, args, cwd):
+	def __init__(self, args, cwd, binary=False):
 		args, env = _get_7zip_args_env_windows(args)
-		super().__init__(args, cwd, env, startupinfo=self._get_startupinfo())
+		super().__init__(
+			args, cwd, env, binary=binary, startupinfo=self._get_startupinfo()
+		)
 	def _get_startupinfo(self):
 		from subprocess import STARTF_USESHOWWINDOW, SW_HIDE, STARTUPINFO
 		result = STARTUPINFO()
@@ -509,9 +1671,9 @@ def _get_7zip_args_env_windows(args):
 	return args, env
 
 class Popen7ZipUnix(Popen7Zip):
-	def __init__(self, args, cwd):
+	def __init__(self, args, cwd, binary=False):
 		env, encoding = _get_7zip_env_encoding_unix()
-		super().__init__(args, cwd, env, encoding=encoding)
+		super().__init__(args, cwd, env, encoding=encoding, binary=binary)
 
 def _get_7zip_env_encoding_unix():
 	# According to the README in its source code distribution, p7zip can
@@ -540,38 +1702,53 @@ class Run7ZipViaPty:
 	"""
 
 	class Stdout:
+
+		_CHUNK_SIZE = 4096
+		_CONTROL_CHARS = re.compile('([\b\n])')
+
 		def __init__(self, fd, encoding):
 			self._fd = fd
 			self._encoding = encoding
 			self._source = BufferedReader(FileIO(self._fd))
 		def __iter__(self):
-			buffer = b''
-			prev_len_delta = 0
-			curr_line = lambda: buffer.decode(self._encoding)
+			# Read as much as is available (up to _CHUNK_SIZE) at a time instead
+			# of byte by byte. The incremental decoder takes care of multi-byte
+			# characters that are split across chunks. The current line is kept
+			# as a list of characters so appending and deleting via '\b' are
+			# cheap. `last_op` records whether the last thing that happened to
+			# the line was that characters were appended (+1) or deleted (-1).
+			# When a '\b' follows an append, the line is complete and about to
+			# be overwritten. This is when we report it:
+			decoder = getincrementaldecoder(self._encoding)()
+			line = []
+			last_op = 0
 			while True:
 				try:
-					b = self._source.read(1)
+					chunk = self._source.read1(self._CHUNK_SIZE)
 				except OSError:
-					yield curr_line()
+					# This happens on Linux when the child closes the pty.
+					chunk = b''
+				text = decoder.decode(chunk, final=not chunk)
+				for part in self._CONTROL_CHARS.split(text):
+					if part == '\b':
+						if last_op == 1:
+							curr_line = ''.join(line)
+							if curr_line.strip():
+								yield curr_line
+						if line:
+							line.pop()
+						last_op = -1
+					elif part == '\n':
+						line.append(part)
+						yield ''.join(line)
+						line = []
+						last_op = 0
+					elif part:
+						line.extend(part)
+						last_op = 1
+				if not chunk:
+					yield ''.join(line)
 					break
-				if b == b'':
-					yield curr_line()
-					break
-				elif b == b'\b':
-					if prev_len_delta == 1:
-						l = curr_line()
-						if l.strip():
-							yield l
-					buffer = buffer[:-1]
-					prev_len_delta = -1
-				else:
-					buffer += b
-					if b == b'\n':
-						yield curr_line()
-						buffer = b''
-						prev_len_delta = 0
-					else:
-						prev_len_delta = 1
 		def close(self):
 			self._source.close()
 
@@ -628,15 +1805,540 @@ class Run7ZipViaWinpty:
 		return PtyProcess.spawn(argv, cwd, env)
 
 class ZipFileSystem(_7ZipFileSystem):
+
 	scheme = 'zip://'
 
+	def open_read(self, path):
+		# Python's zipfile can seek to the file directly. This is much faster
+		# than starting 7-Zip, which is only needed for formats zipfile does
+		# not support.
+		zip_path, path_in_zip = self._split(path)
+		self._flush_changes(zip_path, path_in_zip)
+		try:
+			zip_file = ZipFile(self._get_local_path(zip_path))
+		except (BadZipFile, OSError):
+			return super().open_read(path)
+		# The returned file stays usable after we close the ZipFile:
+		with zip_file:
+			try:
+				return zip_file.open(path_in_zip)
+			except (KeyError, NotImplementedError, RuntimeError):
+				# KeyError: The file doesn't exist or is a directory.
+				# NotImplementedError: Unsupported compression method.
+				# RuntimeError: The file is encrypted.
+				pass
+		return super().open_read(path)
+	def _partition_members(self, local_path, path_in_zip, num_partitions):
+		try:
+			with ZipFile(local_path) as zip_file:
+				infos = zip_file.infolist()
+		except (BadZipFile, OSError):
+			return None
+		for info in infos:
+			is_utf8 = info.flag_bits & _ZIP_FLAG_UTF8
+			if not is_utf8 and not _is_ascii(info.filename):
+				# 7-Zip may decode the name differently than Python.
+				return None
+		entries = [
+			(info.filename.rstrip('/'), info.is_dir(), info.compress_size)
+			for info in infos
+		]
+		return _partition_by_packed_size(entries, path_in_zip, num_partitions)
+	def _copy_directly(
+		self, src_zip_path, path_in_src_zip, dst_zip_path, path_in_dst_zip,
+		task
+	):
+		# Copy the compressed data of the entries from one Zip file to the
+		# other. This avoids decompressing, writing to disk and recompressing.
+		if src_zip_path == dst_zip_path or not is_zipfile(dst_zip_path):
+			return False
+		self._flush_changes(src_zip_path, path_in_src_zip)
+		self._flush_changes(dst_zip_path)
+		try:
+			src_zip = ZipFile(self._get_local_path(src_zip_path))
+		except (BadZipFile, OSError):
+			return False
+		with src_zip:
+			entries = []
+			for info in src_zip.infolist():
+				name = info.filename
+				if path_in_src_zip:
+					if name.rstrip('/') != path_in_src_zip and \
+						not name.startswith(path_in_src_zip + '/'):
+						continue
+					name = path_in_dst_zip + name[len(path_in_src_zip):]
+				else:
+					name = path_in_dst_zip + '/' + name
+				if info.flag_bits & _ZIP_FLAG_ENCRYPTED:
+					# The password check of encrypted entries depends on flag
+					# bits we need to change below.
+					return False
+				entries.append((info, name))
+			if not entries:
+				return False
+			with ZipFile(dst_zip_path, 'a') as dst_zip:
+				# Leave merging and overwriting to 7-Zip:
+				for name in dst_zip.NameToInfo:
+					if name.rstrip('/') == path_in_dst_zip or \
+						name.startswith(path_in_dst_zip + '/'):
+						return False
+				size_bytes = sum(info.compress_size for info, _ in entries)
+				bytes_written = 0
+				for info, name in entries:
+					copy_entry = _copy_zip_entry(src_zip, info, dst_zip, name)
+					for num_bytes in copy_entry:
+						task.check_canceled()
+						bytes_written += num_bytes
+						if size_bytes and task.get_size():
+							task.set_progress(
+								task.get_size() * bytes_written // size_bytes
+							)
+		self.notify_file_added(dst_zip_path + '/' + path_in_dst_zip)
+		return True
+	def _append_directly(self, zip_path, sources, task):
+		# Zip files have their table of contents at the end. So zipfile can
+		# append to them without touching the existing data.
+		compression = _get_zipfile_compression(self._compression_args)
+		if compression is None or not is_zipfile(zip_path):
+			return False
+		with ZipFile(zip_path, 'a', *compression) as zip_file:
+			if not zip_file.filelist:
+				# There is nothing to preserve, for instance because Pack just
+				# created the archive. 7-Zip compresses with several threads:
+				return False
+			if _would_replace(zip_file.namelist(), sources):
+				return False
+			num_entries = len(zip_file.filelist)
+			start_dir = zip_file.start_dir
+			try:
+				_add_files(zip_file.write, sources, task)
+			except BaseException as e:
+				# Make ZipFile write the original table of contents on close:
+				del zip_file.filelist[num_entries:]
+				zip_file.NameToInfo = \
+					{info.filename: info for info in zip_file.filelist}
+				zip_file.start_dir = start_dir
+				if isinstance(e, ValueError):
+					# "ZIP does not support timestamps before 1980". 7-Zip
+					# clamps such timestamps instead:
+					return False
+				raise
+		return True
+
+_PARALLEL_EXTRACTION_MIN_BYTES = 64 * 1024 * 1024
+
+def _partition_by_packed_size(entries, path_in_zip, num_partitions):
+	# `entries` are (path in archive, is_dir, packed size) tuples. Distribute
+	# the files below path_in_zip across at most `num_partitions` partitions,
+	# so that each contains about the same amount of compressed data.
+	files = {}
+	dirs = []
+	for path, is_dir, packed_size in entries:
+		if not _is_in(path, path_in_zip):
+			continue
+		if '*' in path or '?' in path:
+			# 7-Zip would interpret these as wildcards.
+			return None
+		if is_dir:
+			dirs.append(path)
+		else:
+			files[path] = packed_size or 0
+	if sum(files.values()) < _PARALLEL_EXTRACTION_MIN_BYTES:
+		# Starting several 7-Zip processes isn't worth it.
+		return None
+	num_partitions = min(num_partitions, len(files))
+	if num_partitions < 2:
+		return None
+	result = [[] for _ in range(num_partitions)]
+	# Assign the largest files first, each to the emptiest partition:
+	loads = [(0, i) for i in range(num_partitions)]
+	for path in sorted(files, key=files.get, reverse=True):
+		load, i = heappop(loads)
+		result[i].append(path)
+		heappush(loads, (load + files[path], i))
+	# Extracting a directory extracts all files in it. So only add directories
+	# to the list that would otherwise not be created because they're empty:
+	parents = set()
+	for path in chain(files, dirs):
+		while '/' in path:
+			path = path.rsplit('/', 1)[0]
+			parents.add(path)
+	result[0].extend(path for path in dirs if path not in parents)
+	return result
+
+def _is_ascii(text):
+	try:
+		text.encode('ascii')
+	except UnicodeEncodeError:
+		return False
+	return True
+
+def _get_zipfile_compression(compression_args):
+	# Translate 7-Zip's compression switches to arguments for ZipFile.
+	# Returns None if there are switches zipfile does not support.
+	level = 5
+	for arg in compression_args:
+		match = re.fullmatch('-mx=?([0-9])', arg)
+		if match:
+			level = int(match.group(1))
+		elif not arg.startswith('-mmt'):
+			return None
+	if level == 0:
+		return ZIP_STORED, True, None
+	return ZIP_DEFLATED, True, level
+
+_ZIP_FLAG_ENCRYPTED = 0x01
+_ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP_FLAG_UTF8 = 0x800
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+def _copy_zip_entry(src_zip, info, dst_zip, name):
+	# Python's zipfile has no public API for copying an entry without
+	# recompressing it. So we write the local file header and the compressed
+	# data ourselves, and then register the entry the way ZipFile.write(...)
+	# does. Yields the size of each chunk as it is copied.
+	src_zip.fp.seek(info.header_offset)
+	header = src_zip.fp.read(_ZIP_LOCAL_HEADER_SIZE)
+	if len(header) != _ZIP_LOCAL_HEADER_SIZE or header[:4] != b'PK\x03\x04':
+		raise BadZipFile('Bad local file header for ' + info.filename)
+	name_length, extra_length = struct.unpack('<HH', header[26:30])
+	src_zip.fp.seek(name_length + extra_length, os.SEEK_CUR)
+	new_info = copy(info)
+	new_info.filename = name
+	# The CRC and sizes are known, so we put them into the header instead of
+	# writing a data descriptor after the data:
+	new_info.flag_bits &= ~_ZIP_FLAG_DATA_DESCRIPTOR
+	# ZipInfo.FileHeader() adds its own Zip64 field if necessary:
+	new_info.extra = _strip_zip64_extra(info.extra)
+	new_info.header_offset = dst_zip.start_dir
+	# Tell ZipFile to rewrite the central directory on close. It does so at
+	# dst_zip.start_dir. So if we fail half way, the incomplete entry is
+	# overwritten and the archive stays consistent:
+	dst_zip._didModify = True
+	dst_zip.fp.seek(dst_zip.start_dir)
+	dst_zip.fp.write(new_info.FileHeader())
+	remaining = info.compress_size
+	while remaining:
+		chunk = src_zip.fp.read(min(remaining, 64 * 1024))
+		if not chunk:
+			raise BadZipFile('Truncated data for ' + info.filename)
+		dst_zip.fp.write(chunk)
+		remaining -= len(chunk)
+		yield len(chunk)
+	dst_zip.start_dir = dst_zip.fp.tell()
+	dst_zip.filelist.append(new_info)
+	dst_zip.NameToInfo[name] = new_info
+
+def _strip_zip64_extra(extra):
+	result = b''
+	while len(extra) >= 4:
+		header_id, length = struct.unpack('<HH', extra[:4])
+		if header_id != 0x0001:
+			result += extra[:4 + length]
+		extra = extra[4 + length:]
+	return result
+
 class SevenZipFileSystem(_7ZipFileSystem):
+
 	scheme = '7z://'
 
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._solid_blocks = _SolidBlockCache(_SOLID_BLOCK_CACHE_MAX_BYTES)
+	def _open_member(self, local_path, path_in_zip):
+		result = self._solid_blocks.open(local_path, path_in_zip)
+		if result is None:
+			result = super()._open_member(local_path, path_in_zip)
+		return result
+	def _partition_members(self, local_path, path_in_zip, num_partitions):
+		entries = []
+		is_solid = True
+		with _7zip(['l', '-slt', local_path], kill=True) as process:
+			# The archive's properties come first, then a line ---------- and
+			# the properties of each file:
+			lines = process.stdout_lines
+			for line in lines:
+				if line.startswith('Solid = '):
+					is_solid = line.rstrip('\r\n') != 'Solid = -'
+				elif line.startswith('----------'):
+					break
+			if is_solid:
+				# The files in a solid block can't be extracted separately.
+				return None
+			path = packed_size = None
+			for line in lines:
+				line = line.rstrip('\r\n')
+				if line.startswith('Path = '):
+					path = line[len('Path = '):].replace(os.sep, '/')
+				elif line.startswith('Packed Size = '):
+					packed_size = int(line[len('Packed Size = '):] or 0)
+				elif line.startswith('Attributes = '):
+					is_dir = line[len('Attributes = '):].startswith('D')
+					entries.append((path, is_dir, packed_size))
+		return _partition_by_packed_size(entries, path_in_zip, num_partitions)
+
+_SOLID_BLOCK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class _SolidBlockCache:
+	"""
+	To read a file from a solid block, 7-Zip has to decompress everything that
+	precedes it in the block. Reading several files from the same block thus
+	decompresses it again and again. This class instead extracts the entire
+	block to a temporary directory when a file is read from the archive again,
+	and serves its other files from there. (A single read is faster without
+	listing the blocks or extracting them.) The least recently used blocks are
+	deleted when their total size exceeds `max_size_bytes` and no file in them
+	is open.
+	"""
+
+	_MAX_NUM_LAYOUTS = 16
+
+	def __init__(self, max_size_bytes):
+		self._max_size_bytes = max_size_bytes
+		self._dir = None
+		# Maps (archive fingerprint, block index) to (directory, size):
+		self._blocks = OrderedDict()
+		# Maps keys of self._blocks to the number of their open files:
+		self._num_readers = {}
+		# Maps archive fingerprints to the block index of each file, the
+		# files and total size of each block and the indices of the blocks
+		# that were read before:
+		self._layouts = OrderedDict()
+		# Maps fingerprints of archives whose layout we did not list yet to
+		# the file that was read from them:
+		self._first_reads = OrderedDict()
+		self._lock = Lock()
+	def open(self, local_path, path_in_zip):
+		"""
+		Return a binary file object for the given file in the archive, or None
+		if the file is not part of a solid block that can be cached.
+		"""
+		stat = os.stat(local_path)
+		fingerprint = (local_path, stat.st_size, stat.st_mtime_ns)
+		layout = self._get_layout(fingerprint, path_in_zip)
+		if layout is None:
+			return None
+		block_of_file, blocks, blocks_read = layout
+		try:
+			block = block_of_file[path_in_zip]
+		except KeyError:
+			return None
+		paths, size_bytes = blocks[block]
+		if len(paths) < 2 or size_bytes > self._max_size_bytes:
+			return None
+		key = (fingerprint, block)
+		with self._lock:
+			if key in self._blocks:
+				block_dir = self._acquire(key)
+			elif block in blocks_read:
+				block_dir = None
+			else:
+				blocks_read.add(block)
+				return None
+		if block_dir is None:
+			new_dir = self._extract(local_path, paths)
+			with self._lock:
+				if key in self._blocks:
+					# Another thread was faster:
+					shutil.rmtree(new_dir, ignore_errors=True)
+				else:
+					self._blocks[key] = (new_dir, size_bytes)
+				block_dir = self._acquire(key)
+				self._evict()
+		file_path = join(block_dir, *path_in_zip.split('/'))
+		try:
+			return BufferedReader(
+				_CachedFile(file_path, lambda: self._release(key))
+			)
+		except BaseException:
+			self._release(key)
+			raise
+	def _acquire(self, key):
+		self._blocks.move_to_end(key)
+		self._num_readers[key] = self._num_readers.get(key, 0) + 1
+		return self._blocks[key][0]
+	def _release(self, key):
+		with self._lock:
+			self._num_readers[key] -= 1
+			if not self._num_readers[key]:
+				del self._num_readers[key]
+				# The block may have been kept only because it was in use:
+				self._evict()
+	def _get_layout(self, fingerprint, path_in_zip):
+		# Listing the archive's layout takes an extra 7-Zip invocation. A
+		# single read is served without the cache anyway. So we return None
+		# for the first read from an archive, and only list it when it is
+		# read from again:
+		with self._lock:
+			try:
+				self._layouts.move_to_end(fingerprint)
+				return self._layouts[fingerprint]
+			except KeyError:
+				pass
+			first_read = self._first_reads.pop(fingerprint, None)
+			if first_read is None:
+				self._first_reads[fingerprint] = path_in_zip
+				while len(self._first_reads) > self._MAX_NUM_LAYOUTS:
+					self._first_reads.popitem(last=False)
+				return None
+		block_of_file, blocks = self._read_layout(fingerprint[0])
+		blocks_read = set()
+		if first_read in block_of_file:
+			blocks_read.add(block_of_file[first_read])
+		result = block_of_file, blocks, blocks_read
+		with self._lock:
+			self._layouts[fingerprint] = result
+			while len(self._layouts) > self._MAX_NUM_LAYOUTS:
+				self._layouts.popitem(last=False)
+		return result
+	def _read_layout(self, local_path):
+		block_of_file = {}
+		blocks = {}
+		with _7zip(['l', '-ba', '-slt', local_path], kill=True) as process:
+			path = size = None
+			for line in process.stdout_lines:
+				line = line.rstrip('\r\n')
+				if line.startswith('Path = '):
+					path = line[len('Path = '):].replace(os.sep, '/')
+					size = 0
+				elif line.startswith('Size = '):
+					size = int(line[len('Size = '):] or 0)
+				elif line.startswith('Block = ') and line != 'Block = ':
+					if '*' in path or '?' in path:
+						# 7-Zip would interpret these as wildcards.
+						continue
+					block = int(line[len('Block = '):])
+					block_of_file[path] = block
+					paths, size_bytes = blocks.get(block, ([], 0))
+					paths.append(path)
+					blocks[block] = (paths, size_bytes + size)
+		return block_of_file, blocks
+	def _extract(self, local_path, paths):
+		with self._lock:
+			if self._dir is None:
+				self._dir = TemporaryDirectory(prefix='fman-')
+		result = mkdtemp(dir=self._dir.name)
+		list_file = result + '.txt'
+		try:
+			with open(list_file, 'w', encoding='utf-8') as f:
+				for path in paths:
+					f.write(path + '\n')
+			_run_7zip([
+				'x', '-o' + result, '-scsUTF-8', local_path, '@' + list_file
+			])
+		except BaseException:
+			shutil.rmtree(result, ignore_errors=True)
+			raise
+		finally:
+			os.remove(list_file)
+		return result
+	def _evict(self):
+		total_size = sum(size for _, size in self._blocks.values())
+		for key in list(self._blocks):
+			if total_size <= self._max_size_bytes:
+				break
+			if key in self._num_readers:
+				# Don't delete files that are still open.
+				continue
+			block_dir, size = self._blocks.pop(key)
+			total_size -= size
+			shutil.rmtree(block_dir, ignore_errors=True)
+
+class _CachedFile(FileIO):
+	"""
+	A file in a block extracted by _SolidBlockCache. Calls `on_close` when it
+	is closed, so the cache knows the block is no longer in use.
+	"""
+	def __init__(self, path, on_close):
+		super().__init__(path)
+		self._on_close = on_close
+	def close(self):
+		# The attribute is missing if __init__(...) failed:
+		on_close = getattr(self, '_on_close', None)
+		self._on_close = None
+		try:
+			super().close()
+		finally:
+			if on_close is not None:
+				on_close()
+
 class TarFileSystem(_7ZipFileSystem):
+
 	scheme = 'tar://'
 
-_FileInfo = namedtuple('_FileInfo', ('path', 'is_dir', 'size_bytes', 'mtime'))
+	def _append_directly(self, zip_path, sources, task):
+		# Uncompressed tar files end with two empty blocks. tarfile can
+		# overwrite them with new files.
+		try:
+			tar = tarfile.open(zip_path, 'a', dereference=True)
+		except (tarfile.TarError, OSError):
+			return False
+		with tar:
+			names = []
+			for name in tar.getnames():
+				if name.startswith('./'):
+					name = name[2:]
+				names.append(name)
+			if _would_replace(names, sources):
+				return False
+			num_members = len(tar.members)
+			offset = tar.offset
+			def add(ospath, name):
+				tar.add(ospath, name, recursive=False)
+			try:
+				_add_files(add, sources, task)
+			except BaseException:
+				# Remove the files we added:
+				del tar.members[num_members:]
+				tar.offset = offset
+				tar.fileobj.seek(offset)
+				tar.fileobj.truncate()
+				raise
+		return True
+
+def _would_replace(names_in_archive, sources):
+	for name in names_in_archive:
+		name = name.rstrip('/')
+		for _, path_in_zip in sources:
+			if _is_in(name, path_in_zip):
+				return True
+	return False
+
+def _add_files(add_fn, sources, task):
+	# Add the given files and directories, including their contents, via
+	# add_fn(src_ospath, path_in_zip).
+	size_bytes = sum(_get_size_bytes(ospath) for ospath, _ in sources)
+	bytes_added = 0
+	for src_ospath, path_in_zip in sources:
+		for ospath, name in _walk(src_ospath, path_in_zip):
+			task.check_canceled()
+			add_fn(ospath, name)
+			if not os.path.isdir(ospath):
+				bytes_added += os.path.getsize(ospath)
+				if size_bytes and task.get_size():
+					task.set_progress(
+						task.get_size() * bytes_added // size_bytes
+					)
+
+def _walk(src_ospath, path_in_zip):
+	yield src_ospath, path_in_zip
+	if not os.path.isdir(src_ospath):
+		return
+	walk = os.walk(src_ospath, followlinks=True)
+	for dir_path, dir_names, file_names in walk:
+		rel_path = os.path.relpath(dir_path, src_ospath)
+		if rel_path == os.curdir:
+			prefix = path_in_zip
+		else:
+			prefix = path_in_zip + '/' + rel_path.replace(os.sep, '/')
+		for name in dir_names + file_names:
+			yield os.path.join(dir_path, name), prefix + '/' + name
+
+# `crc` is the CRC32 of the file's contents, or None if the archive format
+# does not store it:
+_FileInfo = namedtuple(
+	'_FileInfo', ('path', 'is_dir', 'size_bytes', 'mtime', 'mode', 'crc')
+)
 
 class SourceClosingTextIOWrapper(TextIOWrapper):
 	def close(self):
@@ -2,6 +2,7 @@ from core import LocalFileSystem
 from fman import Task
 from fman.fs import FileSystem
 from fman.url import splitscheme, basename
+from io import UnsupportedOperation
 
 class StubUI:
 	def __init__(self, test_case):
@@ -52,6 +53,9 @@ class StubFS(FileSystem):
 	def exists(self, url):
 		scheme, path = splitscheme(url)
 		return self._backends[scheme].exists(path)
+	def resolve(self, url):
+		scheme, path = splitscheme(url)
+		return self._backends[scheme].resolve(path)
 	def samefile(self, url1, url2):
 		scheme1, path1 = splitscheme(url1)
 		scheme2, path2 = splitscheme(url2)
@@ -67,6 +71,17 @@ class StubFS(FileSystem):
 	def copy(self, src_url, dst_url):
 		scheme = splitscheme(src_url)[0]
 		self._backends[scheme].copy(src_url, dst_url)
+	def prepare_copy(self, src_url, dst_url):
+		# Like fman, let the destination's file system handle the copy if the
+		# source's file system doesn't support it:
+		src_scheme = splitscheme(src_url)[0]
+		dst_scheme = splitscheme(dst_url)[0]
+		try:
+			return self._backends[src_scheme].prepare_copy(src_url, dst_url)
+		except UnsupportedOperation:
+			if dst_scheme == src_scheme:
+				raise
+		return self._backends[dst_scheme].prepare_copy(src_url, dst_url)
 	def delete(self, url):
 		scheme, path = splitscheme(url)
 		self._backends[scheme].delete(path)
@@ -79,6 +94,9 @@ class StubFS(FileSystem):
 	def mkdir(self, url):
 		scheme, path = splitscheme(url)
 		self._backends[scheme].mkdir(path)
+	def notify_file_added(self, url):
+		scheme, path = splitscheme(url)
+		self._backends[scheme].notify_file_added(path)
 	def query(self, url, fs_method_name):
 		scheme, path = splitscheme(url)
 		return getattr(self._backends[scheme], fs_method_name)(path)
\ No newline at end of file
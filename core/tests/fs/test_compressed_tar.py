@@ -0,0 +1,73 @@
+from core.fs.compressed_tar import CompressedTarFileSystem, TarIndex
+from core.tests import StubFS
+from fman.url import as_url
+from io import UnsupportedOperation
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import os
+import os.path
+import tarfile
+
+class CompressedTarFileSystemTest(TestCase):
+	def test_iterdir(self):
+		self.assertEqual({'dir'}, set(self._fs.iterdir(self._path(''))))
+		self.assertEqual(
+			{'a.txt', 'big.bin', 'sub'},
+			set(self._fs.iterdir(self._path('dir')))
+		)
+	def test_is_dir(self):
+		self.assertTrue(self._fs.is_dir(self._path('dir/sub')))
+		self.assertFalse(self._fs.is_dir(self._path('dir/a.txt')))
+	def test_size_bytes(self):
+		self.assertEqual(1, self._fs.size_bytes(self._path('dir/a.txt')))
+	def test_open_read(self):
+		with self._fs.open_read(self._path('dir/sub/z.txt')) as f:
+			self.assertEqual(b'zzz', f.read())
+	def test_extract_file(self):
+		dst = os.path.join(self._tmp_dir.name, 'z.txt')
+		self._fs.copy(self._url('dir/sub/z.txt'), as_url(dst))
+		self.assertEqual('zzz', Path(dst).read_text())
+	def test_extract_directory(self):
+		dst = os.path.join(self._tmp_dir.name, 'extracted')
+		self._fs.copy(self._url('dir'), as_url(dst))
+		self.assertEqual(
+			{'a.txt', 'big.bin', 'sub'}, set(os.listdir(dst))
+		)
+		self.assertEqual('zzz', Path(dst, 'sub', 'z.txt').read_text())
+	def test_read_only(self):
+		with self.assertRaises(UnsupportedOperation):
+			self._fs.delete(self._path('dir/a.txt'))
+	def test_index_resumes_from_checkpoint(self):
+		index = TarIndex(self._tar, checkpoint_interval=64 * 1024)
+		self.assertTrue(index._checkpoints)
+		with index.open('dir/sub/z.txt') as f:
+			self.assertEqual(b'zzz', f.read())
+		with index.open('dir/big.bin') as f:
+			self.assertEqual(self._big_data, f.read())
+	def setUp(self):
+		super().setUp()
+		fman_fs = StubFS()
+		self._fs = CompressedTarFileSystem(fman_fs, {'.tar.gz'})
+		fman_fs.add_child(self._fs)
+		self._tmp_dir = TemporaryDirectory()
+		src_dir = os.path.join(self._tmp_dir.name, 'src')
+		os.makedirs(os.path.join(src_dir, 'sub'))
+		Path(src_dir, 'a.txt').write_text('a')
+		self._big_data = bytes(range(256)) * 4096
+		Path(src_dir, 'big.bin').write_bytes(self._big_data)
+		Path(src_dir, 'sub', 'z.txt').write_text('zzz')
+		self._tar = os.path.join(self._tmp_dir.name, 'test.tar.gz')
+		with tarfile.open(self._tar, 'w:gz') as tar_file:
+			tar_file.add(src_dir, 'dir')
+	def tearDown(self):
+		self._tmp_dir.cleanup()
+		super().tearDown()
+	def _url(self, path_in_tar):
+		return self._fs.scheme + self._path(path_in_tar)
+	def _path(self, path_in_tar):
+		result = self._tar.replace(os.sep, '/')
+		if path_in_tar:
+			result += '/' + path_in_tar
+		return result
\ No newline at end of file
@@ -1,18 +1,31 @@
 from errno import ENOENT
-from core.fs.zip import ZipFileSystem
+from core.fs.zip import ZipFileSystem, TarFileSystem, SevenZipFileSystem, \
+	Run7ZipViaPty, combine_additions, combine_extractions, \
+	archive_transaction, CheckArchives, BatchExtract, BatchPack, \
+	AddManyToArchive, CopyBetweenArchives, _SolidBlockCache, \
+	_partition_by_packed_size, _run_7zip
 from core.tests import StubFS
-from datetime import date
+from datetime import date, datetime
+from fman import Task
 from fman.url import as_url, join, as_human_readable, splitscheme
+from importlib import import_module
+from io import UnsupportedOperation
 from os import listdir
 from pathlib import Path
 from shutil import copyfile
 from tempfile import TemporaryDirectory
+from threading import Thread
 from unicodedata import normalize
 from unittest import TestCase
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 
 import os
 import os.path
+import struct
+import tarfile
+
+# core.fs.zip is shadowed by a function of the same name in core.fs:
+zip_module = import_module('core.fs.zip')
 
 class ZipFileSystemTest(TestCase):
 	def test_iterdir(self):
@@ -92,10 +105,113 @@ class ZipFileSystemTest(TestCase):
 			expected_contents = self._get_zip_contents(path_in_zip=file_path)
 			with open(dest_path) as f:
 				self.assertEqual(expected_contents, f.read())
+	def test_extract_file_preserves_mtime(self):
+		with TemporaryDirectory() as tmp_dir:
+			dest_path = os.path.join(tmp_dir, 'file.txt')
+			self._fs.copy(self._url('ZipFileTest/file.txt'), as_url(dest_path))
+			mtime = datetime.fromtimestamp(os.stat(dest_path).st_mtime)
+			# Compare by date only because the time depends on the time zone:
+			self.assertEqual(date(2017, 11, 8), mtime.date())
+	def test_extract_file_overwrite(self):
+		with TemporaryDirectory() as tmp_dir:
+			file_path = 'ZipFileTest/file.txt'
+			dest_path = os.path.join(tmp_dir, 'file.txt')
+			with open(dest_path, 'w') as f:
+				f.write('to be overwritten')
+			unrelated_path = dest_path + '.tmp'
+			with open(unrelated_path, 'w') as f:
+				f.write('unrelated')
+			self._fs.copy(self._url(file_path), as_url(dest_path))
+			self.assertEqual(
+				['file.txt', 'file.txt.tmp'], sorted(listdir(tmp_dir))
+			)
+			self.assertEqual('unrelated', Path(unrelated_path).read_text())
+			expected_contents = self._get_zip_contents(path_in_zip=file_path)
+			with open(dest_path) as f:
+				self.assertEqual(expected_contents, f.read())
+	def test_extract_several_files_in_one_go(self):
+		file_paths = ['ZipFileTest/file.txt', 'ZipFileTest/Directory']
+		with TemporaryDirectory() as tmp_dir:
+			dest_paths = [
+				os.path.join(tmp_dir, 'file.txt'),
+				os.path.join(tmp_dir, 'Directory')
+			]
+			tasks = []
+			for file_path, dest_path in zip(file_paths, dest_paths):
+				src_url = self._url(file_path)
+				tasks.extend(self._fs.prepare_copy(src_url, as_url(dest_path)))
+			tasks = combine_extractions(tasks)
+			self.assertEqual(1, len(tasks))
+			tasks[0]()
+			self.assertEqual(
+				self._get_zip_contents(path_in_zip='ZipFileTest/file.txt'),
+				Path(dest_paths[0]).read_text()
+			)
+			self.assertEqual(
+				self._get_zip_contents(path_in_zip='ZipFileTest/Directory'),
+				self._read_directory(dest_paths[1])
+			)
 	def test_extract_nonexistent(self):
 		with self.assertRaises(FileNotFoundError):
 			with TemporaryDirectory() as tmp_dir:
 				self._fs.copy(self._url('nonexistent'), as_url(tmp_dir))
+	def test_extract_canceled(self):
+		with TemporaryDirectory() as tmp_dir:
+			dst_dir = os.path.join(tmp_dir, 'dest')
+			task, = self._fs.prepare_copy(self._url(''), as_url(dst_dir))
+			def check_canceled():
+				raise Task.Canceled()
+			task.check_canceled = check_canceled
+			with self.assertRaises(Task.Canceled):
+				task()
+			self.assertEqual([], listdir(tmp_dir))
+	def test_open_read(self):
+		file_path = 'ZipFileTest/Directory/file 2.txt'
+		expected_contents = self._get_zip_contents(path_in_zip=file_path)
+		with self._fs.open_read(self._path(file_path)) as f:
+			self.assertEqual(expected_contents, f.read().decode('utf-8'))
+	def test_open_read_directory(self):
+		with self.assertRaises(IsADirectoryError):
+			self._fs.open_read(self._path('ZipFileTest/Directory'))
+	def test_open_read_nonexistent(self):
+		with self.assertRaises(FileNotFoundError):
+			self._fs.open_read(self._path('nonexistent'))
+	def test_nested_archive(self):
+		inner_zip = os.path.join(self._tmp_dir.name, 'inner.zip')
+		with ZipFile(inner_zip, 'w') as zip_file:
+			zip_file.writestr('dir/file.txt', 'nested!')
+		outer_zip = os.path.join(self._tmp_dir.name, 'outer.zip')
+		with ZipFile(outer_zip, 'w') as zip_file:
+			zip_file.write(inner_zip, 'archives/inner.zip')
+		inner_path = self._path('archives/inner.zip', outer_zip)
+		self.assertFalse(self._fs.is_dir(inner_path))
+		self.assertEqual(['dir'], list(self._fs.iterdir(inner_path)))
+		file_path = inner_path + '/dir/file.txt'
+		self.assertFalse(self._fs.is_dir(file_path))
+		self.assertEqual(7, self._fs.size_bytes(file_path))
+		with self._fs.open_read(file_path) as f:
+			self.assertEqual(b'nested!', f.read())
+		dst = os.path.join(self._tmp_dir.name, 'file.txt')
+		self._fs.copy(as_url(file_path, 'zip://'), as_url(dst))
+		self.assertEqual('nested!', Path(dst).read_text())
+		with self.assertRaises(UnsupportedOperation):
+			self._fs.delete(file_path)
+		# The nested archive itself is a file in the outer archive:
+		inner_copy = os.path.join(self._tmp_dir.name, 'inner copy.zip')
+		self._fs.copy(as_url(inner_path, 'zip://'), as_url(inner_copy))
+		self.assertEqual(
+			Path(inner_zip).read_bytes(), Path(inner_copy).read_bytes()
+		)
+		renamed = self._path('archives/renamed.zip', outer_zip)
+		self._fs.move(
+			as_url(inner_path, 'zip://'), as_url(renamed, 'zip://')
+		)
+		self.assertEqual(
+			['renamed.zip'],
+			list(self._fs.iterdir(self._path('archives', outer_zip)))
+		)
+		self._fs.delete(renamed)
+		self.assertFalse(self._fs.exists(renamed))
 	def test_add_file(self):
 		with TemporaryDirectory() as tmp_dir:
 			file_to_add = os.path.join(tmp_dir, 'tmp.txt')
@@ -121,6 +237,105 @@ class ZipFileSystemTest(TestCase):
 					join(as_url(zip_path, 'zip://'), 'ZipFileTest')
 				)
 				self._expect_zip_contents(self._get_zip_contents(), zip_path)
+	def test_add_several_files_at_once(self):
+		with TemporaryDirectory() as tmp_dir:
+			src_dir = os.path.join(tmp_dir, 'src')
+			os.mkdir(src_dir)
+			names = ('a.txt', 'b.txt', 'ça va.txt')
+			for name in names:
+				with open(os.path.join(src_dir, name), 'w') as f:
+					f.write(name)
+			zip_path = os.path.join(tmp_dir, 'test.zip')
+			self._create_empty_zip(zip_path)
+			zip_url = as_url(zip_path, 'zip://')
+			tasks = []
+			for name in names:
+				src_url = as_url(os.path.join(src_dir, name))
+				dst_url = join(zip_url, name)
+				tasks.extend(self._fs.prepare_copy(src_url, dst_url))
+			tasks = combine_additions(tasks)
+			self.assertEqual(1, len(tasks))
+			tasks[0]()
+			self._expect_zip_contents(
+				{name: name for name in names}, zip_path
+			)
+	def test_add_files_from_several_directories(self):
+		self._test_add_files_from_several_directories(lambda task: task())
+	def test_add_files_in_place(self):
+		# The route taken when symlinks can't be created for staging:
+		def add_in_place(task):
+			with TemporaryDirectory() as tmp_dir:
+				task._add_in_place(tmp_dir, *task._plan_adding_in_place())
+		self._test_add_files_from_several_directories(add_in_place)
+	def _test_add_files_from_several_directories(self, add):
+		with TemporaryDirectory() as tmp_dir:
+			for path in ('src/dir/a.txt', 'src/b.txt', 'other/c.txt'):
+				path = Path(tmp_dir, *path.split('/'))
+				path.parent.mkdir(parents=True, exist_ok=True)
+				path.write_text(path.name)
+			zip_path = os.path.join(tmp_dir, 'test.zip')
+			with ZipFile(zip_path, 'w') as zip_file:
+				zip_file.writestr('b.txt', 'existing')
+			fman_fs = StubFS()
+			# zipfile doesn't support these arguments, so 7-Zip adds the files:
+			zip_fs = ZipFileSystem(fman_fs, {'.zip'}, ['-mm=Deflate'])
+			fman_fs.add_child(zip_fs)
+			task = AddManyToArchive(zip_fs, fman_fs, [
+				(os.path.join(tmp_dir, 'src', 'dir'), 'dir'),
+				(os.path.join(tmp_dir, 'other', 'c.txt'), 'sub/c.txt')
+			], zip_path)
+			add(task)
+			self._expect_zip_contents({
+				'b.txt': 'existing', 'dir': {'a.txt': 'a.txt'},
+				'sub': {'c.txt': 'c.txt'}
+			}, zip_path)
+	def test_add_file_compression_args(self):
+		with TemporaryDirectory() as tmp_dir:
+			file_to_add = os.path.join(tmp_dir, 'tmp.txt')
+			with open(file_to_add, 'w') as f:
+				f.write('a' * 10000)
+			zip_path = os.path.join(tmp_dir, 'test.zip')
+			self._create_empty_zip(zip_path)
+			fman_fs = StubFS()
+			zip_fs = ZipFileSystem(fman_fs, {'.zip'}, ['-mx=0'])
+			fman_fs.add_child(zip_fs)
+			dest_url = join(as_url(zip_path, 'zip://'), 'tmp.txt')
+			zip_fs.copy(as_url(file_to_add), dest_url)
+			with ZipFile(zip_path) as zip_file:
+				info, = zip_file.infolist()
+				self.assertEqual(ZIP_STORED, info.compress_type)
+	def test_add_file_appends_in_place(self):
+		with TemporaryDirectory() as tmp_dir:
+			zip_path = os.path.join(tmp_dir, 'test.zip')
+			with ZipFile(zip_path, 'w', ZIP_DEFLATED) as zip_file:
+				zip_file.writestr('existing.txt', 'existing' * 1000)
+				data_size = zip_file.start_dir
+			data_before = Path(zip_path).read_bytes()[:data_size]
+			file_to_add = os.path.join(tmp_dir, 'added.txt')
+			Path(file_to_add).write_text('added!')
+			dest_url = join(as_url(zip_path, 'zip://'), 'dir/added.txt')
+			self._fs.copy(as_url(file_to_add), dest_url)
+			self.assertEqual(
+				data_before, Path(zip_path).read_bytes()[:data_size]
+			)
+			with ZipFile(zip_path) as zip_file:
+				self.assertIsNone(zip_file.testzip())
+				self.assertEqual(b'added!', zip_file.read('dir/added.txt'))
+	def test_add_file_from_before_1980(self):
+		with TemporaryDirectory() as tmp_dir:
+			zip_path = os.path.join(tmp_dir, 'test.zip')
+			with ZipFile(zip_path, 'w') as zip_file:
+				zip_file.writestr('existing.txt', 'existing')
+			file_to_add = os.path.join(tmp_dir, 'old.txt')
+			Path(file_to_add).write_text('old')
+			os.utime(file_to_add, (0, 0))
+			dest_url = join(as_url(zip_path, 'zip://'), 'old.txt')
+			self._fs.copy(as_url(file_to_add), dest_url)
+			with ZipFile(zip_path) as zip_file:
+				self.assertEqual(
+					['existing.txt', 'old.txt'], sorted(zip_file.namelist())
+				)
+				self.assertEqual(b'old', zip_file.read('old.txt'))
 	def test_replace_file(self):
 		with TemporaryDirectory() as tmp_dir:
 			zip_path = os.path.join(tmp_dir, 'test.zip')
@@ -180,6 +395,64 @@ class ZipFileSystemTest(TestCase):
 		self._test_delete('ZipFileTest/Empty directory')
 	def test_delete_main_directory(self):
 		self._test_delete('ZipFileTest')
+	def test_delete_in_transaction(self):
+		file_1 = 'ZipFileTest/file.txt'
+		file_2 = 'ZipFileTest/Directory/file 2.txt'
+		file_3 = 'ZipFileTest/Directory/Subdirectory/file 3.txt'
+		expected_contents = self._get_zip_contents()
+		for path in (file_1, file_2, file_3):
+			self._pop_from_dir_dict(expected_contents, path)
+		contents_before = self._get_zip_contents()
+		with archive_transaction():
+			self._fs.delete(self._path(file_1))
+			self._fs.delete(self._path(file_2))
+			# The changes are only applied at the end of the transaction:
+			self.assertEqual(contents_before, self._get_zip_contents())
+			self._fs.delete(self._path(file_3))
+			# ... unless we access a file they affect:
+			self.assertFalse(self._fs.exists(self._path(file_3)))
+		self.assertEqual(expected_contents, self._get_zip_contents())
+	def test_open_read_in_transaction(self):
+		file_path = 'ZipFileTest/file.txt'
+		with archive_transaction():
+			self._fs.delete(self._path(file_path))
+			# Reading the file applies its pending deletion:
+			with self.assertRaises(FileNotFoundError):
+				self._fs.open_read(self._path(file_path))
+	def test_transaction_not_applied_on_error(self):
+		contents_before = self._get_zip_contents()
+		task = _RecordingTask('Deleting file.txt')
+		with self.assertRaises(KeyboardInterrupt):
+			with archive_transaction(task):
+				self._fs.delete(self._path('ZipFileTest/file.txt'))
+				raise KeyboardInterrupt()
+		self.assertEqual(contents_before, self._get_zip_contents())
+		# The user is told that the archive was left unchanged:
+		self.assertEqual(1, len(task.alerts))
+		self.assertIn(self._path(''), task.alerts[0])
+	def test_transaction_applied_in_subtask(self):
+		file_path = 'ZipFileTest/file.txt'
+		task = _RecordingTask('Deleting file.txt')
+		with archive_transaction(task):
+			self._fs.delete(self._path(file_path))
+		self.assertEqual(
+			['Updating ' + os.path.basename(self._zip)], task.subtasks
+		)
+		self.assertEqual([], task.alerts)
+		self.assertFalse(self._fs.exists(self._path(file_path)))
+	def test_join_transaction_from_other_thread(self):
+		file_path = 'ZipFileTest/file.txt'
+		exists_in_thread = []
+		def check_exists(transaction):
+			with archive_transaction(join=transaction):
+				exists_in_thread.append(self._fs.exists(self._path(file_path)))
+		with archive_transaction() as transaction:
+			self._fs.delete(self._path(file_path))
+			thread = Thread(target=check_exists, args=(transaction,))
+			thread.start()
+			thread.join()
+		self.assertEqual([False], exists_in_thread)
+		self.assertFalse(self._fs.exists(self._path(file_path)))
 	def test_delete_nonexistent(self):
 		with self.assertRaises(FileNotFoundError):
 			self._fs.delete(self._path('nonexistent'))
@@ -263,6 +536,29 @@ class ZipFileSystemTest(TestCase):
 		self.test_move_file_between_archives(
 			self._fs.copy, self._get_from_dir_dict
 		)
+	def test_copy_dir_between_archives_without_recompressing(self):
+		src_zip = os.path.join(self._tmp_dir.name, 'src.zip')
+		with ZipFile(src_zip, 'w', ZIP_DEFLATED) as zip_file:
+			zip_file.writestr('dir/a.txt', 'a' * 1000)
+			zip_file.writestr('dir/sub/b.txt', 'b' * 1000)
+			zip_file.writestr('other.txt', 'other')
+		dst_zip = os.path.join(self._tmp_dir.name, 'dst.zip')
+		with ZipFile(dst_zip, 'w') as zip_file:
+			zip_file.writestr('dummy.txt', 'dummy')
+		self._fs.copy(
+			as_url(self._path('dir', src_zip), 'zip://'),
+			as_url(self._path('copy', dst_zip), 'zip://')
+		)
+		with ZipFile(dst_zip) as zip_file:
+			self.assertIsNone(zip_file.testzip())
+			self.assertEqual(
+				['dummy.txt', 'copy/a.txt', 'copy/sub/b.txt'],
+				zip_file.namelist()
+			)
+			self.assertEqual(
+				ZIP_DEFLATED, zip_file.getinfo('copy/a.txt').compress_type
+			)
+			self.assertEqual(b'b' * 1000, zip_file.read('copy/sub/b.txt'))
 	def test_size_bytes_file(self):
 		file_path = 'ZipFileTest/Directory/Subdirectory/file 3.txt'
 		file_contents = self._get_zip_contents(path_in_zip=file_path)
@@ -305,6 +601,75 @@ class ZipFileSystemTest(TestCase):
 	def test_resolve_nonexistent_file(self):
 		with self.assertRaises(FileNotFoundError):
 			self._fs.resolve('non-existent')
+	def test_check_archives(self):
+		corrupt_zip = os.path.join(self._tmp_dir.name, 'corrupt.zip')
+		copyfile(self._zip, corrupt_zip)
+		with ZipFile(corrupt_zip) as zip_file:
+			info = next(i for i in zip_file.infolist() if i.file_size)
+			# Skip the local file header, whose length is at offset 26:
+			with open(corrupt_zip, 'rb') as f:
+				f.seek(info.header_offset + 26)
+				name_len, extra_len = struct.unpack('<HH', f.read(4))
+			data_offset = info.header_offset + 30 + name_len + extra_len
+		with open(corrupt_zip, 'r+b') as f:
+			f.seek(data_offset)
+			byte = f.read(1)
+			f.seek(data_offset)
+			f.write(bytes([byte[0] ^ 0xff]))
+		task = CheckArchives([self._zip, corrupt_zip])
+		alerts = []
+		task.show_alert = alerts.append
+		task()
+		self.assertIsNone(task.results[self._zip])
+		self.assertIsNotNone(task.results[corrupt_zip])
+		self.assertEqual(1, len(alerts))
+		self.assertIn('1 of 2 archives have errors', alerts[0])
+	def test_batch_extract(self):
+		missing_zip = os.path.join(self._tmp_dir.name, 'missing.zip')
+		dst_dirs = [
+			os.path.join(self._tmp_dir.name, name) for name in ('a', 'b')
+		]
+		items = [
+			(as_url(path, 'zip://'), as_url(dst_dir))
+			for path, dst_dir in zip((self._zip, missing_zip), dst_dirs)
+		]
+		fman_fs = StubFS()
+		fman_fs.add_child(ZipFileSystem(fman_fs, {'.zip'}))
+		task = BatchExtract(items, fman_fs)
+		alerts = []
+		task.show_alert = alerts.append
+		task()
+		self.assertIsNone(task.results[items[0]])
+		self.assertIsNotNone(task.results[items[1]])
+		self.assertEqual(['ZipFileTest'], listdir(dst_dirs[0]))
+		self.assertEqual(1, len(alerts))
+		self.assertIn('Could not extract 1 of 2 items', alerts[0])
+	def test_batch_pack(self):
+		src_dir = os.path.join(self._tmp_dir.name, 'dir')
+		os.mkdir(src_dir)
+		Path(src_dir, 'file.txt').write_text('contents')
+		src_file = os.path.join(self._tmp_dir.name, 'file.txt')
+		Path(src_file).write_text('contents')
+		archives = [
+			os.path.join(self._tmp_dir.name, name)
+			for name in ('dir.zip', 'file.zip')
+		]
+		items = [
+			(as_url(src), as_url(archive, 'zip://'))
+			for src, archive in zip((src_dir, src_file), archives)
+		]
+		fman_fs = StubFS()
+		fman_fs.add_child(ZipFileSystem(fman_fs, {'.zip'}))
+		task = BatchPack(items, fman_fs)
+		alerts = []
+		task.show_alert = alerts.append
+		task()
+		self.assertEqual([], alerts)
+		self.assertEqual([None, None], list(task.results.values()))
+		names = ('dir/file.txt', 'file.txt')
+		for archive, name in zip(archives, names):
+			with ZipFile(archive) as zip_file:
+				self.assertEqual(b'contents', zip_file.read(name))
 	def _expect_iterdir_result(self, path_in_zip, expected_contents):
 		full_path = self._path(path_in_zip)
 		# Consider ç: It can be encoded in Unicode as "latin small letter c
@@ -363,7 +728,7 @@ class ZipFileSystemTest(TestCase):
 	def setUp(self):
 		super().setUp()
 		fman_fs = StubFS()
-		self._fs = ZipFileSystem(fman_fs, {'.zip'})
+		self._fs = ZipFileSystem(fman_fs, {'.zip'}, ['-mx=5', '-mmt=on'])
 		fman_fs.add_child(self._fs)
 		self._tmp_dir = TemporaryDirectory()
 		self._zip = copyfile(
@@ -381,4 +746,210 @@ class ZipFileSystemTest(TestCase):
 		self.maxDiff = None
 	def tearDown(self):
 		self._tmp_dir.cleanup()
-		super().tearDown()
\ No newline at end of file
+		super().tearDown()
+
+class SevenZipFileSystemTest(TestCase):
+	def test_read_files_from_solid_block(self):
+		with TemporaryDirectory() as tmp_dir:
+			src_dir = os.path.join(tmp_dir, 'src')
+			os.mkdir(src_dir)
+			names = ('a.txt', 'b.txt', 'c.txt')
+			for name in names:
+				Path(src_dir, name).write_text(name * 1000)
+			archive = os.path.join(tmp_dir, 'test.7z')
+			_run_7zip(['a', '-ms=on', archive] + list(names), cwd=src_dir)
+			fs = SevenZipFileSystem(StubFS(), {'.7z'}, [])
+			archive_path = archive.replace(os.sep, '/')
+			commands = self._record_7zip_commands()
+			for name in reversed(names):
+				with fs.open_read(archive_path + '/' + name) as f:
+					self.assertEqual((name * 1000).encode('ascii'), f.read())
+			# The first read only streams the file. The second one extracts
+			# the block. The third is served from it:
+			extractions = [c for c in commands if c in ('e', 'x')]
+			self.assertEqual(['e', 'x'], extractions)
+	def test_solid_block_in_use_is_not_evicted(self):
+		with TemporaryDirectory() as tmp_dir:
+			names = ('a.txt', 'b.txt')
+			archives = []
+			for archive_name in ('1.7z', '2.7z'):
+				src_dir = os.path.join(tmp_dir, archive_name + '.src')
+				os.mkdir(src_dir)
+				for name in names:
+					Path(src_dir, name).write_text(name * 1000)
+				archive = os.path.join(tmp_dir, archive_name)
+				_run_7zip(['a', '-ms=on', archive] + list(names), cwd=src_dir)
+				archives.append(archive)
+			# Only one of the two blocks fits into the cache:
+			cache = _SolidBlockCache(len(names) * 5000)
+			self.assertIsNone(cache.open(archives[0], 'a.txt'))
+			with cache.open(archives[0], 'b.txt') as f:
+				self.assertIsNone(cache.open(archives[1], 'a.txt'))
+				cache.open(archives[1], 'b.txt').close()
+				self.assertEqual(b'b.txt' * 1000, f.read())
+			commands = self._record_7zip_commands()
+			cache.open(archives[0], 'a.txt').close()
+			self.assertEqual([], commands)
+			cache.open(archives[1], 'a.txt').close()
+			self.assertEqual(['x'], commands)
+	def test_first_read_does_not_list_archive(self):
+		with TemporaryDirectory() as tmp_dir:
+			names = ('a.txt', 'b.txt')
+			for name in names:
+				Path(tmp_dir, name).write_text(name * 1000)
+			archive = os.path.join(tmp_dir, 'test.7z')
+			_run_7zip(['a', '-ms=on', archive] + list(names), cwd=tmp_dir)
+			cache = _SolidBlockCache(len(names) * 5000)
+			commands = self._record_7zip_commands()
+			self.assertIsNone(cache.open(archive, 'a.txt'))
+			self.assertEqual([], commands)
+			with cache.open(archive, 'b.txt') as f:
+				self.assertEqual(b'b.txt' * 1000, f.read())
+			self.assertEqual(['l', 'x'], commands)
+			with cache.open(archive, 'a.txt') as f:
+				self.assertEqual(b'a.txt' * 1000, f.read())
+			self.assertEqual(['l', 'x'], commands)
+	def _record_7zip_commands(self):
+		result = []
+		class Recording7zip(zip_module._7zip):
+			def __init__(self, args, *rest, **kwargs):
+				result.append(args[0])
+				super().__init__(args, *rest, **kwargs)
+		zip_module._7zip = Recording7zip
+		self.addCleanup(setattr, zip_module, '_7zip', Recording7zip.__base__)
+		return result
+
+class TarFileSystemTest(TestCase):
+	def test_open_read(self):
+		contents = b'0123456789' * 100000
+		with TemporaryDirectory() as tmp_dir:
+			tar_path = os.path.join(tmp_dir, 'test.tar')
+			file_path = os.path.join(tmp_dir, 'file.bin')
+			with open(file_path, 'wb') as f:
+				f.write(contents)
+			with tarfile.open(tar_path, 'w') as tar:
+				tar.add(file_path, 'file.bin')
+			fs = TarFileSystem(StubFS(), {'.tar'}, [])
+			path = tar_path.replace(os.sep, '/') + '/file.bin'
+			with fs.open_read(path) as f:
+				self.assertEqual(contents[:1024], f.read(1024))
+			with fs.open_read(path) as f:
+				self.assertEqual(contents, f.read())
+	def test_copy_between_archives_in_batches(self):
+		with TemporaryDirectory() as tmp_dir:
+			src_tar = os.path.join(tmp_dir, 'src.tar')
+			dst_tar = os.path.join(tmp_dir, 'dst.tar')
+			src_dir = os.path.join(tmp_dir, 'dir')
+			os.makedirs(os.path.join(src_dir, 'sub'))
+			contents = {'a.txt': 'a' * 10, 'b.txt': 'b' * 10, 'sub/c.txt': 'c'}
+			for path, text in contents.items():
+				Path(src_dir, path).write_text(text)
+			with tarfile.open(src_tar, 'w') as tar:
+				tar.add(src_dir, 'dir')
+			with tarfile.open(dst_tar, 'w') as tar:
+				tar.add(os.path.join(src_dir, 'sub', 'c.txt'), 'dummy.txt')
+			fman_fs = StubFS()
+			fs = TarFileSystem(fman_fs, {'.tar'}, [])
+			# Force several batches. The first one has two files:
+			task = CopyBetweenArchives(
+				fs, fman_fs, src_tar.replace(os.sep, '/'), 'dir',
+				dst_tar.replace(os.sep, '/'), 'copy', staging_limit_bytes=20
+			)
+			task()
+			with tarfile.open(dst_tar) as tar:
+				names = {member.name for member in tar if member.isfile()}
+				self.assertEqual(
+					{'dummy.txt', 'copy/a.txt', 'copy/b.txt', 'copy/sub/c.txt'},
+					names
+				)
+				self.assertEqual(
+					b'b' * 10, tar.extractfile('copy/b.txt').read()
+				)
+	def test_check_archive(self):
+		with TemporaryDirectory() as tmp_dir:
+			tar_path = os.path.join(tmp_dir, 'test.tar')
+			src = os.path.join(tmp_dir, 'a.txt')
+			Path(src).write_text('a' * 1000)
+			with tarfile.open(tar_path, 'w') as tar:
+				tar.add(src, 'a.txt')
+			task = CheckArchives([tar_path])
+			alerts = []
+			task.show_alert = alerts.append
+			task()
+			self.assertEqual({tar_path: None}, dict(task.results))
+			self.assertEqual(['No errors were found.'], alerts)
+	def test_add_file_appends_in_place(self):
+		with TemporaryDirectory() as tmp_dir:
+			tar_path = os.path.join(tmp_dir, 'test.tar')
+			src_dir = os.path.join(tmp_dir, 'dir')
+			os.mkdir(src_dir)
+			Path(src_dir, 'a.txt').write_text('a')
+			with tarfile.open(tar_path, 'w') as tar:
+				tar.add(os.path.join(src_dir, 'a.txt'), 'existing.txt')
+				data_size = tar.offset
+			data_before = Path(tar_path).read_bytes()[:data_size]
+			fs = TarFileSystem(StubFS(), {'.tar'}, [])
+			dest_url = as_url(tar_path, 'tar://') + '/dir'
+			fs.copy(as_url(src_dir), dest_url)
+			self.assertEqual(
+				data_before, Path(tar_path).read_bytes()[:data_size]
+			)
+			with tarfile.open(tar_path) as tar:
+				self.assertEqual(
+					['existing.txt', 'dir', 'dir/a.txt'], tar.getnames()
+				)
+
+class Run7ZipViaPtyStdoutTest(TestCase):
+	def test_progress_lines(self):
+		output = (
+			' 41% + ça va.txt' + '\b' * 16 + ' ' * 16 + '\b' * 16 +
+			' 59% + ça va.txt\n' + 'Everything is Ok\n'
+		).encode('utf-8')
+		expected = \
+			[' 41% + ça va.txt', ' 59% + ça va.txt\n', 'Everything is Ok\n', '']
+		for chunk_size in (1, 3, 4096):
+			self.assertEqual(
+				expected, self._read_lines(output, chunk_size), chunk_size
+			)
+	def test_empty_output(self):
+		self.assertEqual([''], self._read_lines(b''))
+	def _read_lines(self, output, chunk_size=4096):
+		read_fd, write_fd = os.pipe()
+		os.write(write_fd, output)
+		os.close(write_fd)
+		class Stdout(Run7ZipViaPty.Stdout):
+			_CHUNK_SIZE = chunk_size
+		stdout = Stdout(read_fd, 'utf-8')
+		try:
+			return list(stdout)
+		finally:
+			stdout.close()
+
+class PartitionByPackedSizeTest(TestCase):
+	def test_balances_compressed_size(self):
+		mb = 1024 * 1024
+		entries = [
+			('d', True, 0), ('d/a', False, 60 * mb),
+			('d/b', False, 40 * mb), ('d/c', False, 30 * mb), ('d/e', True, 0),
+			('d/e/f', False, 30 * mb), ('d/empty', True, 0),
+			('other', False, 100 * mb)
+		]
+		# Only the empty directory needs to be extracted explicitly:
+		self.assertEqual(
+			[['d/a', 'd/e/f', 'd/empty'], ['d/b', 'd/c']],
+			_partition_by_packed_size(entries, 'd', 2)
+		)
+	def test_small_archive(self):
+		entries = [('a', False, 1000), ('b', False, 1000)]
+		self.assertIsNone(_partition_by_packed_size(entries, '', 2))
+
+class _RecordingTask(Task):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.alerts = []
+		self.subtasks = []
+	def show_alert(self, text, *args, **kwargs):
+		self.alerts.append(text)
+	def run(self, task):
+		self.subtasks.append(task.get_title())
+		return super().run(task)
\ No newline at end of file
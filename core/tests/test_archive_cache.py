@@ -0,0 +1,59 @@
+from core.archive_cache import ArchiveCache
+from core.fs.zip import ZipFileSystem
+from core.tests import StubFS
+from fman.url import as_url, join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from zipfile import ZipFile
+
+import os
+import os.path
+
+class ArchiveCacheTest(TestCase):
+	def test_miss_then_hit(self):
+		url = self._url('a.txt')
+		self.assertIsNone(self._cache.get(url))
+		path = self._cache.extract(url)
+		with open(path) as f:
+			self.assertEqual('a' * 100, f.read())
+		self.assertEqual('a.txt', os.path.basename(path))
+		self.assertEqual(path, self._cache.get(url))
+		self.assertEqual((1, 1), (self._cache.hits, self._cache.misses))
+	def test_persists(self):
+		url = self._url('a.txt')
+		path = self._cache.extract(url)
+		cache = ArchiveCache(self._cache_dir, 1000, self._fs)
+		self.assertEqual(path, cache.get(url))
+	def test_archive_modified(self):
+		url = self._url('a.txt')
+		self._cache.extract(url)
+		with ZipFile(self._zip, 'a') as zip_file:
+			zip_file.writestr('d.txt', 'd')
+		self.assertIsNone(self._cache.get(url))
+	def test_evicts_least_recently_used(self):
+		a, b, c = self._url('a.txt'), self._url('b.txt'), self._url('c.txt')
+		self._cache.extract(a)
+		self._cache.extract(b)
+		# Make a more recently used than b:
+		self._cache.get(a)
+		self._cache.extract(c)
+		self.assertIsNotNone(self._cache.get(a))
+		self.assertIsNone(self._cache.get(b))
+		self.assertIsNotNone(self._cache.get(c))
+	def _url(self, path_in_zip):
+		return join(as_url(self._zip, 'zip://'), path_in_zip)
+	def setUp(self):
+		super().setUp()
+		self._tmp_dir = TemporaryDirectory()
+		self._zip = os.path.join(self._tmp_dir.name, 'test.zip')
+		with ZipFile(self._zip, 'w') as zip_file:
+			for name in ('a', 'b', 'c'):
+				zip_file.writestr(name + '.txt', name * 100)
+		self._fs = StubFS()
+		self._fs.add_child(ZipFileSystem(self._fs, {'.zip'}, []))
+		self._cache_dir = os.path.join(self._tmp_dir.name, 'cache')
+		# Room for two of the three files:
+		self._cache = ArchiveCache(self._cache_dir, 250, self._fs)
+	def tearDown(self):
+		self._tmp_dir.cleanup()
+		super().tearDown()
\ No newline at end of file
@@ -0,0 +1,57 @@
+from core.archive_compare import compare_with_directory
+from core.fs.zip import _run_7zip
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from zipfile import ZipFile
+
+import os
+import os.path
+import tarfile
+
+class CompareWithDirectoryTest(TestCase):
+	def test_zip(self):
+		archive = os.path.join(self._tmp_dir.name, 'test.zip')
+		with ZipFile(archive, 'w') as zip_file:
+			for path, contents in self._contents.items():
+				zip_file.writestr(path, contents)
+		self._check(archive)
+	def test_7z(self):
+		archive = os.path.join(self._tmp_dir.name, 'test.7z')
+		src_dir = os.path.join(self._tmp_dir.name, 'src')
+		self._write(src_dir, self._contents)
+		_run_7zip(['a', archive, 'same.txt', 'dir', 'missing.txt'], src_dir)
+		self._check(archive)
+	def test_tar_gz(self):
+		archive = os.path.join(self._tmp_dir.name, 'test.tar.gz')
+		src_dir = os.path.join(self._tmp_dir.name, 'src')
+		self._write(src_dir, self._contents)
+		with tarfile.open(archive, 'w:gz') as tar_file:
+			for name in ('same.txt', 'dir', 'missing.txt'):
+				tar_file.add(os.path.join(src_dir, name), './' + name)
+		self._check(archive)
+	def _check(self, archive):
+		local_dir = os.path.join(self._tmp_dir.name, 'local')
+		self._write(local_dir, {
+			'same.txt': 'same', 'dir/changed.txt': 'abcd',
+			'dir/resized.txt': 'different size'
+		})
+		self.assertEqual(
+			(['dir/changed.txt', 'dir/resized.txt'], ['missing.txt']),
+			compare_with_directory(archive, local_dir)
+		)
+	def _write(self, dir_path, contents):
+		for path, text in contents.items():
+			file_path = Path(dir_path, *path.split('/'))
+			file_path.parent.mkdir(parents=True, exist_ok=True)
+			file_path.write_text(text)
+	def setUp(self):
+		super().setUp()
+		self._tmp_dir = TemporaryDirectory()
+		self._contents = {
+			'same.txt': 'same', 'dir/changed.txt': 'ABCD',
+			'dir/resized.txt': 'size', 'missing.txt': 'missing'
+		}
+	def tearDown(self):
+		self._tmp_dir.cleanup()
+		super().tearDown()
\ No newline at end of file
@@ -0,0 +1,69 @@
+from core.archive_search import search_archives
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from zipfile import ZipFile
+
+import os
+import os.path
+import tarfile
+
+class SearchArchivesTest(TestCase):
+	def test_name(self):
+		self.assertEqual(
+			{(self._zip, 'lib/log4j-core-2.14.jar'), (self._tar, 'log4j.txt')},
+			self._search('log4j*')
+		)
+	def test_name_case_insensitive(self):
+		self.assertEqual({(self._zip, 'README')}, self._search('readme'))
+	def test_text(self):
+		self.assertEqual(
+			{(self._zip, 'README'), (self._tar, 'log4j.txt')},
+			self._search('*', 'JndiLookup')
+		)
+	def test_compressed_tar(self):
+		expected = {(self._tgz, 'd/needle.txt')}
+		self.assertEqual(expected, self._search('*needle*'))
+		self.assertEqual(expected, self._search('*', 'haystack'))
+	def test_no_match(self):
+		self.assertEqual(set(), self._search('*.exe'))
+	def test_skips_corrupt_archives(self):
+		corrupt = os.path.join(self._tmp_dir.name, 'corrupt.zip')
+		with open(corrupt, 'wb') as f:
+			f.write(b'PK\x03\x04 not really a zip')
+		errors = []
+		on_error = lambda archive_path, exc: errors.append(archive_path)
+		self.assertEqual(
+			{(self._zip, 'README')}, self._search('README', on_error=on_error)
+		)
+		self.assertEqual([corrupt], errors)
+	def setUp(self):
+		super().setUp()
+		self._tmp_dir = TemporaryDirectory()
+		sub_dir = os.path.join(self._tmp_dir.name, 'sub')
+		os.mkdir(sub_dir)
+		self._zip = os.path.join(sub_dir, 'app.zip')
+		with ZipFile(self._zip, 'w') as zip_file:
+			zip_file.writestr('lib/log4j-core-2.14.jar', 'jar')
+			zip_file.writestr('README', 'Uses JndiLookup.')
+		src = os.path.join(self._tmp_dir.name, 'log4j.txt')
+		with open(src, 'w') as f:
+			f.write('x' * 100000 + 'JndiLookup')
+		self._tar = os.path.join(self._tmp_dir.name, 'b.tar')
+		with tarfile.open(self._tar, 'w') as tar_file:
+			tar_file.add(src, 'log4j.txt')
+		os.remove(src)
+		self._tgz = os.path.join(self._tmp_dir.name, 'c.tar.gz')
+		with tarfile.open(self._tgz, 'w:gz') as tar_file:
+			data = b'Needle in a haystack.'
+			tar_info = tarfile.TarInfo('./d/needle.txt')
+			tar_info.size = len(data)
+			tar_file.addfile(tar_info, BytesIO(data))
+	def tearDown(self):
+		self._tmp_dir.cleanup()
+		super().tearDown()
+	def _search(self, name_pattern, text=None, on_error=None):
+		return set(search_archives(
+			self._tmp_dir.name, ('.zip', '.tar', '.tar.gz'), name_pattern,
+			text, on_error=on_error
+		))
\ No newline at end of file
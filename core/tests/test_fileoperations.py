@@ -1,14 +1,16 @@
 from core.fileoperations import CopyFiles, MoveFiles
 from core.tests import StubFS
-from fman import YES, NO, OK, YES_TO_ALL, NO_TO_ALL, ABORT, PLATFORM
+from fman import YES, NO, OK, YES_TO_ALL, NO_TO_ALL, ABORT, PLATFORM, Task
 from fman.url import join, dirname, as_url, as_human_readable
 from os.path import exists
 from tempfile import TemporaryDirectory
+from threading import Event
 from unittest import TestCase, skipIf
 
 import os
 import os.path
 import stat
+import time
 
 class FileTreeOperationAT:
 
@@ -113,6 +115,55 @@ class FileTreeOperationAT:
 		self.test_overwrite_files(
 			files=('dir/a.txt', 'b.txt'), perform_on_files=('dir', 'b.txt')
 		)
+	def test_overwrite_files_in_several_directories(self):
+		self.test_overwrite_files(
+			(NO, YES, NO), (False, True, False),
+			files=('a/x.txt', 'b/y.txt', 'c/z.txt'),
+			perform_on_files=('a', 'b', 'c')
+		)
+	def test_skip_many_existing_files_at_once(self):
+		names = ('a.txt', 'b.txt', 'c.txt', 'd.txt')
+		self._expect_many_conflicts(names, answer=NO_TO_ALL)
+		self._perform_on(*[join(self.src, name) for name in names])
+		for name in names:
+			self._assert_file_contents_equal(join(self.dest, name), 'old')
+	def test_overwrite_many_existing_files_at_once(self):
+		names = ('a.txt', 'b.txt', 'c.txt', 'd.txt')
+		self._expect_many_conflicts(names, answer=YES)
+		self._perform_on(*[join(self.src, name) for name in names])
+		for name in names:
+			self._assert_file_contents_equal(join(self.dest, name), 'new')
+	def test_overwrite_only_older_files(self):
+		names = ('a.txt', 'b.txt', 'c.txt', 'd.txt')
+		self._expect_many_conflicts(names, answer=NO)
+		self._expect_alert(
+			('Do you want to overwrite only the files that are older than the '
+			 'new ones (Yes) or decide for each file (No)?',
+			 YES | NO | ABORT, YES),
+			answer=YES
+		)
+		# Only the existing b.txt and d.txt are older than the new files:
+		for name, offset in zip(names, (60, -60, 60, -60)):
+			src_mtime = self._stat(join(self.src, name)).st_mtime
+			mtime = src_mtime + offset
+			os.utime(as_human_readable(join(self.dest, name)), (mtime, mtime))
+		self._perform_on(*[join(self.src, name) for name in names])
+		for name, contents in zip(names, ('old', 'new', 'old', 'new')):
+			self._assert_file_contents_equal(join(self.dest, name), contents)
+	def _expect_many_conflicts(self, names, answer):
+		for name in names:
+			self._touch(join(self.src, name), 'new')
+			self._touch(join(self.dest, name), 'old')
+		paths = '\n'.join(
+			as_human_readable(join(self.dest, name)) for name in names
+		)
+		self._expect_alert(
+			('4 files already exist:\n\n%s\n\nDo you want to overwrite all '
+			 'of them (Yes or Yes to All), skip all of them (No to All) or '
+			 'choose which ones to overwrite (No)?' % paths,
+			 YES | NO | YES_TO_ALL | NO_TO_ALL | ABORT, YES_TO_ALL),
+			answer=answer
+		)
 	def test_overwrite_directory_abort(self):
 		self.test_overwrite_files(
 			(ABORT,), (False, False,), files=('dir/a/a.txt', 'dir/b/b.txt'),
@@ -363,6 +414,60 @@ class CopyFilesTest(FileTreeOperationAT, TestCase):
 			# Make the file writeable again because on Windows, the temp dir
 			# containing it can't be cleaned up otherwise.
 			self._chmod(locked_dest_file, 0o777)
+	def test_copy_starts_before_files_are_gathered(self):
+		dir_ = join(self.src, 'dir')
+		self._touch(join(dir_, 'test.txt'))
+		first_task_ran = Event()
+		waited_successfully = []
+		prepare_copy = self._fs.prepare_copy
+		def prepare_copy_slowly(src_url, dst_url):
+			yield Task('First task', fn=first_task_ran.set)
+			# Only continue gathering once the first task was executed:
+			waited_successfully.append(first_task_ran.wait(timeout=5))
+			yield from prepare_copy(src_url, dst_url)
+		self._fs.prepare_copy = prepare_copy_slowly
+		self._perform_on(dir_)
+		self.assertEqual([True], waited_successfully)
+		self._expect_files({'test.txt'}, in_dir=join(self.dest, 'dir'))
+	def test_gathering_does_not_run_far_ahead(self):
+		class CopyFewAtATime(CopyFiles):
+			_MAX_QUEUED_TASKS = 2
+		self.operation = CopyFewAtATime
+		dir_ = join(self.src, 'dir')
+		self._touch(join(dir_, 'test.txt'))
+		num_prepared = []
+		num_ahead = []
+		def run_task(i):
+			# Give the gathering threads time to run ahead:
+			time.sleep(.01)
+			num_ahead.append(len(num_prepared) - i)
+		prepare_copy = self._fs.prepare_copy
+		def prepare_many(src_url, dst_url):
+			for i in range(20):
+				num_prepared.append(i)
+				yield Task('Task %d' % i, fn=run_task, args=(i,))
+			yield from prepare_copy(src_url, dst_url)
+		self._fs.prepare_copy = prepare_many
+		self._perform_on(dir_)
+		self.assertLessEqual(max(num_ahead), 10)
+		self._expect_files({'test.txt'}, in_dir=join(self.dest, 'dir'))
+	def test_prepare_in_new_directory_after_creating_it(self):
+		dest_dir = join(self.dest, 'new')
+		makedirs = self._fs.makedirs
+		def makedirs_slowly(*args, **kwargs):
+			time.sleep(.2)
+			makedirs(*args, **kwargs)
+		self._fs.makedirs = makedirs_slowly
+		prepare_copy = self._fs.prepare_copy
+		def prepare_copy_stat_parent(src_url, dst_url):
+			# Like LocalFileSystem.prepare_move(...):
+			self._stat(dirname(dst_url))
+			return prepare_copy(src_url, dst_url)
+		self._fs.prepare_copy = prepare_copy_stat_parent
+		src_file = join(self.src, 'test.txt')
+		self._touch(src_file, '1234')
+		self._perform_on(src_file, dest_dir=dest_dir)
+		self._assert_file_contents_equal(join(dest_dir, 'test.txt'), '1234')
 
 class MoveFilesTest(FileTreeOperationAT, TestCase):
 	def __init__(self, methodName='runTest'):
@@ -426,6 +531,17 @@ class MoveFilesTest(FileTreeOperationAT, TestCase):
 		)
 		self._assert_file_contents_equal(src_file, 'src contents')
 		self._assert_file_contents_equal(dest_file, 'dest contents')
+	def test_merge_renames_missing_subdirectory(self):
+		src_dir = join(self.src, 'dir')
+		subdir = join(src_dir, 'subdir')
+		self._touch(join(subdir, 'test.txt'))
+		self._makedirs(join(self.dest, 'dir'))
+		inode = self._fs.query(subdir, 'stat').st_ino
+		self._perform_on(src_dir)
+		dest_subdir = join(self.dest, 'dir', 'subdir')
+		self.assertEqual(inode, self._fs.query(dest_subdir, 'stat').st_ino)
+		self._expect_files({'test.txt'}, in_dir=dest_subdir)
+		self.assertFalse(self._fs.exists(src_dir))
 	def test_drag_and_drop_file(self):
 		super().test_drag_and_drop_file()
 		self.assertNotIn('test.txt', self._fs.iterdir(self.src))
@@ -1,5 +1,13 @@
 from core import strformat_dict_values
+from core.fs.zip import ZipFileSystem
+from core.tests import StubFS
+from core.util import format_duration, ParentChecker
+from fman.url import as_url, join
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from zipfile import ZipFile
+
+import os
 
 class TestStrformatDictValues(TestCase):
 	def test_empty(self):
@@ -22,4 +30,59 @@ class TestStrformatDictValues(TestCase):
 		)
 	def test_list_ints(self):
 		dict_ = {'list': [1]}
-		self.assertEqual(dict_, strformat_dict_values(dict_, {'a': 'b'}))
\ No newline at end of file
+		self.assertEqual(dict_, strformat_dict_values(dict_, {'a': 'b'}))
+
+class TestFormatDuration(TestCase):
+	def test_seconds(self):
+		self.assertEqual('42 s', format_duration(42.2))
+	def test_minutes(self):
+		self.assertEqual('3 min', format_duration(170))
+	def test_hours(self):
+		self.assertEqual('2 h 5 min', format_duration(2 * 3600 + 5 * 60))
+
+class TestParentChecker(TestCase):
+	def test_parent(self):
+		self.assertTrue(self._checker.is_parent(self._src, self._dest_file))
+	def test_self(self):
+		self.assertTrue(self._checker.is_parent(self._dest, self._dest))
+	def test_sibling(self):
+		self.assertFalse(self._checker.is_parent(self._src, self._other))
+	def test_nonexistent_dir(self):
+		nonexistent = join(self._root, 'nonexistent')
+		self.assertFalse(self._checker.is_parent(nonexistent, self._dest_file))
+	def test_many_files(self):
+		for i in range(3):
+			dir_path = os.path.join(self._tmp_dir.name, 'dir%d' % i)
+			os.mkdir(dir_path)
+			dir_url = as_url(dir_path)
+			self.assertFalse(self._checker.is_parent(dir_url, self._dest_file))
+		self.assertTrue(self._checker.is_parent(self._src, self._dest_file))
+	def test_archive(self):
+		zip_path = os.path.join(self._tmp_dir.name, 'test.zip')
+		with ZipFile(zip_path, 'w') as zip_file:
+			zip_file.writestr('src/dest/file.txt', 'contents')
+			zip_file.writestr('other/file.txt', 'contents')
+		fs = StubFS()
+		fs.add_child(ZipFileSystem(fs, {'.zip'}))
+		checker = ParentChecker(fs)
+		root = 'zip://' + zip_path.replace(os.sep, '/')
+		src = join(root, 'src')
+		dest_file = join(root, 'src/dest/file.txt')
+		self.assertTrue(checker.is_parent(src, dest_file))
+		self.assertTrue(checker.is_parent(root, dest_file))
+		self.assertFalse(checker.is_parent(join(root, 'other'), dest_file))
+		self.assertFalse(checker.is_parent(self._root, dest_file))
+	def setUp(self):
+		super().setUp()
+		self._tmp_dir = TemporaryDirectory()
+		self._root = as_url(self._tmp_dir.name)
+		self._src = join(self._root, 'src')
+		self._dest = join(self._src, 'dest')
+		self._dest_file = join(self._dest, 'file.txt')
+		self._other = join(self._root, 'other')
+		os.makedirs(os.path.join(self._tmp_dir.name, 'src', 'dest'))
+		os.mkdir(os.path.join(self._tmp_dir.name, 'other'))
+		self._checker = ParentChecker(StubFS())
+	def tearDown(self):
+		self._tmp_dir.cleanup()
+		super().tearDown()
\ No newline at end of file
@@ -1,4 +1,5 @@
-from fman.url import dirname
+from fman.url import dirname, splitscheme
+from math import log
 from os import listdir, strerror
 from os.path import join
 from pathlib import PurePosixPath
@@ -20,6 +21,25 @@ def strformat_dict_values(dict_, replacements):
 		result[key] = value
 	return result
 
+def format_size(size_bytes):
+	units = ('%d B', '%d KB', '%.1f MB', '%.1f GB')
+	if size_bytes <= 0:
+		unit_index = 0
+	else:
+		unit_index = min(int(log(size_bytes, 1000)), len(units) - 1)
+	unit = units[unit_index]
+	base = 1024 ** unit_index
+	return unit % (size_bytes / base)
+
+def format_duration(seconds):
+	seconds = int(round(seconds))
+	if seconds < 60:
+		return '%d s' % seconds
+	minutes = int(round(seconds / 60))
+	if minutes < 60:
+		return '%d min' % minutes
+	return '%d h %d min' % divmod(minutes, 60)
+
 def listdir_absolute(dir_path):
 	return [join(dir_path, file_name) for file_name in listdir(dir_path)]
 
@@ -43,6 +63,43 @@ def is_parent(dir_url, file_url, fs=fman.fs):
 			continue
 	return False
 
+class ParentChecker:
+	"""
+	Like is_parent(...), but for checking many files during one operation.
+	The identity of every ancestor is looked up only once: its
+	(st_dev, st_ino) for local files, its resolved URL otherwise. Checking
+	thousands of files against the same destination thus takes O(depth)
+	lookups in total instead of O(files x depth).
+	"""
+	def __init__(self, fs=fman.fs):
+		self._fs = fs
+		self._identities = {}
+	def is_parent(self, dir_url, file_url):
+		dir_identity = self._get_identity(dir_url)
+		if dir_identity is None:
+			return False
+		for parent_url in _iter_parents(file_url):
+			if self._get_identity(parent_url) == dir_identity:
+				return True
+		return False
+	def _get_identity(self, url):
+		try:
+			return self._identities[url]
+		except KeyError:
+			result = self._compute_identity(url)
+			self._identities[url] = result
+			return result
+	def _compute_identity(self, url):
+		try:
+			if splitscheme(url)[0] == 'file://':
+				stat = self._fs.query(url, 'stat')
+				if stat.st_ino and stat.st_dev:
+					return stat.st_dev, stat.st_ino
+				# See LocalFileSystem#samefile(...).
+			return self._fs.resolve(url)
+		except FileNotFoundError:
+			return None
+
 def _iter_parents(url):
 	while True:
 		yield url